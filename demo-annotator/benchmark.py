@@ -0,0 +1,511 @@
+#!/usr/bin/env python
+# timing comparisons for the tree-indexing and mapping code paths in muriqui.py
+# usage:
+#   python benchmark.py mrca --ntax 20000 --queries 2000
+#   python benchmark.py mrca --tree-file examples/canids.tre
+#   python benchmark.py encoding --ntax 20000 --queries 2000
+#   python benchmark.py batch --ntax 20000 --queries 20000
+#   python benchmark.py checks --ntax 20000 --queries 5000
+#   python benchmark.py parse --ntax 200000 --parser stream
+#   python benchmark.py remap --ntax 20000 --queries 100000 --changes 10
+#   python benchmark.py induced --ntax 200000 --queries 300
+#   python benchmark.py model --queries 200000
+#   python benchmark.py load --queries 200000 --loader stream
+#   python benchmark.py load --queries 200000 --distinct-timestamps --lazy
+#   python benchmark.py validate --queries 100000 --workers 1
+#   python benchmark.py corpus --queries 200000 --distinct-timestamps
+#   python benchmark.py cache --ntax 20000 --queries 20000 --changes 1000
+#   python benchmark.py dedupe --ntax 20000 --queries 20000 --distinct 2000
+#   python benchmark.py table --ntax 20000 --queries 200000
+from muriqui import Annotation, AnnotationCorpus, MonophylyCondition, PlacementCache, Reason, ReferenceTarget, SplitEncoding, \
+        TargetTree, Tests, iter_annotation_batches, iter_json_values, make_target_tree, open_table_writer, \
+        validate_annotations
+from cStringIO import StringIO
+import dendropy
+import gc
+import os
+import random
+import re
+import shutil
+import sys
+import time
+
+def timed(func, *valist):
+    start = time.time()
+    r = func(*valist)
+    return time.time() - start, r
+
+def report(label, seconds, n):
+    sys.stdout.write('{l:<40} {s:10.4f} s  {p:12.2f} us/op\n'.format(l=label, s=seconds, \
+            p=1e6 * seconds / max(n, 1)))
+
+def load_tree(args):
+    if args.tree_file:
+        return dendropy.Tree.get_from_path(args.tree_file, 'newick', suppress_internal_node_taxa=False)
+    random.seed(args.seed)
+    newick = Tests.random_newick(args.ntax)
+    if args.unrooted:
+        newick = '[&U] ' + newick[5:]
+    return dendropy.Tree.get_from_string(newick, 'newick')
+
+def bench_mrca(args):
+    t = load_tree(args)
+    elapsed, tree = timed(TargetTree, t, False)
+    report('TargetTree construction', elapsed, 1)
+    elapsed, r = timed(tree.index._build_blocks)
+    report('sparse table construction', elapsed, 1)
+
+    taxa = [x for x in t.taxon_namespace if x.label in tree.index.label2node]
+    random.seed(args.seed)
+    queries = [random.sample(taxa, random.randrange(2, args.max_taxa + 1)) for i in range(args.queries)]
+
+    def with_dendropy():
+        return [t.mrca(taxa=q) for q in queries]
+    def with_index():
+        return [tree.get_mrca(q) for q in queries]
+
+    elapsed_d, expected = timed(with_dendropy)
+    report('dendropy Tree.mrca', elapsed_d, len(queries))
+    elapsed_i, found = timed(with_index)
+    report('TreeIndex.mrca', elapsed_i, len(queries))
+    if expected != found:
+        sys.exit('MRCA results differ between dendropy and the tree index')
+    sys.stdout.write('speedup: {:.1f}x\n'.format(elapsed_d / max(elapsed_i, 1e-9)))
+
+def encoding_size(tree):
+    # bytes held by the split encoding beyond what both modes share
+    if tree._split_encoding == SplitEncoding.BITMASK:
+        size = sys.getsizeof(tree.split_edges) + sys.getsizeof(tree.tree.label2bit)
+        for edge in tree.tree.preorder_edge_iter():
+            size += sys.getsizeof(edge.split_bitmask)
+        return size
+    index = tree.index
+    size = sum(a.itemsize * len(a) for a in [index.end, index.taxa_before, index.taxon_nodes])
+    if tree._split_encoding == SplitEncoding.HASH:
+        table = tree._split_table
+        size += sys.getsizeof(table._nodes) + sum(sys.getsizeof(h) for h in table._nodes)
+        size += table.taxon_hashes.itemsize * len(table.taxon_hashes)
+    return size
+
+def bench_encoding(args):
+    results = []
+    for name, encoding in [('bitmask', SplitEncoding.BITMASK), ('interval', SplitEncoding.INTERVAL), \
+            ('hash', SplitEncoding.HASH)]:
+        t = load_tree(args)
+        def build():
+            tree = TargetTree(t, False, encoding)
+            # the split table is built on first use
+            tree.is_split(tree.get_taxon_set([]))
+            return tree
+        elapsed, tree = timed(build)
+        report('{} TargetTree construction'.format(name), elapsed, 1)
+        sys.stdout.write('{l:<40} {b:10d} bytes\n'.format(l='{} encoding size'.format(name), \
+                b=encoding_size(tree)))
+
+        labels = sorted(tree.index.label2node)
+        random.seed(args.seed)
+        clades = [tree.get_taxa_in_tree(random.sample(labels, random.randrange(1, args.max_taxa + 1)))[0] \
+                for i in range(args.queries)]
+        nodes = [random.choice(tree.index.nodes) for i in range(args.queries)]
+        def checks():
+            r = []
+            for taxa, node in zip(clades, nodes):
+                taxon_set = tree.get_taxon_set(taxa)
+                r.append((tree.is_split(taxon_set), tree.clade_overlaps(node, taxon_set)))
+            return r
+        elapsed, r = timed(checks)
+        report('{} monophyly + exclusion checks'.format(name), elapsed, len(clades))
+        results.append(r)
+    if results[0] != results[1] or results[0] != results[2]:
+        sys.exit('check results differ between the split encodings')
+
+def bench_batch(args):
+    # one mrca per annotation versus all mrcas in one pass over the tree
+    results = []
+    for name in ['per annotation', 'bulk']:
+        t = load_tree(args)
+        tree = TargetTree(t, False, SplitEncoding.INTERVAL)
+        labels = sorted(tree.index.label2node)
+        random.seed(args.seed)
+        annotations = Tests.random_annotations(labels, args.queries)
+        for a in annotations:
+            a.target = ReferenceTarget.from_data(dict(a.target.to_json(), error_checks=[], warning_checks=[]))
+        if name == 'bulk':
+            elapsed, r = timed(tree.add_phyloreferenced_annotations, annotations)
+        else:
+            elapsed, r = timed(lambda: [tree.add_phyloreferenced_annotation(a) for a in annotations])
+        report('{} mapping'.format(name), elapsed, len(annotations))
+        results.append([x.reason_code for x in r])
+    if results[0] != results[1]:
+        sys.exit('bulk and per-annotation mapping differ')
+
+def bench_checks(args):
+    # the per-check loop against the vectorized CheckEngine, on the same placements
+    from muriqui import CheckEngine, Reason, TargetExcludesCondition
+    t = load_tree(args)
+    tree = TargetTree(t, False, SplitEncoding.INTERVAL)
+    labels = sorted(tree.index.label2node)
+    random.seed(args.seed)
+    annotations = Tests.random_annotations(labels, args.queries)
+    for a in annotations:
+        for i in range(3):
+            a.target.add_error_condition(TargetExcludesCondition(*random.sample(labels, 3)))
+        a.target.add_warning_condition(MonophylyCondition(*random.sample(labels, 2)))
+        a.target.add_warning_condition(MonophylyCondition(*labels[:random.randrange(2, 2000)]))
+
+    def placements():
+        r = [(a, tree.find_target(a)) for a in annotations]
+        return [(a, x) for a, x in r if x.reason_code == Reason.SUCCESS]
+    def per_check(placed):
+        for a, r in placed:
+            tree.check_target(a, r)
+    def vectorized(placed):
+        CheckEngine(tree).run(placed)
+    results = []
+    for name, func in [('per check', per_check), ('vectorized', vectorized)]:
+        placed = placements()
+        gc.collect()
+        elapsed, r = timed(func, placed)
+        report('{} error and warning checks'.format(name), elapsed, len(placed))
+        results.append([(x.reason_code, len(x.failed_warning_checks)) for a, x in placed])
+    if results[0] != results[1]:
+        sys.exit('vectorized and per-check results differ')
+
+def resident_bytes():
+    with open('/proc/self/statm') as inp:
+        return int(inp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+def bench_parse(args):
+    # one parser per run, so that the memory numbers are not mixed up
+    if args.tree_file:
+        with open(args.tree_file) as inp:
+            newick = inp.read()
+    else:
+        random.seed(args.seed)
+        newick = Tests.random_newick(args.ntax) + ';'
+    gc.collect()
+    before = resident_bytes()
+    elapsed, tree = timed(make_target_tree, newick, False, None, args.parser == 'stream')
+    report('{} parse and index'.format(args.parser), elapsed, 1)
+    sys.stdout.write('{l:<40} {b:10d} bytes\n'.format(l='{} memory held'.format(args.parser), \
+            b=resident_bytes() - before))
+
+def bench_remap(args):
+    # a full mapping onto the new tree version against carrying forward the
+    # placements made on the old one; the new version gets a new taxon next
+    # to `--changes` random tips
+    random.seed(args.seed)
+    old_newick = Tests.random_newick(args.ntax)
+    labels = ['t' + str(i) for i in range(args.ntax)]
+    moved = set(random.sample(labels, args.changes))
+    new_newick = re.sub(r'\bt\d+\b', lambda m: '({},n{})'.format(m.group(), m.group()) if m.group() in moved \
+            else m.group(), old_newick)
+    annotations = Tests.random_annotations(labels, args.queries)
+    previous = make_target_tree(old_newick, use_taxonomy=False, stream_parse=True)
+    previous.add_phyloreferenced_annotations(annotations)
+    table = StringIO()
+    previous.write_table(table)
+    resolutions = StringIO()
+    previous.write_resolutions(resolutions)
+
+    results = []
+    for name in ['full', 'incremental']:
+        tree = make_target_tree(new_newick, use_taxonomy=False, stream_parse=True)
+        gc.collect()
+        if name == 'full':
+            elapsed, r = timed(tree.add_phyloreferenced_annotations, annotations)
+        else:
+            elapsed, r = timed(tree.remap_from_previous, annotations, previous, StringIO(table.getvalue()), \
+                    StringIO(resolutions.getvalue()))
+            sys.stdout.write('{l:<40} {c:10d} of {n}\n'.format(l='carried forward', \
+                    c=tree.number_annotations_carried_forward, n=len(annotations)))
+        report('{} mapping'.format(name), elapsed, len(annotations))
+        results.append([(x.reason_code, x.attached_to and x.attached_to.__class__, \
+                getattr(getattr(x.attached_to, 'head_node', x.attached_to), 'preorder_index', None), \
+                [c.explain() for c in x.failed_error_checks], [c.explain() for c in x.failed_warning_checks]) for x in r])
+    if results[0] != results[1]:
+        sys.exit('incremental and full mapping differ')
+
+def bench_induced(args):
+    # a small batch mapped onto the whole tree against the induced subtree
+    random.seed(args.seed)
+    tree = make_target_tree(Tests.random_newick(args.ntax), use_taxonomy=False, stream_parse=True)
+    annotations = Tests.random_annotations(['t' + str(i) for i in range(args.ntax)], args.queries)
+    gc.collect()
+    elapsed, induced = timed(tree.induced_tree, annotations)
+    report('induced subtree of {} nodes'.format(len(induced.index)), elapsed, 1)
+    results = []
+    for name, t in [('whole tree', tree), ('induced subtree', induced)]:
+        gc.collect()
+        elapsed, r = timed(t.add_phyloreferenced_annotations, annotations)
+        report('{} mapping'.format(name), elapsed, len(annotations))
+        results.append([(x.reason_code, x.attached_to and \
+                t.get_node_out_id(getattr(x.attached_to, 'head_node', x.attached_to))) for x in r])
+    if results[0] != results[1]:
+        sys.exit('induced and whole tree mapping differ')
+
+# one annotation in the shape of examples/armadillo-annot.json
+ANNOTATION_TEMPLATE = '{{"_id": "{i}", "oa:annotatedBy": {{"type": "prov:Entity", "name": "blackrim"}}, ' \
+        '"oa:annotatedAt": "2014-09-20T19:53:25.813239", "oa:hasTarget": {{"type": "branch", ' \
+        '"included_ids": [{a}, {b}], "excluded_ids": [{c}], "error_checks": [["REQUIRE_MONOPHYLETIC", {a}]], ' \
+        '"warning_checks": []}}, "oa:hasBody": {{"type": "divergence time estimate", "citation": "doi:10.1000/{i}", ' \
+        '"mean age": {i}}}}}'
+
+def bench_model(args):
+    # resident memory per annotation read by Annotation.from_data (specifiers
+    # are drawn from 10000 ott ids, every annotation has the same annotator)
+    import json
+    random.seed(args.seed)
+    gc.collect()
+    before = resident_bytes()
+    start = time.time()
+    annotations = []
+    for i in xrange(args.queries):
+        ids = [random.randrange(10000) for j in range(3)]
+        data = json.loads(ANNOTATION_TEMPLATE.format(i=i, a=ids[0], b=ids[1], c=ids[2]))
+        annotations.append(Annotation.from_data(data))
+    elapsed = time.time() - start
+    gc.collect()
+    report('Annotation.from_data', elapsed, len(annotations))
+    sys.stdout.write('{l:<40} {b:10d} bytes\n'.format(l='memory per annotation', \
+            b=(resident_bytes() - before) // max(len(annotations), 1)))
+
+def bench_load(args):
+    # peak memory of reading an annotations file, all at once with json.load
+    # (as a JSON array) or in batches (as JSON-lines); one loader per run.
+    # With --distinct-timestamps every annotation has its own oa:annotatedAt
+    # (as written by create_ott_annotations.py)
+    import json
+    import resource
+    import tempfile
+    random.seed(args.seed)
+    handle, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(handle, 'w') as out:
+        for i in xrange(args.queries):
+            ids = [random.randrange(10000) for j in range(3)]
+            line = ANNOTATION_TEMPLATE.format(i=i, a=ids[0], b=ids[1], c=ids[2])
+            if args.distinct_timestamps:
+                line = line.replace('19:53:25.813239', '19:53:25.{:06d}'.format(i % 1000000))
+            if args.loader == 'json':
+                line = ('[' if i == 0 else ',') + line
+            out.write(line + '\n')
+        if args.loader == 'json':
+            out.write(']\n')
+    try:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        n = 0
+        if args.loader == 'json':
+            with open(path) as inp:
+                annotations = [Annotation.from_data(a, lazy=args.lazy) for a in json.load(inp)]
+            n = len(annotations)
+        else:
+            for batch in iter_annotation_batches(path, args.batch_size, lazy=args.lazy):
+                n += len(batch)
+        elapsed = time.time() - start
+        report('load ({}{})'.format(args.loader, ', lazy' if args.lazy else ''), elapsed, n)
+        sys.stdout.write('{l:<40} {b:10d} kB\n'.format(l='peak memory growth', \
+                b=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before))
+    finally:
+        os.remove(path)
+
+def bench_validate(args):
+    # one in 20 annotations has a bad timestamp, target type or body; the
+    # schemas of ../schemas apply to the bodies
+    import tempfile
+    random.seed(args.seed)
+    handle, path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(handle, 'w') as out:
+        for i in xrange(args.queries):
+            ids = [random.randrange(10000) for j in range(3)]
+            line = ANNOTATION_TEMPLATE.format(i=i, a=ids[0], b=ids[1], c=ids[2])
+            if i % 20 == 0:
+                line = line.replace(['2014-09-20', '"branch"', '"mean age": ' + str(i)][i // 20 % 3], \
+                        ['20140-09-20', '"tree"', '"mean age": "old"'][i // 20 % 3])
+            out.write(line + '\n')
+    try:
+        start = time.time()
+        bad = 0
+        with open(path) as inp:
+            for d in iter_json_values(inp):
+                try:
+                    Annotation.from_data(d)
+                except ValueError:
+                    bad += 1
+        report('from_data, first error ({} bad)'.format(bad), time.time() - start, args.queries)
+        schema_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'schemas')
+        start = time.time()
+        errors = validate_annotations(path, schema_dir, workers=args.workers)
+        report('validate_annotations ({} bad)'.format(len(errors)), time.time() - start, args.queries)
+    finally:
+        os.remove(path)
+
+def bench_corpus(args):
+    # reading the same annotations from JSON-lines (eager and lazy) and from
+    # an AnnotationCorpus built from them
+    import tempfile
+    random.seed(args.seed)
+    handle, path = tempfile.mkstemp(suffix='.json')
+    corpus_path = path + '.corpus'
+    with os.fdopen(handle, 'w') as out:
+        for i in xrange(args.queries):
+            ids = [random.randrange(10000) for j in range(3)]
+            line = ANNOTATION_TEMPLATE.format(i=i, a=ids[0], b=ids[1], c=ids[2])
+            if args.distinct_timestamps:
+                line = line.replace('19:53:25.813239', '19:53:25.{:06d}'.format(i % 1000000))
+            out.write(line + '\n')
+    try:
+        for lazy in [False, True]:
+            elapsed, n = timed(lambda: sum(len(b) for b in iter_annotation_batches(path, lazy=lazy)))
+            report('JSON-lines ({})'.format('lazy' if lazy else 'eager'), elapsed, n)
+        annotations = (a for b in iter_annotation_batches(path, lazy=True) for a in b)
+        elapsed, corpus = timed(AnnotationCorpus.build, annotations, corpus_path)
+        corpus.close()
+        report('AnnotationCorpus.build', elapsed, args.queries)
+        elapsed, n = timed(lambda: sum(len(b) for b in iter_annotation_batches(corpus_path)))
+        report('AnnotationCorpus', elapsed, n)
+        corpus = AnnotationCorpus(corpus_path)
+        ids = [random.randrange(args.queries) for i in xrange(1000)]
+        elapsed, found = timed(lambda: [corpus.get(str(i)) for i in ids])
+        corpus.close()
+        report('AnnotationCorpus.get', elapsed, len(found))
+        sys.stdout.write('{l:<40} {j:10d} {c:10d} bytes\n'.format(l='JSON-lines, corpus size', \
+                j=os.path.getsize(path), c=os.path.getsize(corpus_path)))
+    finally:
+        os.remove(path)
+        if os.path.exists(corpus_path):
+            os.remove(corpus_path)
+
+def bench_cache(args):
+    # mapping everything, then again through a cold and a warm PlacementCache
+    # after giving --changes annotations new targets
+    import tempfile
+    t = load_tree(args)
+    newick = t.as_string('newick')
+    labels = sorted(TargetTree(t, False).index.label2node)
+    random.seed(args.seed)
+    annotations = Tests.random_annotations(labels, args.queries)
+    changed = Tests.random_annotations(labels, args.changes)
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    try:
+        for name in ['no cache', 'cold cache', 'warm cache']:
+            tree = make_target_tree(newick, use_taxonomy=False, stream_parse=True)
+            if name == 'no cache':
+                elapsed, r = timed(tree.add_phyloreferenced_annotations, annotations)
+            else:
+                cache = PlacementCache(path)
+                if name == 'warm cache':
+                    for a, c in zip(annotations, changed):
+                        a.target = c.target
+                elapsed, r = timed(tree.add_phyloreferenced_annotations_cached, annotations, cache)
+                cache.close()
+            report('{} mapping'.format(name), elapsed, len(annotations))
+    finally:
+        os.remove(path)
+
+def bench_dedupe(args):
+    # --queries annotations sharing --distinct targets (equal copies), mapped
+    # one target per annotation and once per distinct target
+    t = load_tree(args)
+    labels = sorted(TargetTree(t, False).index.label2node)
+    random.seed(args.seed)
+    targets = [a.target.to_json() for a in Tests.random_annotations(labels, args.distinct)]
+    annotations = []
+    for i in xrange(args.queries):
+        a = Annotation(i)
+        a.target = ReferenceTarget.from_data(random.choice(targets))
+        annotations.append(a)
+    results = []
+    for name in ['per annotation', 'deduplicated']:
+        tree = TargetTree(load_tree(args), False, SplitEncoding.INTERVAL)
+        if name == 'deduplicated':
+            elapsed, r = timed(tree.add_phyloreferenced_annotations, annotations)
+        else:
+            def per_annotation():
+                outcomes = tree._find_targets(annotations)
+                tree._check_and_record(annotations, outcomes)
+                return outcomes
+            elapsed, r = timed(per_annotation)
+        report('{} mapping'.format(name), elapsed, len(annotations))
+        results.append([(x.reason_code, len(x.failed_warning_checks)) for x in r])
+    if results[0] != results[1]:
+        sys.exit('deduplicated and per-annotation mapping differ')
+
+def write_table_by_row(tree, out):
+    # the placement table as written one formatted row at a time
+    out.write('type\ttarget_id\tannotation_id\treason\n')
+    for kind, node, refs in tree.iter_placements():
+        for a in refs:
+            out.write('{k}\t{n}\t{a}\t{o}\n'.format(k=kind, n=tree.get_node_out_id(node), a=a.id, \
+                    o=Reason.to_str(Reason.SUCCESS)))
+    for annotation, result in tree.unadded_annotations:
+        out.write('NA\tNA\t{a}\t{o}\n'.format(a=annotation.id, o=Reason.to_str(result.reason_code)))
+
+def bench_table(args):
+    # writing the placement table of --queries annotations row by row and
+    # through the table writers of every format
+    import tempfile
+    t = load_tree(args)
+    labels = sorted(TargetTree(t, False).index.label2node)
+    random.seed(args.seed)
+    tree = TargetTree(t, False, SplitEncoding.INTERVAL)
+    tree.add_phyloreferenced_annotations(Tests.random_annotations(labels, args.queries))
+    tree.write_labeled_tree(StringIO())
+    directory = tempfile.mkdtemp()
+    try:
+        for name, suffix, table_format in [('by row', '.tsv', None), ('tsv', '.tsv', 'tsv'), \
+                ('tsv gzip', '.tsv.gz', 'tsv'), ('columns', '.columns', 'columns'), \
+                ('columns gzip', '.columns.gz', 'columns')]:
+            path = os.path.join(directory, 'table' + suffix)
+            if table_format is None:
+                def write():
+                    with open(path, 'w') as out:
+                        write_table_by_row(tree, out)
+            else:
+                def write():
+                    table = open_table_writer(path, table_format)
+                    table.write_rows(tree.iter_table_rows())
+                    table.close()
+            elapsed, r = timed(write)
+            report('{} table ({:.1f} MB)'.format(name, os.path.getsize(path) / 1e6), elapsed, args.queries)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser('benchmarks for the muriqui annotation mapper')
+    parser.add_argument('benchmark', choices=['mrca', 'encoding', 'batch', 'checks', 'parse', 'remap', \
+            'induced', 'model', 'load', 'validate', 'corpus', 'cache', 'dedupe', 'table'])
+    parser.add_argument('--tree-file', help='newick tree to use instead of a random tree')
+    parser.add_argument('--ntax', type=int, default=10000, help='number of tips in the random tree')
+    parser.add_argument('--queries', type=int, default=1000, help='number of queries to time')
+    parser.add_argument('--max-taxa', type=int, default=20, help='maximum number of taxa per query')
+    parser.add_argument('--parser', choices=['dendropy', 'stream'], default='stream', help='tree parser for parse')
+    parser.add_argument('--changes', type=int, default=50, help='number of tips given a new sister taxon for remap')
+    parser.add_argument('--distinct', type=int, default=1000, help='number of distinct targets for dedupe')
+    parser.add_argument('--unrooted', action='store_true', default=False, help='make the random tree unrooted')
+    parser.add_argument('--loader', choices=['json', 'stream'], default='stream', help='annotation reader for load')
+    parser.add_argument('--batch-size', type=int, default=10000, help='annotations per batch for load --loader stream')
+    parser.add_argument('--lazy', action='store_true', default=False, help='read annotations lazily for load')
+    parser.add_argument('--distinct-timestamps', action='store_true', default=False, \
+            help='give every annotation its own timestamp for load')
+    parser.add_argument('--workers', type=int, default=1, help='processes used by validate')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    args = parser.parse_args()
+    {
+        'mrca': bench_mrca,
+        'encoding': bench_encoding,
+        'batch': bench_batch,
+        'checks': bench_checks,
+        'parse': bench_parse,
+        'remap': bench_remap,
+        'induced': bench_induced,
+        'model': bench_model,
+        'load': bench_load,
+        'validate': bench_validate,
+        'corpus': bench_corpus,
+        'cache': bench_cache,
+        'dedupe': bench_dedupe,
+        'table': bench_table,
+    }[args.benchmark](args)
@@ -1,21 +1,36 @@
 #!/usr/bin/env python
+from array import array
 from copy import deepcopy as copy
 from datetime import datetime
+from dendropy.dataio.nexusprocessing import escape_nexus_token
 from dendropy.utility import container
+from multiprocessing.pool import ThreadPool
 from peyotl.api import APIWrapper
 from cStringIO import StringIO
+import bisect
 import codecs
+import hashlib
 import dateutil.parser
 import dendropy
+import gzip
 import json
 import math
+import mmap
 import os
 import random
+import re
 import shutil
+import sqlite3
 import string
+import struct
 import sys
+import threading
 import time
 import unittest
+try:
+    import numpy
+except ImportError:
+    numpy = None
 TAXOMACHINE = APIWrapper().taxomachine
 TREEMACHINE = APIWrapper().tree_of_life
 SCRIPT_NAME = os.path.split(sys.argv[0])[1]
@@ -35,23 +50,33 @@ class Reason(object):
             return 'the include group is paraphyletic with respect to member/members of the exclude group'
         return ''
     to_str = staticmethod(to_str)
+    def to_code(s):
+        # the inverse of to_str, for reading back a table written by write_table
+        for c in [Reason.NO_INC_DESIGNATORS_IN_TREE, Reason.SUCCESS, Reason.MRCA_HAS_EXCLUDED, \
+                Reason.ERROR_CHECK_FAILED]:
+            if Reason.to_str(c) == s:
+                return c
+        raise ValueError('unknown reason "{}"'.format(s))
+    to_code = staticmethod(to_code)
 
 def debug(msg):
     sys.stderr.write('{s}: {m}\n'.format(s=SCRIPT_NAME, m=msg))
 
 class MappingOutcome(object):
+    __slots__ = ('attached_to', 'reason_code', 'missing_inc', 'missing_exc', 'failed_error_checks', \
+            'failed_warning_checks')
     def __init__(self, attached_to, reason_code, missing_inc, missing_exc):
         self.attached_to = attached_to
         self.reason_code = reason_code
         self.missing_inc = missing_inc
         self.missing_exc = missing_exc
-        self.failed_error_checks = []
-        self.failed_warning_checks = []
+        self.failed_error_checks = ()
+        self.failed_warning_checks = ()
     def add_failed_error_check(self, check):
-        self.failed_error_checks.append(check)
+        self.failed_error_checks += (check,)
         self.reason_code = Reason.ERROR_CHECK_FAILED
     def add_failed_warning_check(self, check):
-        self.failed_warning_checks.append(check)
+        self.failed_warning_checks += (check,)
     def explain(self):
         if self.reason_code == Reason.SUCCESS:
             return 'succcessfully mapped to {}'.format(self.attached_to)
@@ -59,16 +84,1072 @@ class MappingOutcome(object):
             return 'Error check ({}) failed.'.format(self.failed_error_checks[0].explain())
         return 'Attaching the annotation to the tree failed ({})'.format(Reason.to_str(self.reason_code))
 
+# tokens of a newick tree statement: comments, quoted labels, punctuation,
+# unquoted labels (or edge lengths) and whitespace
+_NEWICK_TOKEN = re.compile(r"\[[^\]]*\]|'(?:[^']|'')*'|[(),:;]|[^\s(),:;\[\]']+|\s+")
+
+class AnnotationRefs(object):
+    """
+    List-like container of the annotations attached to a node or edge (its
+    `phylo_ref`), or of the (annotation, outcome) pairs of
+    TargetTree.unadded_annotations. It iterates in insertion order like the
+    list it replaces, but also removes an item by annotation id in amortized
+    O(1): the slot is cleared, and the list compacted once half of it is
+    empty. The id to slots lookup is only built on the first removal; of
+    several items with the same id the last one added is removed first.
+    """
+    __slots__ = ('_items', '_slots', '_removed', '_key')
+    _EMPTY = object()
+
+    def __init__(self, key=None):
+        # `key` returns the annotation id of an item (default: its `id`)
+        self._items = []
+        self._slots = None
+        self._removed = 0
+        self._key = key
+
+    def _id(self, item):
+        if self._key is None:
+            return item.id
+        return self._key(item)
+
+    def append(self, item):
+        if self._slots is not None:
+            self._slots.setdefault(self._id(item), []).append(len(self._items))
+        self._items.append(item)
+
+    def remove(self, annotation_id):
+        if self._slots is None:
+            self._slots = {}
+            for i, x in enumerate(self._items):
+                if x is not self._EMPTY:
+                    self._slots.setdefault(self._id(x), []).append(i)
+        slots = self._slots[annotation_id]
+        i = slots.pop()
+        if not slots:
+            del self._slots[annotation_id]
+        item = self._items[i]
+        self._items[i] = self._EMPTY
+        self._removed += 1
+        if 2 * self._removed > len(self._items):
+            self._items = [x for x in self._items if x is not self._EMPTY]
+            self._slots = None
+            self._removed = 0
+        return item
+
+    def __iter__(self):
+        for x in self._items:
+            if x is not self._EMPTY:
+                yield x
+
+    def __len__(self):
+        return len(self._items) - self._removed
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+def _pair_annotation_id(pair):
+    return pair[0].id
+
+class TreeIndex(object):
+    """
+    Compact array-backed view of the topology of a tree. Nodes are numbered
+    in preorder, so the subtree of node `i` is the contiguous range
+    `i..end[i]` of the numbering. The following arrays are indexed by
+    preorder number:
+        - `parent` : preorder number of the parent node (-1 for the root)
+        - `depth` : number of edges between the node and the root
+        - `end` : largest preorder number found in the subtree of the node
+        - `postorder` : postorder number of the node
+        - `taxa_before` : number of taxon-bearing nodes that precede the
+            node in preorder (one extra trailing entry holds the total)
+    `nodes` holds the dendropy nodes in preorder, `label2node` maps every
+    taxon label to the preorder number of the node that bears it,
+    `taxon_nodes` lists the taxon-bearing nodes in preorder and `labels` the
+    matching taxon labels.
+
+    `save` writes the arrays to a flat file of int32 sections that `load`
+    memory-maps, so that several processes (or later runs) can share one
+    copy of the index (the `nodes` of a loaded index are IndexedNode
+    stand-ins). The file can also carry the output id of every node
+    (`node_labels`) and the labeled newick of the tree (`newick`), which
+    lets IndexedTargetTree write its results without the dendropy tree.
+    `from_newick` builds the index straight from a newick string, without
+    dendropy objects.
+
+    The LCA of `a < b` is either `a` itself (if `b` is in its subtree) or the
+    parent of the shallowest node in the preorder range `a+1..b`. That
+    range-minimum query is answered with a sparse table over blocks of
+    BLOCK_SIZE consecutive nodes plus a scan of at most two partial blocks,
+    so every query costs a constant number of steps and the table takes
+    O(n/BLOCK_SIZE log n) space. The MRCA of a set of nodes is the LCA of
+    the nodes with the smallest and largest preorder numbers.
+    """
+    BLOCK_SIZE = 32
+    MAGIC = 'TREEIDX1'
+    _HEADER = struct.Struct('<8sIIIIQ')
+    _ROOTED, _HAS_NODE_LABELS = 1, 2
+
+    def __init__(self, tree):
+        self.nodes = []
+        self.parent = array('l')
+        self.depth = array('l')
+        self.taxa_before = array('l')
+        self.taxon_nodes = array('l')
+        self.labels = []
+        self.label2node = {}
+        self.is_rooted = bool(tree.is_rooted)
+        self.node_labels = None
+        self.newick = None
+        for i, node in enumerate(tree.preorder_node_iter()):
+            node.preorder_index = i
+            self.nodes.append(node)
+            p = node.parent_node
+            if p is None:
+                self.parent.append(-1)
+                self.depth.append(0)
+            else:
+                self.parent.append(p.preorder_index)
+                self.depth.append(self.depth[p.preorder_index] + 1)
+            self.taxa_before.append(len(self.taxon_nodes))
+            if node.taxon is not None:
+                self.label2node[node.taxon.label] = i
+                self.taxon_nodes.append(i)
+                self.labels.append(node.taxon.label)
+        self.taxa_before.append(len(self.taxon_nodes))
+        self._compute_end()
+        self.postorder = array('l', [0]) * len(self.nodes)
+        for i, node in enumerate(tree.postorder_node_iter()):
+            self.postorder[node.preorder_index] = i
+        self._blocks = None
+
+    def _compute_end(self):
+        n = len(self.parent)
+        self.end = array('l', range(n))
+        for i in xrange(n - 1, 0, -1):
+            p = self.parent[i]
+            if self.end[i] > self.end[p]:
+                self.end[p] = self.end[i]
+
+    @classmethod
+    def from_newick(cls, newick, label_converter=None):
+        """
+        Builds the index of one newick tree statement in a single pass over
+        its tokens, without creating dendropy objects. Labels are read the
+        way main() has dendropy read them (unquoted underscores become
+        spaces, labels of internal nodes are taxa, blank nodes are kept) and
+        non-numeric labels are passed through `label_converter` (e.g.
+        OTTNameConverter.concat_taxon_label_to_ott_id). Branch lengths are
+        kept in `lengths` (`has_length` flags the nodes that have one), and
+        `node_labels` holds the output ids TargetTree would give the nodes,
+        so write_newick can produce the labeled tree. A label that occurs
+        twice is a ValueError, as for TargetTree.
+        """
+        parent = array('l')
+        lengths = array('d')
+        has_length = bytearray()
+        node_label = []
+        rooting = None
+        stack = [] # open internal nodes, with whether a labeled or internal child was seen
+        current = -1 # the node a label or edge length belongs to
+        prev = None
+        want_length = False
+        for m in _NEWICK_TOKEN.finditer(newick):
+            tok = m.group()
+            c = tok[0]
+            if c == '[':
+                if not parent and tok[1:3].upper() in ('&R', '&U'):
+                    rooting = tok[2].upper() == 'R'
+                continue
+            if c.isspace():
+                continue
+            if want_length:
+                want_length = False
+                lengths[current] = float(tok)
+                has_length[current] = 1
+                prev = 'length'
+                continue
+            if c == ';':
+                break
+            if c == ':':
+                if current < 0:
+                    current = len(parent)
+                    parent.append(stack[-1][0] if stack else -1)
+                    lengths.append(0.0)
+                    has_length.append(0)
+                    node_label.append(None)
+                want_length = True
+                continue
+            if c == '(' or (c != ',' and c != ')' and current < 0):
+                # a new internal node or leaf
+                current = len(parent)
+                if stack:
+                    parent.append(stack[-1][0])
+                    stack[-1][1] = True
+                else:
+                    parent.append(-1)
+                lengths.append(0.0)
+                has_length.append(0)
+                node_label.append(None)
+                if c == '(':
+                    stack.append([current, False])
+                    current = -1
+                    prev = c
+                    continue
+            if c == ',' or c == ')':
+                if prev == ',' or (c == ',' and prev == '('):
+                    if c == ',' or not stack[-1][1]:
+                        # blank node
+                        parent.append(stack[-1][0])
+                        lengths.append(0.0)
+                        has_length.append(0)
+                        node_label.append(None)
+                current = stack.pop()[0] if c == ')' else -1
+                prev = c
+                continue
+            if c == "'":
+                label = tok[1:-1].replace("''", "'")
+            else:
+                label = tok.replace('_', ' ')
+            if label_converter is not None:
+                try:
+                    int(label)
+                except ValueError:
+                    label = label_converter(label)
+            node_label[current] = label
+            prev = 'label'
+
+        self = cls.__new__(cls)
+        n = len(parent)
+        self.parent = parent
+        self.depth = array('l', [0]) * n
+        self.taxa_before = array('l')
+        self.taxon_nodes = array('l')
+        self.labels = []
+        self.label2node = {}
+        for i in xrange(n):
+            if i:
+                self.depth[i] = self.depth[parent[i]] + 1
+            self.taxa_before.append(len(self.taxon_nodes))
+            label = node_label[i]
+            if label is not None:
+                if label in self.label2node:
+                    raise ValueError('taxon label "{}" occurs more than once in the tree'.format(label))
+                self.label2node[label] = i
+                self.taxon_nodes.append(i)
+                self.labels.append(label)
+        self.taxa_before.append(len(self.taxon_nodes))
+        del node_label
+        self._compute_end()
+        self.postorder = array('l', [self.end[i] - self.depth[i] for i in xrange(n)])
+        self.is_rooted = bool(rooting)
+        self.rooting = rooting
+        self.lengths = lengths
+        self.has_length = has_length
+        self.nodes = _IndexedNodeList(self)
+        self.node_labels = _NodeOutIds(self)
+        self.newick = None
+        self._blocks = None
+        return self
+
+    def write_newick(self, out):
+        # writes the labeled newick of an index built by from_newick, as
+        # TargetTree.write_labeled_tree writes the dendropy tree
+        out.write({None: '', True: '[&R] ', False: '[&U] '}[self.rooting])
+        def body(i):
+            tag = escape_nexus_token(self.node_labels[i])
+            if self.has_length[i]:
+                return '{t}:{l}'.format(t=tag, l=self.lengths[i])
+            return tag
+        stack = []
+        for i in xrange(len(self.parent)):
+            while stack and self.end[stack[-1]] < i:
+                out.write(')' + body(stack.pop()))
+            if i and i != self.parent[i] + 1:
+                out.write(',')
+            if self.end[i] > i:
+                out.write('(')
+                stack.append(i)
+            else:
+                out.write(body(i))
+        while stack:
+            out.write(')' + body(stack.pop()))
+        out.write(';\n')
+
+    def save(self, filepath, key='', node_labels=None, newick=None):
+        """
+        Writes the index to `filepath`: a header (with the optional `key`
+        string), the int32 sections parent, depth, end, postorder,
+        taxa_before and taxon_nodes, two int32 sections with the offsets of
+        the taxon labels and of the node labels, the labels as utf-8 bytes
+        and finally the newick string.
+        `node_labels` and `newick` default to those of the index.
+        """
+        if node_labels is None:
+            node_labels = self.node_labels
+        if newick is None:
+            newick = self.newick
+        flags = self._ROOTED if self.is_rooted else 0
+        if node_labels is not None:
+            flags |= self._HAS_NODE_LABELS
+        else:
+            node_labels = [''] * len(self.parent)
+        def encoded(strings):
+            return [x.encode('utf-8') if isinstance(x, unicode) else str(x) for x in strings]
+        labels = encoded(self.labels)
+        node_labels = encoded(node_labels)
+        sections = [self.parent, self.depth, self.end, self.postorder, self.taxa_before, self.taxon_nodes]
+        for strings in [labels, node_labels]:
+            offsets = array('i', [0])
+            for x in strings:
+                offsets.append(offsets[-1] + len(x))
+            sections.append(offsets)
+        key = key.encode('utf-8')
+        newick = encoded([newick or ''])[0]
+        with open(filepath, 'wb') as out:
+            out.write(self._HEADER.pack(self.MAGIC, len(self.parent), len(self.taxon_nodes), \
+                    flags, len(key), len(newick)))
+            out.write(key)
+            for a in sections:
+                a = array('i', a)
+                if sys.byteorder == 'big':
+                    a.byteswap()
+                a.tofile(out)
+            for x in labels + node_labels:
+                out.write(x)
+            out.write(newick)
+
+    @classmethod
+    def load(cls, filepath):
+        # memory-maps an index written by `save`
+        self = cls.__new__(cls)
+        self.filepath = filepath
+        self._file = open(filepath, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < cls._HEADER.size:
+            self.close()
+            raise ValueError('"{}" is not a tree index'.format(filepath))
+        magic, n, k, flags, key_len, newick_len = cls._HEADER.unpack_from(self._map, 0)
+        if magic != cls.MAGIC:
+            self.close()
+            raise ValueError('"{}" is not a tree index'.format(filepath))
+        self.is_rooted = bool(flags & cls._ROOTED)
+        offset = cls._HEADER.size
+        self.key = self._map[offset:offset + key_len].decode('utf-8')
+        offset += key_len
+        sections = []
+        for length in [n, n, n, n, n + 1, k, k + 1, n + 1]:
+            sections.append(_Int32Section(self._map, offset, length))
+            offset += 4 * length
+        if offset > len(self._map):
+            self.close()
+            raise ValueError('tree index "{}" is truncated'.format(filepath))
+        self.parent, self.depth, self.end, self.postorder, self.taxa_before, self.taxon_nodes, \
+                label_offsets, node_label_offsets = sections
+        self.labels = _StringSection(self._map, label_offsets, offset)
+        offset += label_offsets[-1]
+        self.node_labels = None
+        if flags & cls._HAS_NODE_LABELS:
+            self.node_labels = _StringSection(self._map, node_label_offsets, offset)
+        offset += node_label_offsets[-1]
+        if offset + newick_len != len(self._map):
+            self.close()
+            raise ValueError('tree index "{}" is truncated'.format(filepath))
+        self.newick = buffer(self._map, offset, newick_len) if newick_len else None
+        self.label2node = dict((self.labels[r], self.taxon_nodes[r]) for r in xrange(k))
+        self.nodes = _IndexedNodeList(self)
+        self._blocks = None
+        return self
+
+    def close(self):
+        # releases the file of a loaded index (one built in memory has none)
+        if getattr(self, '_map', None) is not None:
+            self._map.close()
+            self._file.close()
+            self._map = None
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def is_ancestor(self, a, b):
+        # True if `b` is in the subtree of `a` (a node is its own ancestor)
+        return a <= b <= self.end[a]
+
+    def num_taxa_in_subtree(self, i):
+        return self.taxa_before[self.end[i] + 1] - self.taxa_before[i]
+
+    def content_hash(self):
+        # sha1 of the shape and taxon labels of the tree, the same for equal
+        # trees however they were read or numbered
+        h = hashlib.sha1('rooted' if self.is_rooted else 'unrooted')
+        for a in [self.parent, self.taxon_nodes]:
+            a = a.slice(0, len(a)) if isinstance(a, _Int32Section) else array('i', a)
+            if sys.byteorder == 'big':
+                a.byteswap()
+            h.update(a.tostring())
+        for l in self.labels:
+            h.update(l.encode('utf-8') + '\n')
+        return h.hexdigest()
+
+    def subtree_taxon_counts(self):
+        # num_taxa_in_subtree of every node, by preorder number
+        return array('l', [self.num_taxa_in_subtree(i) for i in xrange(len(self.parent))])
+
+    def subtree_overlaps(self, i, sorted_indices):
+        # True if any of the (sorted) preorder numbers falls in the subtree of `i`
+        j = bisect.bisect_left(sorted_indices, i)
+        return j < len(sorted_indices) and sorted_indices[j] <= self.end[i]
+
+    def taxon_hashes(self, taxa=None):
+        # a 64-bit hash of every taxon label, by rank (0 for labels not in `taxa`)
+        return array('L', [_label_hash(l) if taxa is None or l in taxa else 0 for l in self.labels])
+
+    def split_hashes(self, taxa=None, taxon_hashes=None):
+        """
+        Returns (by preorder number) a 64-bit hash of the set of taxa in the
+        subtree of every node: the XOR of a hash of each taxon label, so the
+        same taxon set gets the same hash in any tree. With `taxa` (a set of
+        labels) the other taxa are left out of every set. `taxon_hashes` may
+        hold the result of taxon_hashes(taxa), if already computed.
+        """
+        if taxon_hashes is None:
+            taxon_hashes = self.taxon_hashes(taxa)
+        prefix = array('L', [0])
+        h = 0
+        for x in taxon_hashes:
+            h ^= x
+            prefix.append(h)
+        taxa_before = self.taxa_before
+        end = self.end
+        return array('L', [prefix[taxa_before[end[i] + 1]] ^ prefix[taxa_before[i]] \
+                for i in xrange(len(self.parent))])
+
+    def taxa_below(self, nodes):
+        # the set of labels of the taxa in the subtrees of the given nodes
+        marks = array('l', [0]) * (len(self.labels) + 1)
+        for i in nodes:
+            marks[self.taxa_before[i]] += 1
+            marks[self.taxa_before[self.end[i] + 1]] -= 1
+        below = set()
+        depth = 0
+        for r in xrange(len(self.labels)):
+            depth += marks[r]
+            if depth > 0:
+                below.add(self.labels[r])
+        return below
+
+    def is_split(self, sorted_indices, rooted=True):
+        """
+        Returns True if the taxon-bearing nodes `sorted_indices` are exactly
+        the taxa of one subtree (or, for unrooted trees, if the remaining taxa
+        of the tree are). Matches the lookups done in the bitmask
+        `split_edges` dictionary, including the singleton splits that internal
+        node taxa add to it.
+        """
+        k = len(sorted_indices)
+        if k == 0:
+            return False
+        if k == 1:
+            return True
+        if self.num_taxa_in_subtree(self.lca(sorted_indices[0], sorted_indices[-1])) == k:
+            return True
+        if rooted:
+            return False
+        # the complement is a clade only if it is one contiguous run of taxon
+        # ranks, i.e. the ranks of the set have a single gap
+        total = self.taxa_before[-1]
+        gaps = []
+        prev = -1
+        for i in sorted_indices:
+            r = self.taxa_before[i]
+            if r > prev + 1:
+                gaps.append((prev + 1, r - 1))
+            prev = r
+        if prev < total - 1:
+            gaps.append((prev + 1, total - 1))
+        if len(gaps) != 1:
+            return False
+        first, last = gaps[0]
+        if first == last:
+            return True
+        c = self.lca(self.taxon_nodes[first], self.taxon_nodes[last])
+        return self.num_taxa_in_subtree(c) == last - first + 1
+
+    def _shallower(self, a, b):
+        if self.depth[b] < self.depth[a]:
+            return b
+        return a
+
+    def _scan_min(self, lo, hi):
+        return min(xrange(lo, hi + 1), key=self.depth.__getitem__)
+
+    def _build_blocks(self):
+        n = len(self.depth)
+        b = self.BLOCK_SIZE
+        level = array('l', [self._scan_min(s, min(s + b, n) - 1) for s in xrange(0, n, b)])
+        self._blocks = [level]
+        num_blocks = len(level)
+        width = 1
+        while 2 * width <= num_blocks:
+            level = array('l', [self._shallower(level[i], level[i + width]) \
+                    for i in xrange(len(level) - width)])
+            self._blocks.append(level)
+            width *= 2
+
+    def _range_min(self, lo, hi):
+        b = self.BLOCK_SIZE
+        first, last = lo // b, hi // b
+        if last - first < 2:
+            return self._scan_min(lo, hi)
+        best = self._shallower(self._scan_min(lo, (first + 1) * b - 1), self._scan_min(last * b, hi))
+        first += 1
+        last -= 1
+        k = (last - first + 1).bit_length() - 1
+        level = self._blocks[k]
+        best = self._shallower(best, level[first])
+        return self._shallower(best, level[last - (1 << k) + 1])
+
+    def lca(self, a, b):
+        if a > b:
+            a, b = b, a
+        if b <= self.end[a]:
+            return a
+        if self._blocks is None:
+            self._build_blocks()
+        return self.parent[self._range_min(a + 1, b)]
+
+    def mrca(self, indices):
+        return self.lca(min(indices), max(indices))
+
+    def batch_lca(self, pairs):
+        """
+        Returns the LCA of every (a, b) pair in `pairs`, found in a single
+        postorder pass with Tarjan's offline algorithm (union-find over the
+        finished subtrees), without building the sparse table.
+        """
+        n = len(self.parent)
+        result = array('l', [-1]) * len(pairs)
+        # queries wait at both of their nodes, in linked lists of slots
+        head = array('l', [-1]) * n
+        slot_next = array('l')
+        slot_other = array('l')
+        for q, (a, b) in enumerate(pairs):
+            if a > b:
+                a, b = b, a
+            if b <= self.end[a]:
+                result[q] = a
+                slot_next.extend([-1, -1])
+                slot_other.extend([-1, -1])
+                continue
+            slot_next.append(head[a])
+            slot_other.append(b)
+            head[a] = 2 * q
+            slot_next.append(head[b])
+            slot_other.append(a)
+            head[b] = 2 * q + 1
+
+        by_postorder = array('l', [0]) * n
+        for i in xrange(n):
+            by_postorder[self.postorder[i]] = i
+        uf = array('l', xrange(n))
+        ancestor = array('l', xrange(n))
+        finished = bytearray(n)
+        def find(x):
+            root = x
+            while uf[root] != root:
+                root = uf[root]
+            while uf[x] != root:
+                uf[x], x = root, uf[x]
+            return root
+        for u in by_postorder:
+            finished[u] = 1
+            k = head[u]
+            while k != -1:
+                v = slot_other[k]
+                if finished[v]:
+                    result[k >> 1] = ancestor[find(v)]
+                k = slot_next[k]
+            p = self.parent[u]
+            if p >= 0:
+                root = find(p)
+                uf[find(u)] = root
+                ancestor[root] = p
+        return result
+
+class InducedTreeIndex(TreeIndex):
+    """
+    The index of the subtree of a larger TreeIndex (`source`) induced by
+    some of its taxon-bearing nodes. It keeps those nodes, the root, the LCA
+    of every pair of them and, below each kept node, the child that leads
+    towards each kept descendant (so the stem-based search still stops at
+    the same edge as in the full tree). `original` maps preorder numbers
+    back to `source`. Output ids, taxon counts of subtrees, the unrooted
+    monophyly test and the newick all come from `source`, so a target tree
+    over this index maps and writes annotations that only refer to the kept
+    taxa exactly as one over `source` would. Building it walks only the
+    paths between the kept nodes.
+    """
+    def __init__(self, source, nodes):
+        parent_of = source.parent
+        depth_of = source.depth
+        end_of = source.end
+        def climb_lca(a, b):
+            while depth_of[a] > depth_of[b]:
+                a = parent_of[a]
+            while depth_of[b] > depth_of[a]:
+                b = parent_of[b]
+            while a != b:
+                a = parent_of[a]
+                b = parent_of[b]
+            return a
+        def attach(order):
+            # the parent of every node in the preorder-sorted list `order`
+            up = {}
+            stack = []
+            for v in order:
+                while stack and not stack[-1] <= v <= end_of[stack[-1]]:
+                    stack.pop()
+                up[v] = stack[-1] if stack else -1
+                stack.append(v)
+            return up
+        order = sorted(set(nodes) | set([0]))
+        kept = set(order)
+        for a, b in zip(order, order[1:]):
+            kept.add(climb_lca(a, b))
+        order = sorted(kept)
+        for v, p in attach(order).items():
+            if p >= 0 and parent_of[v] != p:
+                while parent_of[v] != p:
+                    v = parent_of[v]
+                kept.add(v)
+        order = sorted(kept)
+        up = attach(order)
+
+        self.source = source
+        self.original = array('l', order)
+        induced = dict((v, i) for i, v in enumerate(order))
+        self.parent = array('l', [induced[up[v]] if up[v] >= 0 else -1 for v in order])
+        self.depth = array('l')
+        self.taxa_before = array('l')
+        self.taxon_nodes = array('l')
+        self.labels = []
+        self.label2node = {}
+        for i, v in enumerate(order):
+            self.depth.append(self.depth[self.parent[i]] + 1 if i else 0)
+            self.taxa_before.append(len(self.taxon_nodes))
+            if source.taxa_before[v + 1] > source.taxa_before[v]:
+                label = source.labels[source.taxa_before[v]]
+                self.label2node[label] = i
+                self.taxon_nodes.append(i)
+                self.labels.append(label)
+        self.taxa_before.append(len(self.taxon_nodes))
+        self._compute_end()
+        n = len(order)
+        self.postorder = array('l', [self.end[i] - self.depth[i] for i in xrange(n)])
+        self.is_rooted = source.is_rooted
+        self.rooting = getattr(source, 'rooting', None)
+        self.node_labels = None
+        if source.node_labels is not None:
+            self.node_labels = [source.node_labels[v] for v in order]
+        self.newick = source.newick
+        self.lengths = getattr(source, 'lengths', None)
+        self.nodes = _IndexedNodeList(self)
+        self._blocks = None
+
+    def num_taxa_in_subtree(self, i):
+        return self.source.num_taxa_in_subtree(self.original[i])
+
+    def is_split(self, sorted_indices, rooted=True):
+        if rooted:
+            return TreeIndex.is_split(self, sorted_indices, rooted=True)
+        # whether the other taxa form a clade depends on all taxa of the tree
+        return self.source.is_split([self.original[i] for i in sorted_indices], rooted=False)
+
+    def write_newick(self, out):
+        self.source.write_newick(out)
+
+    def save(self, filepath, key='', node_labels=None, newick=None):
+        raise ValueError('an induced tree index can not be saved')
+
+class IndexedNode(object):
+    """
+    Stands in for the dendropy node with preorder number `preorder_index`
+    of a tree that is only known through its TreeIndex (see TreeIndex.load
+    and IndexedTargetTree). `edge` gives the matching edge stand-in.
+    """
+    def __init__(self, index, preorder_index):
+        self.index = index
+        self.preorder_index = preorder_index
+    @property
+    def parent_node(self):
+        p = self.index.parent[self.preorder_index]
+        if p < 0:
+            return None
+        return IndexedNode(self.index, p)
+    @property
+    def edge(self):
+        return IndexedEdge(self)
+    def __eq__(self, other):
+        return isinstance(other, IndexedNode) and other.preorder_index == self.preorder_index
+    def __ne__(self, other):
+        return not self == other
+    def __hash__(self):
+        return hash(self.preorder_index)
+
+class IndexedEdge(object):
+    def __init__(self, head_node):
+        self.head_node = head_node
+
+_UINT64 = struct.Struct('<Q')
+
+def _label_hash(label):
+    # the builtin string hash differs in few bits for similar labels, which
+    # would cancel out in an XOR of many of them
+    if isinstance(label, unicode):
+        label = label.encode('utf-8')
+    return _UINT64.unpack_from(hashlib.md5(label).digest())[0]
+
+def _positions(text):
+    # the comma-separated check positions of a resolutions file (see TargetTree.write_resolutions)
+    return [int(j) for j in text.split(',')] if text else []
+
+def _taxa_hash(taxa, label_hashes):
+    # (number of taxa, XOR of their label hashes); `label_hashes` caches
+    # the hash of every label
+    h = 0
+    for t in taxa:
+        x = label_hashes.get(t.label)
+        if x is None:
+            x = label_hashes[t.label] = _label_hash(t.label)
+        h ^= x
+    return (len(taxa), h)
+
+class SplitDiff(object):
+    """
+    Compares the splits of two versions of a tree. Splits are restricted to
+    the taxa found in both trees and compared by TreeIndex.split_hashes; a
+    split has changed if it is found at a different number of nodes in the
+    two trees (so a node inserted above a clade, e.g. to attach a new taxon,
+    changes the split of that clade). `changed_taxa` holds the labels of
+    every taxon below a changed split of either tree. The clades that contain
+    only taxa outside of it are the same in both trees, and `new_node` maps
+    their nodes from the old tree to the new one; `same_clade` tells if such
+    a node also has no taxa that are only in one of the trees.
+    """
+    def __init__(self, old_index, new_index):
+        self.common = set(old_index.labels) & set(new_index.labels)
+        # every label is hashed once, for both trees
+        self.label_hashes = dict((l, _label_hash(l)) for l in self.common)
+        for index in [old_index, new_index]:
+            hashes = index.split_hashes(taxon_hashes=array('L', [self.label_hashes.get(l, 0) for l in index.labels]))
+            if index is old_index:
+                self.old_hashes = hashes
+            else:
+                self.new_hashes = hashes
+        self._old_parent = old_index.parent
+        self._new_end = new_index.end
+        self._old_counts = {}
+        for h in self.old_hashes:
+            self._old_counts[h] = self._old_counts.get(h, 0) + 1
+        self._new_counts = {}
+        self._new_first = {}
+        for i, h in enumerate(self.new_hashes):
+            self._new_counts[h] = self._new_counts.get(h, 0) + 1
+            if h not in self._new_first:
+                self._new_first[h] = i
+        old_changed = [i for i, h in enumerate(self.old_hashes) if self._new_counts.get(h) != self._old_counts[h]]
+        new_changed = [i for i, h in enumerate(self.new_hashes) if self._old_counts.get(h) != self._new_counts[h]]
+        self.changed_taxa = old_index.taxa_below(old_changed) | new_index.taxa_below(new_changed)
+        self.same_taxa = len(self.common) == len(old_index.labels) == len(new_index.labels)
+        self._old_index = old_index
+        self._new_index = new_index
+        self._common_before = array('l', [0])
+        for l in old_index.labels:
+            self._common_before.append(self._common_before[-1] + (l in self.common))
+
+    def new_node(self, i):
+        # preorder number in the new tree of old node `i`, or -1 if its split changed
+        h = self.old_hashes[i]
+        if h == 0 or self._new_counts.get(h) != self._old_counts[h]:
+            return -1
+        j = self._new_first[h]
+        # nodes that share a split are nested; keep the position among them
+        p = self._old_parent[i]
+        while p >= 0 and self.old_hashes[p] == h:
+            c = j + 1
+            while self.new_hashes[c] != h:
+                c = self._new_end[c] + 1
+            j = c
+            p = self._old_parent[p]
+        return j
+
+    def common_taxa_below(self, i):
+        # the number of taxa of both trees in the subtree of old node `i`
+        old = self._old_index
+        return self._common_before[old.taxa_before[old.end[i] + 1]] - self._common_before[old.taxa_before[i]]
+
+    def same_clade(self, i):
+        # whether old node `i` has the same taxa as its node in the new tree
+        j = self.new_node(i)
+        if j < 0:
+            return False
+        n = self._old_index.num_taxa_in_subtree(i)
+        return n == self._new_index.num_taxa_in_subtree(j) == self.common_taxa_below(i)
+
+class SplitTable(object):
+    """
+    Constant-time lookup of the splits of a tree by their hash (see
+    TreeIndex.split_hashes): a set of taxa is hashed as the XOR of its
+    taxon hashes and looked up in a dict of one int per node, instead of
+    a dict keyed by bitmasks of one bit per taxon. In an unrooted tree a
+    set and its complement are the same split, so the key is the smaller of
+    the hash and the hash of the complement (the XOR with the hash of all
+    taxa). A found node is compared with the set by its preorder range and
+    taxon count, so hash collisions can not give a wrong answer; nodes
+    whose taxon sets collide are all kept and tried in turn.
+    """
+    def __init__(self, index, rooted=True):
+        self.index = index
+        self.rooted = rooted
+        self.taxon_hashes = index.taxon_hashes()
+        hashes = index.split_hashes(taxon_hashes=self.taxon_hashes)
+        self._all = hashes[0]
+        self._nodes = {}
+        self._collisions = {}
+        for i, h in enumerate(hashes):
+            key = self._key(h)
+            j = self._nodes.setdefault(key, i)
+            if j != i and not self._same_taxa(j, i):
+                self._collisions.setdefault(key, [j]).append(i)
+
+    def _key(self, h):
+        if self.rooted:
+            return h
+        return min(h, h ^ self._all)
+
+    def _same_taxa(self, a, b):
+        # a is an ancestor of b (preorder) with the same taxa, e.g. in a unary chain
+        index = self.index
+        return index.is_ancestor(a, b) and index.num_taxa_in_subtree(a) == index.num_taxa_in_subtree(b)
+
+    def is_split(self, sorted_indices):
+        # same answers as TreeIndex.is_split, for sorted taxon-bearing preorder numbers
+        k = len(sorted_indices)
+        if k == 0:
+            return False
+        if k == 1:
+            return True
+        taxa_before = self.index.taxa_before
+        h = 0
+        for i in sorted_indices:
+            h ^= self.taxon_hashes[taxa_before[i]]
+        key = self._key(h)
+        j = self._nodes.get(key)
+        if j is None:
+            return False
+        for c in self._collisions.get(key, [j]):
+            if self._matches(c, sorted_indices):
+                return True
+        return False
+
+    def _matches(self, c, sorted_indices):
+        index = self.index
+        count = index.num_taxa_in_subtree(c)
+        k = len(sorted_indices)
+        if count == k and c <= sorted_indices[0] and sorted_indices[-1] <= index.end[c]:
+            return True
+        # the set is the complement of the clade
+        return not self.rooted and count == index.taxa_before[-1] - k and \
+                not index.subtree_overlaps(c, sorted_indices)
+
+class _NodeOutIds(object):
+    # output ids of the nodes of a TreeIndex built by from_newick: the taxon
+    # label, or AUTOGENID<k> for the k-th node without one in postorder (the
+    # order in which TargetTree.get_node_out_id hands them out while writing)
+    def __init__(self, index):
+        n = len(index.parent)
+        by_postorder = array('l', [0]) * n
+        for i in xrange(n):
+            by_postorder[index.postorder[i]] = i
+        self._autogen = array('l', [-1]) * n
+        taxa_before = index.taxa_before
+        k = 0
+        for i in by_postorder:
+            if taxa_before[i + 1] == taxa_before[i]:
+                self._autogen[i] = k
+                k += 1
+        self._index = index
+    def __len__(self):
+        return len(self._autogen)
+    def __getitem__(self, i):
+        k = self._autogen[i]
+        if k < 0:
+            return self._index.labels[self._index.taxa_before[i]]
+        return 'AUTOGENID' + str(k)
+
+class _IndexedNodeList(object):
+    # the `nodes` of a loaded TreeIndex
+    def __init__(self, index):
+        self._index = index
+    def __len__(self):
+        return len(self._index.parent)
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('node index out of range')
+        return IndexedNode(self._index, i)
+
+class SplitEncoding(object):
+    # BITMASK stores a split bitmask (a long with one bit per taxon) on every
+    # edge; INTERVAL relies on the preorder ranges of the TreeIndex instead;
+    # HASH is INTERVAL with monophyly looked up in a SplitTable
+    BITMASK, INTERVAL, HASH = range(3)
+
+class CheckEngine(object):
+    """
+    Evaluates the error and warning checks of a batch of placements on a
+    TargetTree that uses the INTERVAL or HASH split encoding, with NumPy arrays over
+    the preorder numbers of the tree instead of one `passes` call per check.
+    Error checks are evaluated one position at a time for the placements
+    that have not failed yet, so a placement is not checked further after
+    its first failed error check (as in TargetTree.check_target).
+    TargetExcludesCondition becomes a comparison of all excluded nodes
+    against the subtree range of their target; MonophylyCondition does not
+    depend on the target, so each distinct clade list is decided once (with
+    its MRCAs from one batch_lca pass) and the answer reused.
+    """
+    def __init__(self, tree):
+        self.tree = tree
+        self._end = numpy.array(tree.index.end, dtype=numpy.int64)
+        self._taxon_counts = numpy.array(tree.index.subtree_taxon_counts(), dtype=numpy.int64)
+        self._tips = {}
+        self._monophyletic = {}
+
+    def _clade_tips(self, specifier):
+        # sorted preorder numbers of the nodes with taxa of the clade
+        tips = self._tips.get(specifier)
+        if tips is None:
+            tree = self.tree
+            tips = tree.get_taxon_set(tree.get_taxa_in_tree(specifier)[0])
+            self._tips[specifier] = tips
+        return tips
+
+    def run(self, placements):
+        # placements holds (annotation, outcome) pairs of successfully placed targets
+        targets = [getattr(r.attached_to, 'head_node', r.attached_to).preorder_index for a, r in placements]
+        alive = [True] * len(placements)
+        j = 0
+        while True:
+            pending = [(i, a.target.error_checks[j]) for i, (a, r) in enumerate(placements) \
+                    if alive[i] and len(a.target.error_checks) > j]
+            if not pending:
+                break
+            for (i, check), failed in zip(pending, self.evaluate(pending, targets)):
+                if failed:
+                    placements[i][1].add_failed_error_check(check)
+                    alive[i] = False
+            j += 1
+        pending = [(i, check) for i, (a, r) in enumerate(placements) if alive[i] \
+                for check in a.target.warning_checks]
+        for (i, check), failed in zip(pending, self.evaluate(pending, targets)):
+            if failed:
+                placements[i][1].add_failed_warning_check(check)
+
+    def evaluate(self, pending, targets):
+        # returns a bool array, True where the check of the (placement, check) pair fails
+        failed = numpy.zeros(len(pending), dtype=bool)
+        excludes = []
+        monophyly = []
+        for k, (i, check) in enumerate(pending):
+            if isinstance(check, TargetExcludesCondition):
+                excludes.append(k)
+            elif isinstance(check, MonophylyCondition):
+                monophyly.append(k)
+            else:
+                failed[k] = not check.passes(self.tree, self.tree.index.nodes[targets[i]])
+        if excludes:
+            failed[excludes] = self._target_excludes_fails([pending[k] for k in excludes], targets)
+        if monophyly:
+            failed[monophyly] = self._monophyly_fails([pending[k][1] for k in monophyly])
+        return failed
+
+    def _target_excludes_fails(self, pending, targets):
+        tips = []
+        starts = []
+        owner = []
+        for k, (i, check) in enumerate(pending):
+            for c in check.clade_list:
+                t = self._clade_tips(c)
+                tips.extend(t)
+                starts.extend([targets[i]] * len(t))
+                owner.extend([k] * len(t))
+        if not tips:
+            return numpy.zeros(len(pending), dtype=bool)
+        tips = numpy.array(tips, dtype=numpy.int64)
+        starts = numpy.array(starts, dtype=numpy.int64)
+        owner = numpy.array(owner, dtype=numpy.int64)
+        inside = (tips >= starts) & (tips <= self._end[starts])
+        failed = numpy.bincount(owner[inside], minlength=len(pending)) > 0
+
+        # report the first offending clade the way TargetExcludesCondition.passes does
+        end = self.tree.index.end
+        for k in numpy.flatnonzero(failed):
+            i, check = pending[k]
+            t = targets[i]
+            for c in check.clade_list:
+                if any(t <= x <= end[t] for x in self._clade_tips(c)):
+                    check.failed = c
+                    break
+        return failed
+
+    def _monophyly_fails(self, checks):
+        keys = [tuple(check.clade_list) for check in checks]
+        new = [k for k in set(keys) if k not in self._monophyletic]
+        if new:
+            sets = []
+            for k in new:
+                taxon_set = set()
+                for c in k:
+                    taxon_set.update(self._clade_tips(c))
+                sets.append(sorted(taxon_set))
+            if self.tree._split_encoding == SplitEncoding.HASH:
+                # looked up in the split table, without a pass over the tree
+                ok = [self.tree.is_split(x) for x in sets]
+            else:
+                ok = self._monophyletic_by_lca(sets)
+            for k, v in zip(new, ok):
+                self._monophyletic[k] = bool(v)
+        return numpy.array([not self._monophyletic[k] for k in keys], dtype=bool)
+
+    def _monophyletic_by_lca(self, sets):
+        sizes = numpy.array([len(x) for x in sets], dtype=numpy.int64)
+        multi = numpy.flatnonzero(sizes > 1)
+        ok = sizes == 1
+        if len(multi):
+            lcas = numpy.array(self.tree.index.batch_lca([(sets[m][0], sets[m][-1]) for m in multi]), \
+                    dtype=numpy.int64)
+            ok[multi] = self._taxon_counts[lcas] == sizes[multi]
+        if not self.tree.tree.is_rooted:
+            # the complement may still be a clade
+            for m in multi[~ok[multi]]:
+                ok[m] = self.tree.index.is_split(sets[m], rooted=False)
+        return ok
+
 class TargetTree(object):
 
     tree = None
     _unnamed_node_count = 0
+    _split_table = None
 
-    unadded_annotations = []
     _num_tried = 0
     _num_added = 0
+    _num_carried = 0
+    _num_cached = 0
 
     _name_converter = None
+    _num_resolution_hits = 0
+    _num_resolution_misses = 0
     
     @property
     def number_annotations_tried(self):
@@ -76,16 +1157,37 @@ class TargetTree(object):
     @property
     def number_annotations_added(self):
         return self._num_added
+    @property
+    def number_annotations_carried_forward(self):
+        return self._num_carried
+    @property
+    def number_annotations_from_cache(self):
+        return self._num_cached
+    @property
+    def number_resolution_hits(self):
+        return self._num_resolution_hits
+    @property
+    def number_resolution_misses(self):
+        return self._num_resolution_misses
     
-    def __init__(self, tree, use_taxonomy=True):
+    def __init__(self, tree, use_taxonomy=True, split_encoding=SplitEncoding.BITMASK, name_converter=None):
         self.tree = tree
+        self.unadded_annotations = AnnotationRefs(key=_pair_annotation_id)
+        self._placements = {}
         self.preorder_node_iter = self.tree.preorder_node_iter
         self.print_plot = self.tree.print_plot
         self.write = self.tree.write
         self._use_taxonomy = use_taxonomy
+        self._split_encoding = split_encoding
+        self._resolved = {}
+        self._ott_id_index = None
+        self._taxonomy_position_index = None
+        self._check_engine = None
 
         if use_taxonomy:
-            self._name_converter = OTTNameConverter()
+            if name_converter is None:
+                name_converter = OTTNameConverter()
+            self._name_converter = name_converter
             # check if all taxa have numeric names (assumed to be ott ids)
             all_numeric_taxa = True
             for taxon in self.tree.taxon_namespace:
@@ -105,114 +1207,163 @@ class TargetTree(object):
                         taxon.label = ott_id
 
         #tree.print_plot(show_internal_node_ids=True)
-        self.mod_encode_splits(tree, delete_outdegree_one=False, internal_node_taxa=True)
+        if split_encoding == SplitEncoding.BITMASK:
+            self.mod_encode_splits(tree, delete_outdegree_one=False, internal_node_taxa=True)
         self.tree.label2index = {}
         self.tree.label2bit = {}
         curr_bit = 1
         for n, taxon in enumerate(tree.taxon_namespace):
             assert taxon.label not in tree.label2index
             self.tree.label2index[taxon.label] = n
-            self.tree.label2bit[taxon.label] = curr_bit
-            curr_bit <<= 1
+            if split_encoding == SplitEncoding.BITMASK:
+                self.tree.label2bit[taxon.label] = curr_bit
+                curr_bit <<= 1
         #print tree.label2index
         #print tree.label2bit
         for node in tree.preorder_node_iter():
-            node.phylo_ref = []
+            node.phylo_ref = AnnotationRefs()
             if node.edge:
-                node.edge.phylo_ref = []
+                node.edge.phylo_ref = AnnotationRefs()
             #print node.edge.split_bitmask
             #if node.taxon:
             #   print node.taxon.label
-            
+        self.index = TreeIndex(tree)
+
+    def resolve_specifier(self, specifier):
+        """
+        Returns the taxa of the tree that the specifier (an ott id or a taxon
+        label) stands for, and a list holding the specifier if none of its
+        taxa are in the tree.
+        Every specifier is expanded and looked up once per tree; later calls
+        for the same specifier (as an included or excluded id, or in an error
+        or warning check) reuse the stored result.
+        """
+        if not isinstance(specifier, basestring):
+            specifier = str(specifier)
+        r = self._resolved.get(specifier)
+        if r is not None:
+            self._num_resolution_hits += 1
+            return r
+        self._num_resolution_misses += 1
+        if self._use_taxonomy:
+            found = self._name_converter.expand_clade_using_ott(specifier).taxa_in_tree(self)
+        else:
+            ind = self.tree.label2index.get(specifier)
+            found = [] if ind is None else [self.tree.taxon_namespace[ind]]
+        r = (found, [] if found else [specifier])
+        self._resolved[specifier] = r
+        return r
+
+    def get_ott_id_index(self):
+        # the tree's ott ids in ascending order, and the matching taxa
+        if self._ott_id_index is None:
+            pairs = sorted((int(t.label), t) for t in self.tree.taxon_namespace)
+            self._ott_id_index = (array('i', [p[0] for p in pairs]), [p[1] for p in pairs])
+        return self._ott_id_index
+
+    def get_taxonomy_position_index(self, taxonomy):
+        # preorder numbers in the local taxonomy of the tree's taxa (ascending)
+        # and the matching taxa; taxa unknown to the taxonomy are left out
+        if self._taxonomy_position_index is None or self._taxonomy_position_index[0] is not taxonomy:
+            pairs = []
+            for t in self.tree.taxon_namespace:
+                p = taxonomy.position(t.label)
+                if p is not None:
+                    pairs.append((p, t))
+            pairs.sort()
+            self._taxonomy_position_index = (taxonomy, array('i', [p[0] for p in pairs]), [p[1] for p in pairs])
+        return self._taxonomy_position_index[1:]
+
     def get_taxa_in_tree(self, ids, bits=False):
-        if isinstance(ids,str):
+        if isinstance(ids, basestring):
             ids = [ids,]
-        if self._use_taxonomy:
-            ids = self._expand_ids(ids)
         found = []
         not_found = []
         for i in ids:
-#            debug("searching for {} in tree".format(i))
-            ind = self.tree.label2index.get(i)
-            if ind is not None:
-                if bits:
-                    found.append(self.tree.label2bit[i])
-                else:
-                    found.append(self.tree.taxon_namespace[ind])
-            else:
-                not_found.append(i)
+            f, nf = self.resolve_specifier(i)
+            found.extend(f)
+            not_found.extend(nf)
+        if bits:
+            found = [self.tree.label2bit[t.label] for t in found]
         return found, not_found
 
     def get_bits_in_tree(self, ids):
-        if isinstance(ids,str):
-            ids = [ids,]
-        if self._use_taxonomy:
-            ids = self._expand_ids(ids)
-        found, not_found = self.get_taxa_in_tree(ids)
-        return [self.tree.label2bit[i.label] for i in found], not_found
+        return self.get_taxa_in_tree(ids, bits=True)
 
     def get_mrca(self, taxa):
-        mrca = None
-        if len(taxa) == 1:
-            mrca = self.tree.find_node_with_taxon_label(taxa[0].label)
-        else:
-            mrca = self.tree.mrca(taxa=taxa)
-        return mrca
+        label2node = self.index.label2node
+        return self.index.nodes[self.index.mrca([label2node[t.label] for t in taxa])]
 
-    def _expand_ids(self, ids):
-        e = []
-        for i in ids:
-            e.extend(self._name_converter.expand_clade_using_ott(i))
-        return e
-            
-    def find_node_based_target(self, annotation):
+    def find_node_based_target(self, annotation, mrca=None):
 
         # get included nodes. if none in tree, fail
         included, dropped_inc = self.get_taxa_in_tree(annotation.target.ids_to_include)
         if len(included) < 1:
             return MappingOutcome(None, Reason.NO_INC_DESIGNATORS_IN_TREE, dropped_inc, None)
 
-        mrca = self.get_mrca(included)
+        if mrca is None:
+            mrca = self.get_mrca(included)
         assert mrca != None
 
         return MappingOutcome(mrca, Reason.SUCCESS, dropped_inc, None)
 
-    def find_stem_based_target(self, annotation):
+    def find_stem_based_target(self, annotation, mrca=None):
 
         # get included nodes. if none in tree, fail
         included, dropped_inc = self.get_taxa_in_tree(annotation.target.ids_to_include)
         if len(included) < 1:
             return MappingOutcome(None, Reason.NO_INC_DESIGNATORS_IN_TREE, dropped_inc, None)
 
-        # get excluded bits. if none in tree, return root
-        excluded, dropped_exc = self.get_bits_in_tree(annotation.target.ids_to_exclude)
+        # get excluded nodes. if none in tree, return root
+        excluded, dropped_exc = self.get_taxa_in_tree(annotation.target.ids_to_exclude)
         if len(excluded) < 1:
             return MappingOutcome(self.tree.seed_node, Reason.SUCCESS, dropped_inc, dropped_exc)
 
-        # tally the excluded tips in bitset
-        exc_bit_set = 0
-        for e in excluded:
-            exc_bit_set |= e
-
-        # fail if the intersection of excluded bitset and mrca is not empty
-        if (mrca.edge.split_bitmask & exc_bit_set) != 0:
-            return MappingOutcome(None, Reason.MRCA_HAS_EXCLUDED, dropped_inc, dropped_exc)
+        # tally the excluded tips in the encoding of the tree
+        exc_set = self.get_taxon_set(excluded)
 
         # get the mrca of the included nodes
-        mrca = self.get_mrca(included)
+        if mrca is None:
+            mrca = self.get_mrca(included)
         assert mrca is not None
 
+        # fail if the mrca contains any excluded tip
+        if self.clade_overlaps(mrca, exc_set):
+            return MappingOutcome(None, Reason.MRCA_HAS_EXCLUDED, dropped_inc, dropped_exc)
+
         # find the deepest valid mrca that doesn't include any excluded nodes
         deepest_valid = mrca
         curr = mrca.parent_node
-        while (curr is not None) and ((curr.edge.split_bitmask & exc_bit_set) == 0):
-            #print 'no intersection of', curr.edge.split_bitmask, exc_bit_set
+        while (curr is not None) and not self.clade_overlaps(curr, exc_set):
             deepest_valid = curr
             curr = curr.parent_node
-        #if curr:
-        #    print 'intersection of', curr.edge.split_bitmask, exc_bit_set
         return MappingOutcome(deepest_valid.edge, Reason.SUCCESS, dropped_inc, dropped_exc)
 
+    def get_taxon_set(self, taxa):
+        # a set of taxa in the split encoding of the tree: a bitmask, or the
+        # sorted preorder numbers of the nodes that bear the taxa
+        if self._split_encoding == SplitEncoding.BITMASK:
+            bits = 0
+            for t in taxa:
+                bits |= self.tree.label2bit[t.label]
+            return bits
+        label2node = self.index.label2node
+        return sorted(set([label2node[t.label] for t in taxa]))
+
+    def clade_overlaps(self, node, taxon_set):
+        if self._split_encoding == SplitEncoding.BITMASK:
+            return (node.edge.split_bitmask & taxon_set) != 0
+        return self.index.subtree_overlaps(node.preorder_index, taxon_set)
+
+    def is_split(self, taxon_set):
+        if self._split_encoding == SplitEncoding.BITMASK:
+            return (taxon_set != 0) and (taxon_set in self.split_edges)
+        if self._split_encoding == SplitEncoding.HASH:
+            if self._split_table is None:
+                self._split_table = SplitTable(self.index, rooted=self.tree.is_rooted)
+            return self._split_table.is_split(taxon_set)
+        return self.index.is_split(taxon_set, rooted=self.tree.is_rooted)
+
     def mod_encode_splits(self, create_dict=True, delete_outdegree_one=True, internal_node_taxa=False):
         """
         Processes splits on a tree, encoding them as bitmask on each edge.
@@ -307,7 +1458,11 @@ class TargetTree(object):
         # all the taxa, but only those found on the tree
         if not self.tree.is_rooted:
             mask = self.tree.seed_node.edge.split_bitmask
-            d = container.NormalizedBitmaskDict(mask=mask)
+            try:
+                d = container.NormalizedBitmaskDict(mask=mask)
+            except TypeError:
+                # later DendroPy4 releases renamed the argument
+                d = container.NormalizedBitmaskDict(fill_bitmask=mask)
             for k, v in self.split_edges.items():
                 d[k] = v
             self.split_edges = d
@@ -317,22 +1472,338 @@ class TargetTree(object):
             return CheckOutcome(True, check)
         return CheckOutcome(False, check)
 
-    def add_phyloreferenced_annotation(self, annotation):
-        self._num_tried += 1
-        
-        # find the target
-        if annotation.target.type == TargetType.BRANCH:
-            r = self.find_stem_based_target(annotation)
-        else:
-            assert annotation.target.type == TargetType.NODE
-            r = self.find_node_based_target(annotation)
+    def add_phyloreferenced_annotations(self, annotations):
+        """
+        Bulk version of add_phyloreferenced_annotation. The include sets of
+        all annotations are resolved first, then every MRCA is found in a
+        single postorder pass over the tree (TreeIndex.batch_lca). With the
+        INTERVAL encoding (and NumPy available) the checks of all placed
+        targets are then evaluated together by a CheckEngine. Annotations
+        with identical targets (see ReferenceTarget.key) are mapped once.
+        Returns the outcomes in the order of `annotations`.
+        """
+        outcomes = self._map_distinct_targets(annotations)
+        for a, r in zip(annotations, outcomes):
+            self._record(a, r)
+        return outcomes
 
-        # if no target was found, fail
-        if r.reason_code != Reason.SUCCESS:
-            self.unadded_annotations.append((annotation, r))
-            debug(self.unadded_annotations)
+    def _map_distinct_targets(self, annotations):
+        # the outcomes of _find_targets and _check_targets, computed once for
+        # every distinct target and copied to the annotations that share it
+        first = {}
+        distinct = []
+        group = []
+        for a in annotations:
+            k = a.target.key()
+            j = first.get(k)
+            if j is None:
+                j = first[k] = len(distinct)
+                distinct.append(a)
+            group.append(j)
+        outcomes = self._find_targets(distinct)
+        self._check_targets(distinct, outcomes)
+        self._num_tried += len(annotations) - len(distinct)
+        return [self._copy_outcome(distinct[j], outcomes[j], a) for a, j in zip(annotations, group)]
+
+    @staticmethod
+    def _copy_outcome(source, r, annotation):
+        # the outcome `r` of `source` for an annotation with an identical
+        # target, whose failed checks are its own (at the same positions)
+        if annotation is source:
             return r
+        c = MappingOutcome(r.attached_to, r.reason_code, r.missing_inc, r.missing_exc)
+        if r.failed_error_checks:
+            c.failed_error_checks = tuple([annotation.target.error_checks[j] for j, x in \
+                    enumerate(source.target.error_checks) if x in r.failed_error_checks])
+        if r.failed_warning_checks:
+            c.failed_warning_checks = tuple([annotation.target.warning_checks[j] for j, x in \
+                    enumerate(source.target.warning_checks) if x in r.failed_warning_checks])
+        return c
+
+    def _find_targets(self, annotations):
+        label2node = self.index.label2node
+        pairs = []
+        for a in annotations:
+            included = self.get_taxa_in_tree(a.target.ids_to_include)[0]
+            if included:
+                indices = [label2node[t.label] for t in included]
+                pairs.append((min(indices), max(indices)))
+            else:
+                pairs.append((-1, -1))
+        mrcas = self.index.batch_lca([p for p in pairs if p[0] >= 0])
+        outcomes = []
+        j = 0
+        for a, p in zip(annotations, pairs):
+            mrca = None
+            if p[0] >= 0:
+                mrca = self.index.nodes[mrcas[j]]
+                j += 1
+            self._num_tried += 1
+            outcomes.append(self.find_target(a, mrca))
+        return outcomes
+
+    def _check_and_record(self, annotations, outcomes):
+        self._check_targets(annotations, outcomes)
+        for a, r in zip(annotations, outcomes):
+            self._record(a, r)
+
+    def _check_targets(self, annotations, outcomes):
+        placed = [(a, r) for a, r in zip(annotations, outcomes) if r.reason_code == Reason.SUCCESS]
+        if numpy is not None and self._split_encoding != SplitEncoding.BITMASK:
+            if self._check_engine is None:
+                self._check_engine = CheckEngine(self)
+            self._check_engine.run(placed)
+        else:
+            for a, r in placed:
+                self.check_target(a, r)
+
+    def add_phyloreferenced_annotations_cached(self, annotations, cache, tree_key=None, prefetch_workers=0):
+        """
+        Same as add_phyloreferenced_annotations, but the outcome of every
+        target is first looked up in `cache` (a PlacementCache) under
+        `tree_key` (by default the content hash of the tree index, which is
+        worth computing once per tree); only the annotations whose targets
+        are not cached are mapped (after prefetching their expansions with
+        `prefetch_workers`, see OTTNameConverter.prefetch), and their
+        outcomes are stored.
+        """
+        if tree_key is None:
+            tree_key = self.index.content_hash()
+        keys = [PlacementCache.target_key(a.target, self._use_taxonomy) for a in annotations]
+        cached = cache.get_many(tree_key, keys)
+        missing = [j for j, k in enumerate(keys) if k not in cached]
+        missing_annotations = [annotations[j] for j in missing]
+        if missing_annotations and prefetch_workers > 0 and self._name_converter is not None:
+            self._name_converter.prefetch(collect_specifiers(missing_annotations), max_workers=prefetch_workers)
+        mapped = self._map_distinct_targets(missing_annotations)
+        cache.put_many(tree_key, [(keys[j], _pack_outcome(annotations[j], r)) for j, r in zip(missing, mapped)])
+
+        outcomes = []
+        mapped = iter(mapped)
+        for a, k in zip(annotations, keys):
+            if k in cached:
+                r = self._unpack_outcome(a, cached[k])
+                self._num_tried += 1
+                self._num_cached += 1
+            else:
+                r = next(mapped)
+            self._record(a, r)
+            outcomes.append(r)
+        return outcomes
+
+    def remap_from_previous(self, annotations, previous, previous_table, previous_resolutions,
+            table_name='the previous table'):
+        """
+        Maps the annotations onto this tree, a new version of the tree of
+        `previous` (a target tree of the old version), reusing the placements
+        that `previous` wrote to `previous_table` (the lines of a table in the
+        format of write_table, without a tree column, or its rows as given by
+        read_table) and the resolutions it wrote next to it with
+        write_resolutions (`previous_resolutions`, the lines of that file).
+        An annotation whose specifiers resolve to the same taxa in both trees
+        (as recorded, they are not resolved against `previous` again), none
+        of them below a changed split (see SplitDiff), is carried forward:
+        its old target (also recorded for a failed error check) is moved to
+        the node with the same split, or its old failure is kept if no
+        target was found. The checks of a carried target are only evaluated
+        again if the clades they depend on may differ between the trees;
+        otherwise their old outcome is kept.
+        All other annotations are mapped as by add_phyloreferenced_annotations.
+        Returns the outcomes in the order of `annotations`; errors in the
+        table name it as `table_name`.
+        """
+        rows = {}
+        repeated = set()
+        reason_codes = dict((t, c) for c, t in enumerate(_REASON_TEXT))
+        for n, row in enumerate(previous_table, 1):
+            if isinstance(row, basestring):
+                row = row.rstrip('\r\n').split('\t')
+            if len(row) != 4:
+                raise ValueError('{} (--previous-table) must be the table of a single tree, without a tree ' \
+                        'column'.format(table_name))
+            kind, target_id, annotation_id, reason = row
+            if kind == 'type':
+                continue
+            if reason not in reason_codes:
+                raise ValueError('row {n} of {t} (--previous-table), "{r}", has the unknown reason "{x}"'.format( \
+                        n=n, t=table_name, r='\t'.join(row), x=reason))
+            if annotation_id in rows:
+                repeated.add(annotation_id)
+            rows[annotation_id] = (kind, target_id, reason_codes[reason])
+        old_taxa = {}
+        old_checks = {}
+        for line in previous_resolutions:
+            f = line.rstrip('\r\n').split('\t')
+            if f[0] == 'specifier':
+                old_taxa[f[1]] = (int(f[2]), int(f[3]))
+            else:
+                old_checks[f[1]] = (f[2], f[3], _positions(f[4]), _positions(f[5]))
+        old_ids = dict((l, i) for i, l in enumerate(previous.node_out_ids()))
+        diff = SplitDiff(previous.index, self.index)
+
+        # whether each specifier stands for the same taxa as recorded, none
+        # of them below a changed split, and its specifiers not in the tree
+        label_hashes = diff.label_hashes
+        changed_taxa = diff.changed_taxa
+        specifiers = {}
+        def specifier_info(s):
+            taxa, not_found = self.resolve_specifier(s)
+            key = s if isinstance(s, basestring) else str(s)
+            x = specifiers[s] = (_taxa_hash(taxa, label_hashes) == old_taxa.get(key) and \
+                    not any(t.label in changed_taxa for t in taxa), not_found)
+            return x
+
+        outcomes = []
+        carried = []
+        no_checks = ('NA', 'NA', (), ())
+        for a in annotations:
+            r = None
+            annotation_id = str(a.id)
+            row = rows.get(annotation_id)
+            dropped = None
+            if row is not None and annotation_id not in repeated:
+                dropped = self._carried_specifiers(a.target, specifiers, specifier_info)
+            if dropped is not None:
+                kind, target_id, reason_code = row
+                checks = old_checks.get(annotation_id, no_checks)
+                if reason_code == Reason.ERROR_CHECK_FAILED and checks[0] != 'NA':
+                    kind, target_id = checks[:2]
+                    reason_code = Reason.SUCCESS
+                dropped_inc, dropped_exc = dropped
+                if a.target.type != TargetType.BRANCH or reason_code == Reason.NO_INC_DESIGNATORS_IN_TREE:
+                    dropped_exc = None
+                if kind == 'NA':
+                    if reason_code != Reason.ERROR_CHECK_FAILED:
+                        r = MappingOutcome(None, reason_code, dropped_inc, dropped_exc)
+                else:
+                    if target_id not in old_ids:
+                        raise ValueError('target "{}" of the previous table is not in the previous tree'.format(target_id))
+                    i = diff.new_node(old_ids[target_id])
+                    if i >= 0:
+                        node = self.index.nodes[i]
+                        r = MappingOutcome(node.edge if kind == 'edge' else node, Reason.SUCCESS, dropped_inc, \
+                                dropped_exc)
+                        carried.append((a, r, checks))
+            if r is not None:
+                self._num_tried += 1
+                self._num_carried += 1
+            outcomes.append(r)
+
+        remapped = [j for j, r in enumerate(outcomes) if r is None]
+        remapped_annotations = [annotations[j] for j in remapped]
+        remapped_outcomes = self._find_targets(remapped_annotations)
+        for j, r in zip(remapped, remapped_outcomes):
+            outcomes[j] = r
+        self._check_targets(remapped_annotations, remapped_outcomes)
+        for a, r, checks in carried:
+            self._recheck_carried(a, r, previous, diff, checks[2], checks[3])
+        for a, r in zip(annotations, outcomes):
+            self._record(a, r)
+        return outcomes
+
+    @staticmethod
+    def _carried_specifiers(target, specifiers, specifier_info):
+        # the included and excluded specifiers of the target that are not in
+        # the tree, or None if any of its specifiers (or those of its checks)
+        # is not stable (see remap_from_previous)
+        dropped = ([], [])
+        for ids, not_found in [(target.ids_to_include, dropped[0]), (target.ids_to_exclude, dropped[1])]:
+            for s in ids:
+                x = specifiers.get(s) or specifier_info(s)
+                if not x[0]:
+                    return None
+                not_found.extend(x[1])
+        for check in target.error_checks + target.warning_checks:
+            for s in check.clade_list:
+                if not (specifiers.get(s) or specifier_info(s))[0]:
+                    return None
+        return dropped
+
+    def _recheck_carried(self, annotation, r, previous, diff, failed_errors, failed_warnings):
+        # evaluates the checks of a target carried forward, which failed the
+        # error and warning checks at the positions in `failed_errors` and
+        # `failed_warnings` on `previous` (where checks after a failed error
+        # check were not evaluated); a check that can not have changed keeps
+        # its outcome
+        first_failed = failed_errors[0] if failed_errors else None
+        for j, check in enumerate(annotation.target.error_checks):
+            if (first_failed is None or j <= first_failed) and self._check_unchanged(check, previous, diff):
+                passed = j != first_failed
+            else:
+                passed = self.perform_check(r.attached_to, check).passed
+            if not passed:
+                r.add_failed_error_check(check)
+                return r
+        for j, check in enumerate(annotation.target.warning_checks):
+            if first_failed is None and self._check_unchanged(check, previous, diff):
+                passed = j not in failed_warnings
+            else:
+                passed = self.perform_check(r.attached_to, check).passed
+            if not passed:
+                r.add_failed_warning_check(check)
+        return r
+
+    def _check_unchanged(self, check, previous, diff):
+        # whether a check of a carried placement (whose specifiers are all
+        # stable, so its clade is made of taxa of both trees) has the same
+        # outcome in both trees. TARGET_EXCLUDES only looks at the taxa of
+        # both trees under the target, which are the same. A clade is
+        # monophyletic if its mrca has no other taxa: that is unchanged if
+        # the mrca has the same taxa in both trees, or if it already had
+        # other taxa of both trees (in an unrooted tree the complement of
+        # the clade counts too, so the trees must have the same taxa)
+        if isinstance(check, TargetExcludesCondition):
+            return True
+        if not self.index.is_rooted and not diff.same_taxa:
+            return False
+        label2node = previous.index.label2node
+        nodes = set()
+        for c in check.clade_list:
+            for t in self.resolve_specifier(c)[0]:
+                nodes.add(label2node[t.label])
+        if not nodes:
+            return True
+        i = previous.index.mrca(list(nodes))
+        return diff.common_taxa_below(i) > len(nodes) or diff.same_clade(i)
 
+    def write_resolutions(self, out):
+        """
+        Writes what remap_from_previous needs besides the table to carry the
+        placements of this tree forward to its next version, as tab-separated
+        lines: `specifier`, a resolved specifier and the number and hash of
+        its taxa; and `annotation`, the id of an annotation whose target
+        failed checks, the type and id of the target (which the table leaves
+        out when an error check failed, NA otherwise) and the positions of
+        the failed error and warning checks (comma-separated).
+        """
+        label_hashes = {}
+        for s, r in self._resolved.iteritems():
+            out.write('specifier\t{s}\t{n}\t{h}\n'.format(s=s, n=len(r[0]), h=_taxa_hash(r[0], label_hashes)[1]))
+        ids = None
+        for placed in self._placements.itervalues():
+            for a, r in placed:
+                if not (r.failed_error_checks or r.failed_warning_checks):
+                    continue
+                kind, target_id = 'NA', 'NA'
+                if r.failed_error_checks:
+                    if ids is None:
+                        ids = self.node_out_ids()
+                    node = getattr(r.attached_to, 'head_node', r.attached_to)
+                    kind = 'edge' if node is not r.attached_to else 'node'
+                    target_id = ids[node.preorder_index]
+                errors = [str(j) for j, c in enumerate(a.target.error_checks) if c in r.failed_error_checks]
+                warnings = [str(j) for j, c in enumerate(a.target.warning_checks) if c in r.failed_warning_checks]
+                out.write('\t'.join(['annotation', str(a.id), kind, str(target_id), ','.join(errors), \
+                        ','.join(warnings)]) + '\n')
+
+    def find_target(self, annotation, mrca=None):
+        # `mrca` may hold the already computed mrca of the included taxa
+        if annotation.target.type == TargetType.BRANCH:
+            return self.find_stem_based_target(annotation, mrca)
+        assert annotation.target.type == TargetType.NODE
+        return self.find_node_based_target(annotation, mrca)
+
+    def check_target(self, annotation, r):
         # check error conditions
         for check in annotation.target.error_checks:
             check_result = self.perform_check(r.attached_to, check)
@@ -340,7 +1811,6 @@ class TargetTree(object):
                 r.add_failed_error_check(check)
                 
                 # stop if we fail an error check
-                self.unadded_annotations.append((annotation, r))
                 return r
 
         # check warning conditions
@@ -348,11 +1818,122 @@ class TargetTree(object):
             check_result = self.perform_check(r.attached_to, check)
             if not check_result.passed:
                 r.add_failed_warning_check(check)
+        return r
+
+    def _record(self, annotation, r):
+        # annotations that share an id are all kept (update_annotation
+        # replaces them)
+        self._placements.setdefault(annotation.id, []).append((annotation, r))
+        if r.failed_error_checks:
+            self.unadded_annotations.append((annotation, r))
+            return
+        if r.reason_code != Reason.SUCCESS:
+            # no target was found
+            self.unadded_annotations.append((annotation, r))
+            debug('annotation {a}: {e}'.format(a=annotation.id, e=r.explain()))
+            return
 
         # add the annotation
-        r.attached_to.phylo_ref.append(annotation)
+        self._refs_for(r.attached_to).append(annotation)
         annotation.applied_to.append((self.tree, r.attached_to))
         self._num_added += 1
+
+    def _refs_for(self, target):
+        return target.phylo_ref
+
+    def get_placement(self, annotation_id):
+        # (annotation, MappingOutcome) of the last added annotation with this id, or None
+        placed = self._placements.get(annotation_id)
+        return placed[-1] if placed else None
+
+    def remove_annotation(self, annotation_id):
+        """
+        Detaches the annotations with this id from their nodes or edges (or
+        drops them from unadded_annotations) and forgets them, without
+        touching the rest of the tree. Returns the MappingOutcome of the
+        last one added, or None if no annotation with this id was added.
+        """
+        placed = self._placements.pop(annotation_id, None)
+        if placed is None:
+            return None
+        for annotation, r in reversed(placed):
+            self._num_tried -= 1
+            if r.reason_code != Reason.SUCCESS:
+                self.unadded_annotations.remove(annotation_id)
+                continue
+            self._refs_for(r.attached_to).remove(annotation_id)
+            applied_to = annotation.applied_to
+            for j in xrange(len(applied_to) - 1, -1, -1):
+                if applied_to[j][0] is self.tree and applied_to[j][1] is r.attached_to:
+                    del applied_to[j]
+                    break
+            self._num_added -= 1
+        return placed[-1][1]
+
+    def update_annotation(self, annotation):
+        # remaps an annotation (e.g. after its target was edited), replacing
+        # the placements of the annotations with the same id
+        self.remove_annotation(annotation.id)
+        return self.add_phyloreferenced_annotation(annotation)
+
+    def add_phyloreferenced_annotation(self, annotation, mrca=None):
+        self._num_tried += 1
+        
+        # find the target
+        r = self.find_target(annotation, mrca)
+
+        # if a target was found, check it
+        if r.reason_code == Reason.SUCCESS:
+            self.check_target(annotation, r)
+        self._record(annotation, r)
+        return r
+
+    def add_phyloreferenced_annotations_in_shards(self, annotations, workers=2, shard_size=None):
+        """
+        Same as add_phyloreferenced_annotations, but `workers` processes map
+        disjoint shards of the annotation list. The tree index is saved to a
+        temporary file that every worker memory-maps (see TreeIndex.load),
+        so the tree is neither copied nor rebuilt per worker; the targets
+        that the workers find are attached here, in annotation order.
+        """
+        import multiprocessing
+        import tempfile
+        if shard_size is None:
+            shard_size = max(1, -(-len(annotations) // (4 * workers)))
+        handle, index_filepath = tempfile.mkstemp(suffix='.idx')
+        os.close(handle)
+        outcomes = []
+        try:
+            self.index.save(index_filepath)
+            pool = multiprocessing.Pool(workers, _init_shard_worker, (index_filepath, annotations, \
+                    self._use_taxonomy, self._name_converter))
+            try:
+                shards = [(i, min(i + shard_size, len(annotations))) for i in xrange(0, len(annotations), shard_size)]
+                for start, packed in pool.imap(_map_annotation_shard, shards):
+                    for a, x in zip(annotations[start:start + len(packed)], packed):
+                        r = self._unpack_outcome(a, x)
+                        self._num_tried += 1
+                        self._record(a, r)
+                        outcomes.append(r)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+        finally:
+            os.remove(index_filepath)
+        return outcomes
+
+    def _unpack_outcome(self, annotation, packed):
+        # the inverse of _pack_outcome, with the nodes of this tree
+        reason_code, target, on_edge, missing_inc, missing_exc, errors, warnings = packed
+        attached_to = None
+        if target >= 0:
+            attached_to = self.index.nodes[target]
+            if on_edge:
+                attached_to = attached_to.edge
+        r = MappingOutcome(attached_to, reason_code, missing_inc, missing_exc)
+        r.failed_error_checks = tuple([annotation.target.error_checks[j] for j in errors])
+        r.failed_warning_checks = tuple([annotation.target.warning_checks[j] for j in warnings])
         return r
 
     def get_node_out_id(self,node):
@@ -369,62 +1950,621 @@ class TargetTree(object):
         return l
 
     def write_labeled_tree(self, tree_file):
-        self.tree.write(tree_file, 'newick', node_label_compose_func=self.get_node_out_id)
+        self.tree.write(file=tree_file, schema='newick', node_label_compose_fn=self.get_node_out_id)
+
+    def close(self):
+        # releases the memory-mapped file of an index loaded by
+        # load_target_tree; the tree can not be used afterwards
+        self.index.close()
+
+    def save_index(self, filepath, key=''):
+        """
+        Saves the tree index along with the output id of every node and the
+        labeled newick, so that a later run can load it into an
+        IndexedTargetTree instead of parsing the tree again (see
+        load_target_tree).
+        """
+        out = StringIO()
+        node_labels = self.node_out_ids(out)
+        self.index.save(filepath, key=key, node_labels=node_labels, newick=out.getvalue())
+
+    def node_out_ids(self, tree_file=None):
+        # the output ids of all nodes, in preorder; the ids of unnamed nodes
+        # are assigned by writing the labeled tree (to `tree_file`, if given)
+        self.write_labeled_tree(StringIO() if tree_file is None else tree_file)
+        return [self.get_node_out_id(n) for n in self.index.nodes]
 
-    def write_table(self, table_file):
-        table_file.write('type\ttarget_id\tannotation_id\treason\n')
+    def iter_placements(self):
+        # ('node' or 'edge', node, annotations) for the mapped annotations, in preorder
         for node in self.tree.preorder_node_iter():
             if node.phylo_ref:
-                for a in node.phylo_ref:
-                    table_file.write('node\t{n}\t{a}\t{o}\n'.format(n=self.get_node_out_id(node), \
-                            a=a.id, o=Reason.to_str(Reason.SUCCESS)))
+                yield 'node', node, node.phylo_ref
             e = node.edge
             if e:
                 if e.phylo_ref:
-                    for a in e.phylo_ref:
-                        table_file.write('edge\t{n}\t{a}\t{o}\n'.format(n=self.get_node_out_id(node), \
-                                a=a.id, o=Reason.to_str(Reason.SUCCESS)))
+                    yield 'edge', node, e.phylo_ref
 
-        # report unadded annotations
+    def iter_table_rows(self):
+        # (type, target_id, annotation_id, reason code) for the placements in
+        # preorder, then for the unadded annotations
+        for kind, node, refs in self.iter_placements():
+            target_id = str(self.get_node_out_id(node))
+            for a in refs:
+                yield kind, target_id, str(a.id), Reason.SUCCESS
         for annotation, result in self.unadded_annotations:
-            table_file.write('NA\tNA\t{a}\t{o}\n'.format(a=annotation.id,\
-                    o=Reason.to_str(result.reason_code)))
+            yield 'NA', 'NA', str(annotation.id), result.reason_code
+
+    def write_table(self, table_file, tree_index=None, header=True):
+        # with a tree_index every row starts with a `tree` column holding it
+        writer = TableWriter(table_file, tree_column=tree_index is not None, header=header)
+        writer.write_rows(self.iter_table_rows(), tree_index)
+        writer.flush()
+
+class IndexedTaxon(object):
+    def __init__(self, label):
+        self.label = label
+
+class IndexedTree(object):
+    # the parts of a dendropy tree that TargetTree uses while mapping
+    def __init__(self, index):
+        self.seed_node = index.nodes[0]
+        self.is_rooted = index.is_rooted
+        self.taxon_namespace = [IndexedTaxon(l) for l in index.labels]
+        self.label2index = dict((t.label, n) for n, t in enumerate(self.taxon_namespace))
+
+class IndexedTargetTree(TargetTree):
+    """
+    A TargetTree over a TreeIndex alone (usually one mapped with
+    TreeIndex.load), without the dendropy tree. It always uses the INTERVAL
+    split encoding and targets are IndexedNode/IndexedEdge objects, whose
+    annotations are kept by preorder number. Writing the results needs an
+    index saved by TargetTree.save_index.
+    With `attach` False found targets are only returned, which is what the
+    workers of TargetTree.add_phyloreferenced_annotations_in_shards use.
+    """
+    def __init__(self, index, use_taxonomy=True, name_converter=None, attach=True):
+        self.index = index
+        self.tree = IndexedTree(index)
+        self.unadded_annotations = AnnotationRefs(key=_pair_annotation_id)
+        self._placements = {}
+        self._attach = attach
+        self._node_refs = {}
+        self._edge_refs = {}
+        self._use_taxonomy = use_taxonomy
+        self._split_encoding = SplitEncoding.INTERVAL
+        self._resolved = {}
+        self._ott_id_index = None
+        self._taxonomy_position_index = None
+        self._check_engine = None
+        if use_taxonomy and name_converter is None:
+            name_converter = OTTNameConverter()
+        self._name_converter = name_converter
+
+    def _record(self, annotation, r):
+        if not self._attach:
+            if r.reason_code == Reason.SUCCESS:
+                self._num_added += 1
+            return
+        TargetTree._record(self, annotation, r)
+
+    def _refs_for(self, target):
+        i = getattr(target, 'head_node', target).preorder_index
+        refs = self._edge_refs if isinstance(target, IndexedEdge) else self._node_refs
+        if i not in refs:
+            refs[i] = AnnotationRefs()
+        return refs[i]
+
+    def get_node_out_id(self, node):
+        if self.index.node_labels is None:
+            raise ValueError('the tree index has no node labels')
+        return self.index.node_labels[node.preorder_index]
+
+    def node_out_ids(self, tree_file=None):
+        if tree_file is not None:
+            self.write_labeled_tree(tree_file)
+        if self.index.node_labels is None:
+            raise ValueError('the tree index has no node labels')
+        return self.index.node_labels
+
+    def induced_tree(self, annotations):
+        """
+        Returns an IndexedTargetTree over the subtree induced by the taxa
+        that the specifiers of `annotations` stand for (see InducedTreeIndex).
+        It maps and writes those annotations as this tree would, but the
+        mapping costs depend on the size of the batch instead of the size of
+        the tree. The resolved specifiers are shared with it.
+        """
+        label2node = self.index.label2node
+        tips = set()
+        for s in collect_specifiers(annotations):
+            for t in self.resolve_specifier(s)[0]:
+                tips.add(label2node[t.label])
+        tree = IndexedTargetTree(InducedTreeIndex(self.index, tips), use_taxonomy=self._use_taxonomy, \
+                name_converter=self._name_converter)
+        tree._resolved = self._resolved
+        return tree
+
+    def write_labeled_tree(self, tree_file):
+        if self.index.newick is not None:
+            tree_file.write(self.index.newick)
+        elif getattr(self.index, 'lengths', None) is not None:
+            self.index.write_newick(tree_file)
+        else:
+            raise ValueError('the tree index has no newick')
+
+    def iter_placements(self):
+        for i in sorted(set(self._node_refs) | set(self._edge_refs)):
+            node = self.index.nodes[i]
+            if self._node_refs.get(i):
+                yield 'node', node, self._node_refs[i]
+            if self._edge_refs.get(i):
+                yield 'edge', node, self._edge_refs[i]
+
+def tree_index_key(newick, use_taxonomy=True):
+    # the labels in the index depend on whether they were converted to ott ids
+    h = hashlib.sha1(newick.encode('utf-8') if isinstance(newick, unicode) else newick)
+    return '{h}-{t}'.format(h=h.hexdigest(), t='ott' if use_taxonomy else 'labels')
+
+def make_target_tree(newick, use_taxonomy=True, name_converter=None, stream_parse=False):
+    """
+    Returns a target tree for a newick tree statement: a TargetTree over the
+    dendropy tree, or with `stream_parse` an IndexedTargetTree over a
+    TreeIndex built by TreeIndex.from_newick, which needs much less memory
+    and time for large trees.
+    """
+    if stream_parse:
+        if use_taxonomy and name_converter is None:
+            name_converter = OTTNameConverter()
+        converter = name_converter.concat_taxon_label_to_ott_id if use_taxonomy else None
+        return IndexedTargetTree(TreeIndex.from_newick(newick, converter), use_taxonomy=use_taxonomy, \
+                name_converter=name_converter)
+    t = dendropy.Tree.get_from_string(newick, 'newick', suppress_internal_node_taxa=False)
+    return TargetTree(t, use_taxonomy=use_taxonomy, split_encoding=SplitEncoding.HASH, name_converter=name_converter)
+
+def load_target_tree(newick, index_dir, use_taxonomy=True, name_converter=None, stream_parse=False):
+    """
+    Returns a target tree for the newick string. If `index_dir` holds an
+    index saved for this newick (and taxonomy setting), it is memory-mapped
+    into an IndexedTargetTree and the tree is not parsed at all. Otherwise
+    the tree is parsed into a TargetTree and its index saved for the next
+    run; indexes that are truncated, of another format or saved under
+    another key are rebuilt the same way.
+    """
+    key = tree_index_key(newick, use_taxonomy)
+    filepath = os.path.join(index_dir, key + '.idx')
+    if os.path.exists(filepath):
+        try:
+            index = TreeIndex.load(filepath)
+        except (ValueError, struct.error, mmap.error):
+            index = None
+        if index is not None and index.key == key and index.node_labels is not None and index.newick:
+            return IndexedTargetTree(index, use_taxonomy=use_taxonomy, name_converter=name_converter)
+        if index is not None:
+            index.close()
+        debug('rebuilding stale tree index "{}"'.format(filepath))
+    tree = make_target_tree(newick, use_taxonomy=use_taxonomy, name_converter=name_converter, \
+            stream_parse=stream_parse)
+    if not os.path.exists(index_dir):
+        os.makedirs(index_dir)
+    # write under a temporary name, so no run ever maps a partial index
+    tmp_filepath = '{f}.{p}.tmp'.format(f=filepath, p=os.getpid())
+    tree.save_index(tmp_filepath, key=key)
+    os.rename(tmp_filepath, filepath)
+    return tree
+
+class CheckOutcome(object):
+    __slots__ = ('passed', 'check')
+    def __init__(self, passed, check):
+        self.passed = passed
+        self.check = check
+
+class TargetType(object):
+    BRANCH, NODE, UNDEFINED = range(3)
+    def to_str(c):
+        _validate_int(c,"type")
+        if c == TargetType.BRANCH:
+            return 'branch'
+        elif c == TargetType.NODE:
+            return 'node'
+        elif c == TargetType.UNDEFINED:
+            return 'undefined'
+        else:
+            raise AssertionError("The value '" + str(c) + "' is invalid.")
+    to_str = staticmethod(to_str)
+    def to_code(c):
+        _validate_string(c,"type")
+        if c.lower() == 'branch':
+            return TargetType.BRANCH
+        elif c.lower() == 'node':
+            return TargetType.NODE
+        elif c.lower() == 'undefined':
+            return TargetType.UNDEFINED
+        else:
+            raise ValueError("The value '" + str(c) + "' does not correspond to a known " \
+                    "type. Target type may only be 'node', 'branch', or 'undefined'.")
+    to_code = staticmethod(to_code)
+
+class _Int32Section(object):
+    # read-only view of a run of little-endian int32 values in a buffer
+    def __init__(self, buf, offset, length):
+        self._buf = buf
+        self._offset = offset
+        self._length = length
+    def __len__(self):
+        return self._length
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._length
+        if not 0 <= i < self._length:
+            raise IndexError('section index out of range')
+        return struct.unpack_from('<i', self._buf, self._offset + 4 * i)[0]
+    def slice(self, start, stop):
+        a = array('i')
+        a.fromstring(self._buf[self._offset + 4 * start:self._offset + 4 * stop])
+        if sys.byteorder == 'big':
+            a.byteswap()
+        return a
+
+class _StringSection(object):
+    # read-only view of utf-8 strings stored back to back in a buffer at
+    # `offset`, with their bounds in an _Int32Section of offsets
+    def __init__(self, buf, offsets, offset):
+        self._buf = buf
+        self._offsets = offsets
+        self._offset = offset
+    def __len__(self):
+        return len(self._offsets) - 1
+    def __getitem__(self, i):
+        start = self._offset + self._offsets[i]
+        return self._buf[start:self._offset + self._offsets[i + 1]].decode('utf-8')
+
+class OTTTaxonomyIndex(object):
+    """
+    Local, memory-mapped index of an OTT taxonomy, built from the
+    taxonomy.tsv file of an OTT release. Taxa are numbered in preorder, so
+    the descendants of a taxon are a contiguous range of the numbering and
+    expanding a clade is a binary search plus a range read. The file holds
+    a short header followed by five int32 sections of one entry per taxon:
+        - the ott ids in preorder
+        - the largest preorder number in the subtree of each taxon
+        - the preorder number of the parent of each taxon (-1 for roots)
+        - the ott ids in ascending order
+        - the preorder number of each of those sorted ids
+    """
+    MAGIC = 'OTTIDX01'
+    _HEADER = struct.Struct('<8sII')
+    NUM_SECTIONS = 5
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._file = open(filepath, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, version_len = self._HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC:
+            raise ValueError('"{}" is not an OTT taxonomy index'.format(filepath))
+        offset = self._HEADER.size
+        self.version = self._map[offset:offset + version_len].decode('utf-8')
+        offset += version_len
+        sections = []
+        for i in range(self.NUM_SECTIONS):
+            sections.append(_Int32Section(self._map, offset, n))
+            offset += 4 * n
+        self.ids, self.end, self.parent, self._sorted_ids, self._sorted_pos = sections
+
+    def __len__(self):
+        return len(self.ids)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def position(self, ott_id):
+        # preorder number of the taxon, or None if it is not in the taxonomy
+        ott_id = int(ott_id)
+        lo, hi = 0, len(self._sorted_ids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._sorted_ids[mid] < ott_id:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self._sorted_ids) and self._sorted_ids[lo] == ott_id:
+            return self._sorted_pos[lo]
+        return None
+
+    def descendant_range(self, ott_id):
+        # (first, last) preorder numbers of the clade, including the taxon itself
+        p = self.position(ott_id)
+        if p is None:
+            return None
+        return p, self.end[p]
+
+    def descendants(self, ott_id):
+        r = self.descendant_range(ott_id)
+        if r is None:
+            return None
+        return self.ids.slice(r[0], r[1] + 1)
+
+    @staticmethod
+    def read_version(taxonomy_filepath):
+        # OTT releases ship a version.txt next to taxonomy.tsv; without it
+        # the index has no version and cannot key caches (see
+        # OTTNameConverter.get_taxonomy_version)
+        v = os.path.join(os.path.dirname(os.path.abspath(taxonomy_filepath)), 'version.txt')
+        if os.path.exists(v):
+            with open(v) as inp:
+                return inp.read().strip()
+        return ''
+
+    @classmethod
+    def build(cls, taxonomy_filepath, filepath, version=None):
+        if version is None:
+            version = cls.read_version(taxonomy_filepath)
+        row_ids = array('l')
+        parent_ids = array('l')
+        with open(taxonomy_filepath) as tax_file:
+            for line in tax_file:
+                spls = line.split('\t|')
+                uid = spls[0].strip()
+                if not uid.isdigit():
+                    continue # header
+                row_ids.append(int(uid))
+                parent = spls[1].strip()
+                parent_ids.append(int(parent) if parent else -1)
+        n = len(row_ids)
+        id2row = dict((uid, r) for r, uid in enumerate(row_ids))
+
+        # child lists as linked rows, roots are taxa without a known parent
+        first_child = array('l', [-1]) * n
+        next_sibling = array('l', [-1]) * n
+        roots = []
+        for r in xrange(n - 1, -1, -1):
+            p = id2row.get(parent_ids[r])
+            if p is None:
+                roots.append(r)
+            else:
+                next_sibling[r] = first_child[p]
+                first_child[p] = r
+        del id2row
+
+        ids = array('i')
+        parent = array('i')
+        row2pos = array('l', [-1]) * n
+        stack = [(r, -1) for r in roots]
+        while stack:
+            r, p = stack.pop()
+            row2pos[r] = len(ids)
+            ids.append(row_ids[r])
+            parent.append(p)
+            c = first_child[r]
+            while c != -1:
+                stack.append((c, row2pos[r]))
+                c = next_sibling[c]
+        end = array('i', xrange(n))
+        for i in xrange(n - 1, 0, -1):
+            p = parent[i]
+            if p >= 0 and end[i] > end[p]:
+                end[p] = end[i]
+        sorted_pos = array('i', sorted(xrange(n), key=ids.__getitem__))
+        sorted_ids = array('i', [ids[i] for i in sorted_pos])
+
+        version = version.encode('utf-8')
+        with open(filepath, 'wb') as out:
+            out.write(cls._HEADER.pack(cls.MAGIC, n, len(version)))
+            out.write(version)
+            for a in [ids, end, parent, sorted_ids, sorted_pos]:
+                if sys.byteorder == 'big':
+                    a.byteswap()
+                a.tofile(out)
+        return cls(filepath)
+
+class ExpansionCache(object):
+    """
+    Persistent (SQLite) cache of clade expansions fetched from taxomachine,
+    keyed by ott id and taxonomy version so that a new OTT release never
+    sees stale expansions. Expansions are stored as packed int32 ids. The
+    cache holds at most `max_entries` expansions; when it grows beyond that,
+    the least recently used ones are evicted.
+    """
+    def __init__(self, filepath, taxonomy_version='', max_entries=100000):
+        self.filepath = filepath
+        self.taxonomy_version = taxonomy_version
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(filepath)
+        self._db.execute('CREATE TABLE IF NOT EXISTS expansion (ott_id TEXT, version TEXT, ' \
+                'ids BLOB, last_used INTEGER, PRIMARY KEY (ott_id, version))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS expansion_last_used ON expansion (last_used)')
+        self._clock, self._count = self._db.execute('SELECT MAX(last_used), COUNT(*) FROM expansion').fetchone()
+        if self._clock is None:
+            self._clock = 0
+        self._pending = 0
+
+    @property
+    def hit_rate(self):
+        n = self.hits + self.misses
+        if n == 0:
+            return 0.0
+        return float(self.hits) / n
+
+    def _tick(self):
+        self._clock += 1
+        self._pending += 1
+        if self._pending >= 1000:
+            self._db.commit()
+            self._pending = 0
+        return self._clock
+
+    def get(self, ott_id):
+        key = (str(ott_id), self.taxonomy_version)
+        row = self._db.execute('SELECT ids FROM expansion WHERE ott_id = ? AND version = ?', key).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._db.execute('UPDATE expansion SET last_used = ? WHERE ott_id = ? AND version = ?', \
+                (self._tick(),) + key)
+        ids = array('i')
+        ids.fromstring(str(row[0]))
+        if sys.byteorder == 'big':
+            ids.byteswap()
+        return IdArrayClade.from_sorted_array(ids)
+
+    def put(self, ott_id, clade):
+        if not isinstance(clade, IdArrayClade):
+            clade = IdArrayClade(clade)
+        ids = array('i', clade.ids)
+        if sys.byteorder == 'big':
+            ids.byteswap()
+        key = (str(ott_id), self.taxonomy_version)
+        exists = self._db.execute('SELECT 1 FROM expansion WHERE ott_id = ? AND version = ?', key).fetchone()
+        self._db.execute('INSERT OR REPLACE INTO expansion VALUES (?, ?, ?, ?)', \
+                key + (buffer(ids.tostring()), self._tick()))
+        if exists is None:
+            self._count += 1
+        if self._count > self.max_entries:
+            self._db.execute('DELETE FROM expansion WHERE rowid IN (SELECT rowid FROM expansion ' \
+                    'ORDER BY last_used LIMIT ?)', (self._count - self.max_entries,))
+            self._count = self.max_entries
+
+    def warm(self, ott_ids, fetch):
+        # fetch and store the expansions of the ids that are not cached yet
+        for i in ott_ids:
+            key = (str(i), self.taxonomy_version)
+            if self._db.execute('SELECT 1 FROM expansion WHERE ott_id = ? AND version = ?', key).fetchone() is None:
+                self.put(i, fetch(i))
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+class PlacementCache(object):
+    """
+    Persistent (SQLite) cache of the outcomes of mapping targets, keyed by
+    the content hash of the tree (TreeIndex.content_hash), the taxonomy
+    version and a hash of the specifiers and checks of the target, which
+    also tells whether they were resolved as ott ids (target_key).
+    Annotations with the same target share one entry whatever their bodies.
+    Outcomes are stored as the JSON of _pack_outcome (target node, reason,
+    missing specifiers and failed checks).
+    """
+    # SQLite allows at most 999 parameters in a statement
+    _QUERY_SIZE = 500
+
+    def __init__(self, filepath, taxonomy_version=''):
+        self.filepath = filepath
+        self.taxonomy_version = taxonomy_version
+        self.hits = 0
+        self.misses = 0
+        self._db = sqlite3.connect(filepath)
+        self._db.execute('CREATE TABLE IF NOT EXISTS placement (tree TEXT, version TEXT, target TEXT, ' \
+                'outcome TEXT, PRIMARY KEY (tree, version, target))')
+
+    @staticmethod
+    def target_key(target, use_taxonomy=True):
+        # the fields in a fixed order rather than to_json with sort_keys,
+        # which keeps json.dumps from using its C encoder; the same
+        # specifiers resolve to other taxa as ott ids than as labels (as in
+        # tree_index_key)
+        h = hashlib.sha1(json.dumps([target.type, target.ids_to_include, target.ids_to_exclude, \
+                [c.to_json() for c in target.error_checks], \
+                [c.to_json() for c in target.warning_checks]]))
+        return '{h}-{t}'.format(h=h.hexdigest(), t='ott' if use_taxonomy else 'labels')
+
+    def get_many(self, tree_key, target_keys):
+        # {target key: packed outcome} of the cached keys among target_keys
+        found = {}
+        target_keys = list(set(target_keys))
+        for i in xrange(0, len(target_keys), self._QUERY_SIZE):
+            chunk = target_keys[i:i + self._QUERY_SIZE]
+            rows = self._db.execute('SELECT target, outcome FROM placement WHERE tree = ? AND version = ? ' \
+                    'AND target IN ({})'.format(','.join('?' * len(chunk))), \
+                    [tree_key, self.taxonomy_version] + chunk)
+            for k, outcome in rows:
+                found[k] = json.loads(outcome)
+        self.hits += len(found)
+        self.misses += len(target_keys) - len(found)
+        return found
+
+    def put_many(self, tree_key, items):
+        # store (target key, packed outcome) pairs
+        self._db.executemany('INSERT OR REPLACE INTO placement VALUES (?, ?, ?, ?)', \
+                [(tree_key, self.taxonomy_version, k, json.dumps(packed)) for k, packed in items])
+        self._db.commit()
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
 
-class CheckOutcome(object):
-    def __init__(self, passed, check):
-        self.passed = passed
-        self.check = check
+class IdArrayClade(object):
+    """
+    Expansion of a clade held as a sorted int32 array of its ott ids (4 bytes
+    per id instead of a string object). Iterating yields the ids as strings.
+    """
+    def __init__(self, ids):
+        self.ids = array('i', sorted(int(i) for i in ids))
+    @classmethod
+    def from_sorted_array(cls, ids):
+        c = cls([])
+        c.ids = ids
+        return c
+    def __len__(self):
+        return len(self.ids)
+    def __iter__(self):
+        for i in self.ids:
+            yield str(i)
+    def __contains__(self, ott_id):
+        j = bisect.bisect_left(self.ids, int(ott_id))
+        return j < len(self.ids) and self.ids[j] == int(ott_id)
+    def taxa_in_tree(self, tree):
+        # walk the smaller of the clade and the overlapping part of the tree
+        if not self.ids:
+            return []
+        tree_ids, taxa = tree.get_ott_id_index()
+        lo = bisect.bisect_left(tree_ids, self.ids[0])
+        hi = bisect.bisect_right(tree_ids, self.ids[-1])
+        if hi - lo <= len(self.ids):
+            return [taxa[j] for j in xrange(lo, hi) if tree_ids[j] in self]
+        found = []
+        for i in self.ids:
+            j = bisect.bisect_left(tree_ids, i, lo, hi)
+            if j < hi and tree_ids[j] == i:
+                found.append(taxa[j])
+        return found
 
-class TargetType(object):
-    BRANCH, NODE, UNDEFINED = range(3)
-    def to_str(c):
-        _validate_int(c,"type")
-        if c == TargetType.BRANCH:
-            return 'branch'
-        elif c == TargetType.NODE:
-            return 'node'
-        elif c == TargetType.UNDEFINED:
-            return 'undefined'
-        else:
-            raise AssertionError("The value '" + str(c) + "' is invalid.")
-    to_str = staticmethod(to_str)
-    def to_code(c):
-        _validate_string(c,"type")
-        if c.lower() == 'branch':
-            return TargetType.BRANCH
-        elif c.lower() == 'node':
-            return TargetType.NODE
-        elif c.lower() == 'undefined':
-            return TargetType.UNDEFINED
-        else:
-            raise ValueError("The value '" + str(c) + "' does not correspond to a known " \
-                    "type. Target type may only be 'node', 'branch', or 'undefined'.")
-    to_code = staticmethod(to_code)
+class TaxonomyRangeClade(object):
+    """
+    Expansion of a clade as the range of preorder numbers it spans in an
+    OTTTaxonomyIndex, so it takes constant space whatever the clade size.
+    """
+    def __init__(self, taxonomy, first, last):
+        self.taxonomy = taxonomy
+        self.first = first
+        self.last = last
+    def __len__(self):
+        return self.last - self.first + 1
+    def __iter__(self):
+        for i in self.taxonomy.ids.slice(self.first, self.last + 1):
+            yield str(i)
+    def __contains__(self, ott_id):
+        p = self.taxonomy.position(ott_id)
+        return p is not None and self.first <= p <= self.last
+    def taxa_in_tree(self, tree):
+        positions, taxa = tree.get_taxonomy_position_index(self.taxonomy)
+        lo = bisect.bisect_left(positions, self.first)
+        hi = bisect.bisect_right(positions, self.last)
+        return taxa[lo:hi]
 
 class OTTNameConverter(object):
 
-    def __init__(self):
+    def __init__(self, taxonomy_index=None, expansion_cache=None, taxomachine=None):
         self._EXP_CACHE = {}
+        self._taxonomy = taxonomy_index
+        self._expansion_cache = expansion_cache
+        if taxomachine is None:
+            taxomachine = TAXOMACHINE
+        self._taxomachine = taxomachine
 
     def get_ott_ids_from_taxon_namespace(self, ns):
         r = []
@@ -433,10 +2573,83 @@ class OTTNameConverter(object):
             r.append(x)
         return r
 
+    def get_taxonomy_version(self):
+        # raises rather than guessing, as persistent caches are keyed by it
+        if self._taxonomy is not None:
+            if not self._taxonomy.version:
+                raise RuntimeError('the OTT index "{}" has no taxonomy version (there was no version.txt next to ' \
+                        'its taxonomy.tsv)'.format(self._taxonomy.filepath))
+            return self._taxonomy.version
+        try:
+            version = self._taxomachine.info()['source']
+        except Exception as x:
+            raise RuntimeError('could not get the taxonomy version from taxomachine ({})'.format(x))
+        if not version:
+            raise RuntimeError('taxomachine did not report a taxonomy version')
+        return version
+
     def expand_clade_using_ott(self, ott_id):
+        # returns an IdArrayClade or TaxonomyRangeClade
         if ott_id in self._EXP_CACHE:
             return self._EXP_CACHE[ott_id]
-        n = TAXOMACHINE.subtree(ott_id)['subtree']
+        if self._taxonomy is not None:
+            id_list = self.expand_clade_locally(ott_id)
+        else:
+            id_list = None
+            if self._expansion_cache is not None:
+                id_list = self._expansion_cache.get(ott_id)
+            if id_list is None:
+                id_list = self.expand_clade_using_taxomachine(ott_id)
+                if self._expansion_cache is not None:
+                    self._expansion_cache.put(ott_id, id_list)
+        self._EXP_CACHE[ott_id] = id_list
+        return id_list
+
+    def prefetch(self, ott_ids, max_workers=8):
+        """
+        Fills the expansion cache for all of `ott_ids` before mapping starts.
+        Expansions that are neither in memory nor in the persistent cache are
+        fetched from taxomachine by a pool of `max_workers` threads; the
+        results are stored from the calling thread, as the SQLite cache may
+        only be used from the thread that opened it.
+        """
+        missing = []
+        for i in set(ott_ids):
+            if i in self._EXP_CACHE:
+                continue
+            if self._taxonomy is not None:
+                self._EXP_CACHE[i] = self.expand_clade_locally(i)
+                continue
+            if self._expansion_cache is not None:
+                id_list = self._expansion_cache.get(i)
+                if id_list is not None:
+                    self._EXP_CACHE[i] = id_list
+                    continue
+            missing.append(i)
+        if not missing:
+            return 0
+        pool = ThreadPool(max(1, min(max_workers, len(missing))))
+        try:
+            expansions = pool.map(self.expand_clade_using_taxomachine, missing)
+        finally:
+            pool.close()
+            pool.join()
+        for i, id_list in zip(missing, expansions):
+            self._EXP_CACHE[i] = id_list
+            if self._expansion_cache is not None:
+                self._expansion_cache.put(i, id_list)
+        return len(missing)
+
+    def expand_clade_locally(self, ott_id):
+        # the local index spans every descendant (internal taxa and the
+        # taxon itself included); ids it does not know expand to themselves
+        r = self._taxonomy.descendant_range(ott_id)
+        if r is None:
+            return IdArrayClade([ott_id])
+        return TaxonomyRangeClade(self._taxonomy, r[0], r[1])
+
+    def expand_clade_using_taxomachine(self, ott_id):
+        n = self._taxomachine.subtree(ott_id)['subtree']
         if n.startswith('('):
     #        n += ';'
             inp = StringIO(n)
@@ -447,9 +2660,7 @@ class OTTNameConverter(object):
     
         # kludge to deal with dendropy bug where trailing semicolon is added to name
             id_list = [i.strip(";") for i in id_list]
-    
-        self._EXP_CACHE[ott_id] = id_list
-        return id_list
+        return IdArrayClade(id_list)
     
     def concat_taxon_label_to_ott_id(self, label, from_taxom=False):
         s = label.split('_')
@@ -475,25 +2686,23 @@ class OTTNameConverter(object):
 
     
 class MonophylyCondition(object):
+    __slots__ = ('clade_list',)
     def __init__(self, *valist):
-        self.clade_list = [str(i) for i in valist]
+        self.clade_list = tuple([_intern(str(i)) for i in valist])
     def explain(self):
         return 'REQUIRE_MONOPHYLETIC({})'.format(', '.join(self.clade_list))
     def passes(self, tree, node_or_edge):
-        bitmask = 0
+        in_tree = []
         for c in self.clade_list:
-            in_tree = tree.get_taxa_in_tree(c, bits=True)[0]
-            for x in in_tree:
-                bitmask |= x
-        if (bitmask == 0) or (bitmask not in tree.split_edges):
-            return False
-        return True
+            in_tree.extend(tree.get_taxa_in_tree(c)[0])
+        return tree.is_split(tree.get_taxon_set(in_tree))
     def to_json(self):
-        return ["REQUIRE_MONOPHYLETIC",] + self.clade_list
+        return ["REQUIRE_MONOPHYLETIC",] + list(self.clade_list)
 
 class TargetExcludesCondition(object):
+    __slots__ = ('clade_list', 'failed')
     def __init__(self, *valist):
-        self.clade_list = [str(i) for i in valist]
+        self.clade_list = tuple([_intern(str(i)) for i in valist])
         self.failed = None
     def explain(self):
         return 'TARGET_EXCLUDES({})'.format(', '.join(self.clade_list))
@@ -502,20 +2711,17 @@ class TargetExcludesCondition(object):
         if not node_or_edge:
             return None
         try:
-            edge = node_or_edge.edge
-        except:
-            edge = node_or_edge
+            node = node_or_edge.head_node
+        except AttributeError:
+            node = node_or_edge
         for c in self.clade_list:
-            in_tree = tree.get_taxa_in_tree(c, bits=True)[0]
-            exc_code = 0
-            for t in in_tree:
-                exc_code |= t
-            if exc_code * edge.split_bitmask:
+            in_tree = tree.get_taxa_in_tree(c)[0]
+            if in_tree and tree.clade_overlaps(node, tree.get_taxon_set(in_tree)):
                 self.failed = c
                 return False
         return True
     def to_json(self):
-        return ['TARGET_EXCLUDES',] + self.clade_list
+        return ['TARGET_EXCLUDES',] + list(self.clade_list)
 
 class ReferenceCondition(object):
 
@@ -537,12 +2743,15 @@ class ReferenceCondition(object):
         return ReferenceCondition._CODE_TO_TYPE[code]
         
 class ReferenceTarget(object):
+    # specifiers and checks are kept in (shared) tuples; use the methods
+    # below to add to them
+    __slots__ = ('_type', '_ids_to_include', '_ids_to_exclude', '_error_checks', '_warning_checks')
     def __init__(self, target_type=TargetType.UNDEFINED):
         self._type = target_type
-        self._ids_to_include = []
-        self._ids_to_exclude = []
-        self._error_checks = []
-        self._warning_checks = []
+        self._ids_to_include = ()
+        self._ids_to_exclude = ()
+        self._error_checks = ()
+        self._warning_checks = ()
     @property
     def type(self):
         return self._type
@@ -564,16 +2773,21 @@ class ReferenceTarget(object):
         return self._warning_checks
 
     def include_specifiers(self, specifiers):
-        for s in specifiers:
-            self._ids_to_include.append(s)
+        self._ids_to_include += tuple([_intern(s) for s in specifiers])
     def exclude_specifiers(self, specifiers):
-        for s in specifiers:
-            self._ids_to_exclude.append(s)
+        self._ids_to_exclude += tuple([_intern(s) for s in specifiers])
+
+    def key(self):
+        # equal for targets of the same type with the same specifiers and
+        # checks, in the same order
+        return (self._type, self._ids_to_include, self._ids_to_exclude, \
+                tuple([(type(c),) + c.clade_list for c in self._error_checks]), \
+                tuple([(type(c),) + c.clade_list for c in self._warning_checks]))
 
     def add_error_condition(self, condition):
-        self._error_checks.append(condition)
+        self._error_checks += (condition,)
     def add_warning_condition(self, condition):
-        self._warning_checks.append(condition)
+        self._warning_checks += (condition,)
     @classmethod
     def from_data(cls, data):
         if type(data) is not dict:
@@ -600,12 +2814,47 @@ class ReferenceTarget(object):
     def to_json(self):
         return {
             "type": TargetType.to_str(self._type),
-            "included_ids": self._ids_to_include,
-            "excluded_ids": self._ids_to_exclude,
+            "included_ids": list(self._ids_to_include),
+            "excluded_ids": list(self._ids_to_exclude),
             "error_checks": [x.to_json() for x in self._error_checks],
             "warning_checks": [x.to_json() for x in self._warning_checks],
         }
 
+# values that repeat across an annotation corpus (specifiers, timestamps);
+# one object is kept for every distinct value, keyed with its type so that
+# e.g. 1 and '1' stay apart. Like the timestamps (and the entities of
+# Entity.from_data), the table is cleared when it is full, so a long-running
+# process does not keep every value it has seen
+_MAX_INTERNED = 1 << 16
+_INTERNED = {}
+_MAX_TIMESTAMPS = 4096
+_TIMESTAMPS = {}
+
+def _normalize_timestamp(value):
+    # the isoformat of a datetime string, or None if it cannot be parsed;
+    # annotations of a corpus are often made at the same few times
+    cached = isinstance(value, basestring)
+    s = _TIMESTAMPS.get(value) if cached else None
+    if s is None:
+        try:
+            s = dateutil.parser.parse(value).isoformat()
+        except:
+            return None
+        if cached:
+            if len(_TIMESTAMPS) >= _MAX_TIMESTAMPS:
+                _TIMESTAMPS.clear()
+            _TIMESTAMPS[value] = s
+    return s
+
+def _intern(value):
+    key = (type(value), value)
+    x = _INTERNED.get(key)
+    if x is None:
+        if len(_INTERNED) >= _MAX_INTERNED:
+            _INTERNED.clear()
+        x = _INTERNED[key] = value
+    return x
+
 def _validate_int(s, property):
     if type(s) not in [int, long]:
         raise ValueError("The '" + property + "' property must always be an integer")
@@ -631,39 +2880,54 @@ def _validate_list(s, property):
         raise ValueError("The '" + property + "' property must always be a list")
 
 class Entity(object):
+    # from_data returns one shared Entity for every distinct annotator (up to
+    # _MAX_INTERNED of them); shared entities cannot be modified, modify a
+    # copy() instead
+    __slots__ = ('_name', '_url', '_description', '_version', '_invocation', '_shared')
+    _type = "prov:Entity"
+    _interned = {}
     def __init__(self):
         self._name = ""
         self._url = ""
         self._description = ""
         self._version = ""
         self._invocation = {}
-        self._type = "prov:Entity"
+        self._shared = False
+    def _check_mutable(self):
+        if self._shared:
+            raise ValueError("This entity is shared between annotations read from data and cannot be modified; " \
+                    "modify a copy() of it instead")
     @property
     def url(self):
         return self._url
     @url.setter
     def url(self, url):
+        self._check_mutable()
         _validate_string(url,"url")
         self._url = url
     @property
     def description(self):
         return self._description
-    @url.setter
+    @description.setter
     def description(self, description):
+        self._check_mutable()
         _validate_string(description,"description")
         self._description = description
     @property
     def version(self):
         return self._version
-    @url.setter
+    @version.setter
     def version(self, version):
+        self._check_mutable()
         _validate_string_or_number(version,"version")
         self._version = version
     @property
     def invocation(self):
-        return self._invocation
-    @url.setter
+        # the dict of a shared entity is copied, so that it is not modified either
+        return copy(self._invocation) if self._shared else self._invocation
+    @invocation.setter
     def invocation(self, invocation):
+        self._check_mutable()
         _validate_dict(invocation,"invocation")
         self._invocation = invocation
     @property
@@ -671,6 +2935,7 @@ class Entity(object):
         return self._name
     @name.setter
     def name(self, name):
+        self._check_mutable()
         _validate_string(name,"name")
         self._name = name
     @property
@@ -688,6 +2953,22 @@ class Entity(object):
         e.description = data["description"] if "description" in data else ""
         e.version = data["version"] if "version" in data else ""
         e.invocation = data["invocation"] if "invocation" in data else {}
+        key = (cls, e._name, e._url, e._description, e._version, json.dumps(e._invocation, sort_keys=True))
+        shared = cls._interned.get(key)
+        if shared is None:
+            if len(cls._interned) >= _MAX_INTERNED:
+                cls._interned.clear()
+            e._shared = True
+            shared = cls._interned[key] = e
+        return shared
+    def copy(self):
+        # an entity with the same values that can be modified
+        e = Entity()
+        e._name = self._name
+        e._url = self._url
+        e._description = self._description
+        e._version = self._version
+        e._invocation = copy(self._invocation)
         return e
     def to_json(self):
         return {
@@ -696,10 +2977,11 @@ class Entity(object):
             "url": self._url,
             "description": self._description,
             "version": self._version,
-            "invocation": self._invocation,
+            "invocation": copy(self._invocation) if self._shared and self._invocation else self._invocation,
         }
         
 class Annotation(object):
+    __slots__ = ('_id', '_applied_to', '_target', '_annotated_at', '_annotated_by', '_body', '_pending')
     def __init__(self, id):
         _validate_string_or_int(id,"_id")
         self._id = id # should be unique within the used context
@@ -708,6 +2990,8 @@ class Annotation(object):
         self._annotated_at = datetime.now().isoformat()
         self._annotated_by = Entity()
         self._body = {}
+        # a mask of the LAZY_ fields that still hold the value as read
+        self._pending = 0
     @property
     def id(self):
         return self._id
@@ -725,27 +3009,37 @@ class Annotation(object):
         self._target = target
     @property
     def annotated_at(self):
+        if self._pending & Annotation.LAZY_AT:
+            self.annotated_at = self._annotated_at
         return self._annotated_at
     @annotated_at.setter
     def annotated_at(self, datetime_str):
-        try:
-            x = dateutil.parser.parse(datetime_str)
-        except:
+        s = _normalize_timestamp(datetime_str)
+        if s is None:
             raise ValueError("could not parse the datetime string '" + \
                     str(datetime_str) + "'. The oa:annotatedAt field must contain a " + \
                     "datetime string which should be of the format: " + \
                     datetime.now().isoformat())
-        self._annotated_at = x.isoformat()
+        self._annotated_at = s
+        self._pending &= ~Annotation.LAZY_AT
     @property
     def annotated_by(self):
+        if self._pending & Annotation.LAZY_BY:
+            self.annotated_by = Entity.from_data(self._annotated_by)
         return self._annotated_by
     @annotated_by.setter
     def annotated_by(self, entity):
         if type(entity) is not Entity:
             raise ValueError("The oa:annotatedBy field may only contain Entity objects.")
         self._annotated_by = entity
+        self._pending &= ~Annotation.LAZY_BY
     @property
     def body(self):
+        if self._pending & Annotation.LAZY_BODY:
+            self.body = self._body
+        elif self._pending & Annotation.LAZY_BODY_TEXT:
+            self._body = json.loads(self._body)
+            self._pending &= ~Annotation.LAZY_BODY_TEXT
         return self._body
     @body.setter
     def body(self, body):
@@ -756,6 +3050,7 @@ class Annotation(object):
                     str(body) + "' to JSON. The body of an annotation must " \
                     "be JSON-serializable.")
         self._body = body
+        self._pending &= ~(Annotation.LAZY_BODY | Annotation.LAZY_BODY_TEXT)
     @property
     def applied_to(self):
         return self._applied_to
@@ -766,7 +3061,12 @@ class Annotation(object):
     def summary(self):
         return json.dumps(self.to_json())
     @classmethod
-    def from_data(cls, data):
+    def from_data(cls, data, lazy=False):
+        """
+        With `lazy` only the id and target are parsed; the timestamp,
+        annotator and body are kept as read and parsed (and validated) the
+        first time one of them is used, so their errors surface then.
+        """
         if type(data) is not dict:
             raise ValueError("Cannot parse " + str(type(data)) + " as entity.")
         if not '_id' in data:
@@ -777,9 +3077,15 @@ class Annotation(object):
                 raise ValueError("the annotation must contain the properties: " + \
                         ",".join(cls.required_properties))                        
         a.target = ReferenceTarget.from_data(data['oa:hasTarget'])
-        a.annotated_at = data['oa:annotatedAt']
-        a.annotated_by = Entity.from_data(data['oa:annotatedBy'])
-        a.body = data['oa:hasBody']
+        if lazy:
+            a._annotated_at = data['oa:annotatedAt']
+            a._annotated_by = data['oa:annotatedBy']
+            a._body = data['oa:hasBody']
+            a._pending = Annotation.LAZY_AT | Annotation.LAZY_BY | Annotation.LAZY_BODY
+        else:
+            a.annotated_at = data['oa:annotatedAt']
+            a.annotated_by = Entity.from_data(data['oa:annotatedBy'])
+            a.body = data['oa:hasBody']
         return a
     def to_json(self):
         return {
@@ -790,6 +3096,24 @@ class Annotation(object):
             'oa:hasBody': self.body,
         }
     required_properties = ["oa:hasTarget","oa:annotatedBy","oa:hasBody","oa:annotatedAt"]
+    LAZY_AT = 1
+    LAZY_BY = 2
+    LAZY_BODY = 4
+    LAZY_BODY_TEXT = 8
+
+    @classmethod
+    def _restore(cls, id, target, annotated_at, annotated_by, body_text):
+        # an annotation from parts that were validated when they were stored
+        # (see AnnotationCorpus); the body is JSON text parsed on first use
+        a = cls.__new__(cls)
+        a._id = id
+        a._applied_to = []
+        a._target = target
+        a._annotated_at = annotated_at
+        a._annotated_by = annotated_by
+        a._body = body_text
+        a._pending = Annotation.LAZY_BODY_TEXT
+        return a
         
 class RandomAnnotation(Annotation):
     
@@ -816,7 +3140,7 @@ class RandomAnnotation(Annotation):
         else:
             self.get_random_string = self._get_random_string_ascii
 
-        self.id = id
+        Annotation.__init__(self, id)
 
         e = Entity()
         e.name = self.get_random_string(random.randrange(30))
@@ -949,38 +3273,987 @@ class RandomAnnotation(Annotation):
             c = TargetExcludesCondition(*specifiers)
         return c
 
-def main(tree_filename, annotations_filename, out_tree_file_path, out_table_file_path, use_taxonomy=True):
+def collect_specifiers(annotations):
+    # every distinct specifier used by the targets and checks of the annotations
+    specifiers = set()
+    for a in annotations:
+        t = a.target
+        specifiers.update(t.ids_to_include)
+        specifiers.update(t.ids_to_exclude)
+        for check in t.error_checks + t.warning_checks:
+            specifiers.update(check.clade_list)
+    return set([i if isinstance(i, basestring) else str(i) for i in specifiers])
+
+def iter_newick_statements(stream, chunk_size=1 << 16):
+    """
+    Yields the tree statements (up to and including the ';') of a newick
+    stream as strings, without parsing them. Semicolons inside quoted labels
+    and [comments] do not end a statement.
+    """
+    statement = []
+    in_quote = False
+    comment_depth = 0
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        start = 0
+        for i, c in enumerate(chunk):
+            if in_quote:
+                in_quote = c != "'"
+            elif comment_depth:
+                if c == '[':
+                    comment_depth += 1
+                elif c == ']':
+                    comment_depth -= 1
+            elif c == "'":
+                in_quote = True
+            elif c == '[':
+                comment_depth = 1
+            elif c == ';':
+                statement.append(chunk[start:i + 1])
+                start = i + 1
+                s = ''.join(statement).strip()
+                statement = []
+                if s != ';':
+                    yield s
+        statement.append(chunk[start:])
+    s = ''.join(statement).strip()
+    if s:
+        yield s + ';'
+
+# the Python types of the JSON types named by the "type" keyword of a schema
+_SCHEMA_TYPES = {
+    'object': (dict,),
+    'array': (list,),
+    'string': (str, unicode),
+    'integer': (int, long),
+    'number': (int, long, float),
+    'boolean': (bool,),
+    'null': (type(None),),
+}
+
+# checks of the "format" keyword
+SCHEMA_FORMATS = {
+    'date-time': lambda v: _normalize_timestamp(v) is not None,
+    'target-type': lambda v: isinstance(v, basestring) and v.lower() in ('node', 'branch', 'undefined'),
+    'reference-condition': lambda v: type(v) is list and len(v) > 0 and \
+            isinstance(v[0], basestring) and v[0] in ReferenceCondition._CODE_TO_TYPE,
+}
+
+_SPECIFIERS_SCHEMA = {'type': 'array', 'items': {'type': ['string', 'integer']}}
+_CHECKS_SCHEMA = {'type': 'array', 'items': {'format': 'reference-condition'}}
+
+# what Annotation.from_data reads, in the form of the schemas of the
+# schemas/ directory
+ANNOTATION_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        '_id': {'type': ['string', 'integer']},
+        'oa:annotatedAt': {'type': 'string', 'format': 'date-time'},
+        'oa:annotatedBy': {
+            'type': 'object',
+            'properties': {
+                'name': {'type': 'string'},
+                'url': {'type': 'string'},
+                'description': {'type': 'string'},
+                'version': {'type': ['string', 'number']},
+                'invocation': {'type': 'object'},
+            },
+            'required': ['name'],
+        },
+        'oa:hasBody': {'type': 'object'},
+        'oa:hasTarget': {
+            'type': 'object',
+            'properties': {
+                'type': {'format': 'target-type'},
+                'included_ids': _SPECIFIERS_SCHEMA,
+                'excluded_ids': _SPECIFIERS_SCHEMA,
+                'error_checks': _CHECKS_SCHEMA,
+                'warning_checks': _CHECKS_SCHEMA,
+            },
+            'required': ['type', 'included_ids'],
+        },
+    },
+    'required': ['_id', 'oa:hasTarget', 'oa:annotatedBy', 'oa:hasBody', 'oa:annotatedAt'],
+}
+
+def compile_schema(schema, formats=SCHEMA_FORMATS):
+    """
+    Compiles a schema (the subset of JSON schema used in schemas/: type,
+    properties, required, items, enum and format, where a string in place
+    of a schema is a constant) into a function check(value, path, errors)
+    that appends a message for every problem found to the list `errors`.
+    """
+    if isinstance(schema, basestring):
+        def check_constant(value, path, errors):
+            if value != schema:
+                errors.append("{p}: must be '{c}'".format(p=path or '/', c=schema))
+        return check_constant
+    names = schema.get('type')
+    if isinstance(names, basestring):
+        names = [names]
+    types = None
+    if names:
+        types = tuple([t for n in names for t in _SCHEMA_TYPES[n]])
+    allow_bool = 'boolean' in (names or ())
+    enum = schema.get('enum')
+    format_check = formats[schema['format']] if 'format' in schema else None
+    required = schema.get('required', ())
+    properties = [(k, compile_schema(v, formats)) for k, v in sorted(schema.get('properties', {}).items())]
+    items = compile_schema(schema['items'], formats) if 'items' in schema else None
+    has_properties = bool(required or properties)
+
+    def check(value, path, errors):
+        if types is not None and (not isinstance(value, types) or type(value) is bool and not allow_bool):
+            errors.append('{p}: must be of type {t}'.format(p=path or '/', t=' or '.join(names)))
+            return
+        if enum is not None and value not in enum:
+            errors.append('{p}: must be one of {e}'.format(p=path or '/', e=', '.join(map(json.dumps, enum))))
+        if format_check is not None and not format_check(value):
+            errors.append('{p}: is not a valid {f}'.format(p=path or '/', f=schema['format']))
+        if has_properties and type(value) is dict:
+            for k in required:
+                if k not in value:
+                    errors.append("{p}: missing the required property '{k}'".format(p=path or '/', k=k))
+            for k, c in properties:
+                if k in value:
+                    c(value[k], path + '/' + k, errors)
+        elif items is not None and type(value) is list:
+            for i, x in enumerate(value):
+                items(x, '{p}/{i}'.format(p=path, i=i), errors)
+    return check
+
+class AnnotationValidator(object):
+    """
+    Checks annotation documents (the JSON values of an annotations file)
+    against ANNOTATION_SCHEMA and the schemas (*.json) of `schema_dir`, each
+    compiled once by compile_schema. A schema whose top-level property (e.g.
+    oa:hasBody) has a constant type is only applied to documents in which
+    that property has that type.
+    """
+    def __init__(self, schema_dir=None):
+        self._checks = [compile_schema(ANNOTATION_SCHEMA)]
+        self._typed_checks = {}
+        self.schemas = []
+        if schema_dir is not None:
+            for name in sorted(os.listdir(schema_dir)):
+                if name.endswith('.json'):
+                    with open(os.path.join(schema_dir, name)) as inp:
+                        self.add_schema(json.load(inp))
+                    self.schemas.append(name)
+
+    def add_schema(self, schema):
+        check = compile_schema(schema)
+        for k, v in schema.get('properties', {}).items():
+            if isinstance(v, dict) and isinstance(v.get('properties', {}).get('type'), basestring):
+                self._typed_checks.setdefault((k, v['properties']['type']), []).append(check)
+                return
+        self._checks.append(check)
+
+    def errors(self, document):
+        # the problems of a document, as a list of messages
+        errors = []
+        for check in self._checks:
+            check(document, '', errors)
+        if type(document) is dict and self._typed_checks:
+            for (k, t), checks in self._typed_checks.items():
+                part = document.get(k)
+                if type(part) is dict and part.get('type') == t:
+                    for check in checks:
+                        check(document, '', errors)
+            # the schemas overlap, e.g. on the type of included_ids
+            seen = set()
+            errors = [e for e in errors if not (e in seen or seen.add(e))]
+        return errors
+
+def _init_validator_worker(schema_dir):
+    _TREE_WORKER['validator'] = AnnotationValidator(schema_dir)
+
+def _validate_documents(job):
+    start, documents = job
+    validator = _TREE_WORKER['validator']
+    return _validation_report(validator, start, documents)
+
+def _validation_report(validator, start, documents):
+    report = []
+    for n, d in enumerate(documents, start):
+        errors = validator.errors(d)
+        if errors:
+            report.append((n, d.get('_id') if type(d) is dict else None, errors))
+    return report
+
+def validate_annotations(filepath, schema_dir=None, workers=1, chunk_size=1000):
+    """
+    Checks every annotation of the file at `filepath` (see iter_json_values,
+    or an AnnotationCorpus) with an AnnotationValidator, in `workers`
+    processes if more than one. Returns a report of the invalid annotations
+    as a list of (position in the file, _id or None, list of messages), in
+    file order.
+    """
+    def chunks():
+        chunk = []
+        start = 0
+        for d in _iter_annotation_documents(filepath):
+            chunk.append(d)
+            if len(chunk) >= chunk_size:
+                yield start, chunk
+                start += len(chunk)
+                chunk = []
+        if chunk:
+            yield start, chunk
+    report = []
+    if workers <= 1:
+        validator = AnnotationValidator(schema_dir)
+        for start, documents in chunks():
+            report.extend(_validation_report(validator, start, documents))
+        return report
+    import multiprocessing
+    pool = multiprocessing.Pool(workers, _init_validator_worker, (schema_dir,))
+    try:
+        for r in pool.imap(_validate_documents, chunks()):
+            report.extend(r)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return report
+
+def _iter_annotation_documents(filepath):
+    # the JSON data of the annotations of a JSON or corpus file
+    if AnnotationCorpus.is_corpus(filepath):
+        corpus = AnnotationCorpus(filepath)
+        try:
+            for a in corpus:
+                yield a.to_json()
+        finally:
+            corpus.close()
+    else:
+        with codecs.open(filepath, 'r', encoding='utf-8') as inp:
+            for d in iter_json_values(inp):
+                yield d
+
+_JSON_DECODER = json.JSONDecoder()
+# what may follow a number that the end of a chunk cut short (e.g. "12." of "12.5")
+_NUMBER_TAIL = re.compile(r'[-+.0-9eE]*\Z')
+
+def iter_json_values(stream, chunk_size=1 << 16):
+    """
+    Yields the JSON values of a stream one at a time: the elements of a
+    top-level array, or the values of a JSON-lines (or any whitespace
+    separated) stream. Only the value being decoded is held in memory.
+    """
+    buf = ''
+    pos = 0
+    eof = False
+    in_array = None
+    while True:
+        # skip whitespace (and, inside the array, the separating commas)
+        while pos < len(buf) and (buf[pos].isspace() or (buf[pos] == ',' and in_array)):
+            pos += 1
+        if pos == len(buf):
+            if eof:
+                break
+            buf = stream.read(chunk_size)
+            pos = 0
+            eof = not buf
+            continue
+        if in_array is None:
+            in_array = buf[pos] == '['
+            if in_array:
+                pos += 1
+                continue
+        if in_array and buf[pos] == ']':
+            in_array = False
+            pos += 1
+            continue
+        try:
+            value, end = _JSON_DECODER.raw_decode(buf, pos)
+        except ValueError:
+            if eof:
+                raise
+            end = len(buf)
+        if not eof and (end == len(buf) or (not isinstance(value, (dict, list, basestring)) and \
+                _NUMBER_TAIL.match(buf, end))):
+            # possibly cut short by the end of the chunk, a number even before
+            # its fraction or exponent (a value as large as the buffer doubles
+            # the next read)
+            chunk = stream.read(max(chunk_size, len(buf) - pos))
+            buf = buf[pos:] + chunk
+            pos = 0
+            eof = not chunk
+            continue
+        yield value
+        pos = end
+    if in_array:
+        raise ValueError('unterminated JSON array')
+
+def iter_annotations(stream, chunk_size=1 << 16, lazy=False):
+    # Annotation objects of a JSON array, a single JSON object or JSON-lines
+    # (see Annotation.from_data for `lazy`)
+    for data in iter_json_values(stream, chunk_size):
+        yield Annotation.from_data(data, lazy=lazy)
+
+def iter_annotation_batches(filepath, batch_size=10000, lazy=False):
+    """
+    Reads the annotations file at `filepath` (see iter_json_values, or an
+    AnnotationCorpus) lazily, yielding lists of at most `batch_size`
+    Annotation objects.
+    """
+    if AnnotationCorpus.is_corpus(filepath):
+        corpus = AnnotationCorpus(filepath)
+        try:
+            for batch in corpus.iter_batches(batch_size):
+                yield batch
+        finally:
+            corpus.close()
+        return
+    with codecs.open(filepath, 'r', encoding='utf-8') as inp:
+        batch = []
+        for a in iter_annotations(inp, lazy=lazy):
+            batch.append(a)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+class AnnotationCorpus(object):
+    """
+    Memory-mapped binary file of annotations, written by build and read
+    back without parsing any JSON except each annotator once and each body
+    when it is first used. The file holds a short header followed by:
+        - the offsets of the records of the annotations (int32, n + 1)
+        - the records, runs of int32 values: the id, whether the id is an
+          integer, the target type, the timestamp, the annotator, then
+          the included and excluded specifiers and the error and warning
+          checks, each preceded by its count (a check is its code and
+          its count of specifiers, followed by the specifiers)
+        - the offsets and utf-8 bytes of the distinct strings (ids,
+          timestamps, annotators as JSON, specifiers that are not OTT ids),
+          which the records refer to by number
+        - the offsets and utf-8 bytes of the bodies, as JSON
+        - the annotation numbers ordered by id, for get
+    A specifier that is a non-negative int32 is stored as itself, any other
+    as -1 minus the number of its string. As the offsets are int32, the
+    records, the strings and the bodies can each take at most
+    MAX_SECTION_SIZE values or bytes (2 GB).
+    """
+    MAGIC = 'ANNCRP01'
+    MAX_SECTION_SIZE = (1 << 31) - 1
+    _HEADER = struct.Struct('<8sIIIII')
+    _CHECK_CODES = sorted(ReferenceCondition._CODE_TO_TYPE)
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self._file = open(filepath, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, n, num_strings, num_values, string_bytes, body_bytes = self._HEADER.unpack_from(self._map, 0)
+        if magic != self.MAGIC:
+            raise ValueError('"{}" is not an annotation corpus'.format(filepath))
+        offset = self._HEADER.size
+        self._record_offsets = _Int32Section(self._map, offset, n + 1)
+        offset += 4 * (n + 1)
+        self._records = _Int32Section(self._map, offset, num_values)
+        offset += 4 * num_values
+        # the string offsets are read into memory, as records refer to
+        # strings anywhere in the file
+        self._string_offsets = _Int32Section(self._map, offset, num_strings + 1).slice(0, num_strings + 1)
+        offset += 4 * (num_strings + 1)
+        self._string_start = offset
+        offset += string_bytes
+        self._body_offsets = _Int32Section(self._map, offset, n + 1)
+        offset += 4 * (n + 1)
+        self._body_start = offset
+        offset += body_bytes
+        self._by_id = _Int32Section(self._map, offset, n)
+        self._entities = {}
+
+    @staticmethod
+    def is_corpus(filepath):
+        with open(filepath, 'rb') as inp:
+            return inp.read(len(AnnotationCorpus.MAGIC)) == AnnotationCorpus.MAGIC
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('annotation index out of range')
+        start = self._record_offsets[i]
+        body = self._map[self._body_start + self._body_offsets[i]:self._body_start + self._body_offsets[i + 1]]
+        return self._annotation(self._records.slice(start, self._record_offsets[i + 1]), 0, body)
+
+    def __iter__(self):
+        for batch in self.iter_batches():
+            for a in batch:
+                yield a
+
+    def iter_batches(self, batch_size=10000):
+        # lists of at most batch_size annotations, in file order
+        for first in xrange(0, len(self), batch_size):
+            stop = min(first + batch_size, len(self))
+            offsets = self._record_offsets.slice(first, stop + 1)
+            records = self._records.slice(offsets[0], offsets[-1])
+            body_offsets = self._body_offsets.slice(first, stop + 1)
+            bodies = self._map[self._body_start + body_offsets[0]:self._body_start + body_offsets[-1]]
+            yield [self._annotation(records, offsets[j] - offsets[0], \
+                    bodies[body_offsets[j] - body_offsets[0]:body_offsets[j + 1] - body_offsets[0]]) \
+                    for j in xrange(len(offsets) - 1)]
+
+    def get(self, annotation_id, default=None):
+        # the annotation with the given _id (compared as text)
+        key = unicode(annotation_id)
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._id_string(self._by_id[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self._id_string(self._by_id[lo]) == key:
+            return self[self._by_id[lo]]
+        return default
+
+    def _id_string(self, i):
+        return self._string(self._records[self._record_offsets[i]])
+
+    def _string(self, i):
+        start = self._string_start
+        return codecs.utf_8_decode(self._map[start + self._string_offsets[i]:start + self._string_offsets[i + 1]])[0]
+
+    def _specifiers(self, values):
+        return tuple([_intern(v if v >= 0 else self._string(-1 - v)) for v in values])
+
+    def _annotation(self, r, p, body):
+        # the annotation whose record starts at r[p], with its body as JSON
+        strings = self._string
+        annotation_id = strings(r[p])
+        if r[p + 1]:
+            annotation_id = int(annotation_id)
+        target = ReferenceTarget(r[p + 2])
+        annotated_at = strings(r[p + 3])
+        entity = self._entities.get(r[p + 4])
+        if entity is None:
+            entity = self._entities[r[p + 4]] = Entity.from_data(json.loads(strings(r[p + 4])))
+        p += 5
+        n = r[p]
+        target._ids_to_include = self._specifiers(r[p + 1:p + 1 + n])
+        p += 1 + n
+        n = r[p]
+        target._ids_to_exclude = self._specifiers(r[p + 1:p + 1 + n])
+        p += 1 + n
+        for kind in ['_error_checks', '_warning_checks']:
+            checks = []
+            n = r[p]
+            p += 1
+            for j in xrange(n):
+                condition = ReferenceCondition.get_type_from_code(self._CHECK_CODES[r[p]])
+                m = r[p + 1]
+                checks.append(condition(*self._specifiers(r[p + 2:p + 2 + m])))
+                p += 2 + m
+            setattr(target, kind, tuple(checks))
+        return Annotation._restore(annotation_id, target, annotated_at, entity, body)
+
+    def write_json(self, out):
+        # the annotations as JSON-lines, see iter_json_values
+        for a in self:
+            out.write(json.dumps(a.to_json()) + '\n')
+
+    @classmethod
+    def build(cls, annotations, filepath):
+        """
+        Writes the Annotation objects of the iterable `annotations` (as given
+        by their to_json) to a corpus at `filepath` and returns it opened.
+        Raises ValueError as soon as a section of the corpus outgrows
+        MAX_SECTION_SIZE, before the remaining annotations are read.
+        """
+        strings = {}
+        string_list = []
+        string_offsets = array('i', [0])
+        def ref(s):
+            i = strings.get(s)
+            if i is None:
+                i = strings[s] = len(string_list)
+                string_list.append(s.encode('utf-8'))
+                check_size(string_offsets[-1] + len(string_list[-1]), 'bytes of distinct strings')
+                string_offsets.append(string_offsets[-1] + len(string_list[-1]))
+            return i
+        def check_size(size, what):
+            if size > cls.MAX_SECTION_SIZE:
+                raise ValueError('the {} of the annotations pass {}, the limit of the int32 offsets of an ' \
+                        'annotation corpus; split the annotations into several corpora'.format(what, \
+                        cls.MAX_SECTION_SIZE))
+        def specifier(v):
+            if type(v) in (int, long) and 0 <= v < 1 << 31:
+                return v
+            if not isinstance(v, basestring):
+                raise ValueError('cannot store the specifier {} in an annotation corpus'.format(json.dumps(v)))
+            return -1 - ref(v)
+        check_codes = dict((c, i) for i, c in enumerate(cls._CHECK_CODES))
+
+        record_offsets = array('i', [0])
+        records = array('i')
+        body_offsets = array('i', [0])
+        bodies = []
+        id_refs = []
+        for a in annotations:
+            d = a.to_json()
+            target = d['oa:hasTarget']
+            id_refs.append(ref(unicode(d['_id'])))
+            records.extend([id_refs[-1], not isinstance(d['_id'], basestring), \
+                    TargetType.to_code(target['type']), ref(d['oa:annotatedAt']), \
+                    ref(json.dumps(d['oa:annotatedBy'], sort_keys=True))])
+            for k in ['included_ids', 'excluded_ids']:
+                records.append(len(target[k]))
+                records.extend([specifier(v) for v in target[k]])
+            for k in ['error_checks', 'warning_checks']:
+                records.append(len(target[k]))
+                for check in target[k]:
+                    records.extend([check_codes[check[0]], len(check) - 1])
+                    records.extend([specifier(v) for v in check[1:]])
+            check_size(len(records), 'record values')
+            record_offsets.append(len(records))
+            bodies.append(json.dumps(d['oa:hasBody']))
+            check_size(body_offsets[-1] + len(bodies[-1]), 'bytes of bodies')
+            body_offsets.append(body_offsets[-1] + len(bodies[-1]))
+        strings.clear()
+
+        by_id = array('i', sorted(xrange(len(id_refs)), key=lambda i: string_list[id_refs[i]].decode('utf-8')))
+
+        with open(filepath, 'wb') as out:
+            out.write(cls._HEADER.pack(cls.MAGIC, len(id_refs), len(string_list), len(records), \
+                    string_offsets[-1], body_offsets[-1]))
+            for section in [record_offsets, records, string_offsets, string_list, body_offsets, bodies, by_id]:
+                if type(section) is list:
+                    out.write(''.join(section))
+                    continue
+                if sys.byteorder == 'big':
+                    section.byteswap()
+                section.tofile(out)
+        return cls(filepath)
+
+_REASON_TEXT = [Reason.to_str(c) for c in xrange(4)]
+
+class TableWriter(object):
+    """
+    Streams the rows of placement tables (see TargetTree.iter_table_rows)
+    to `out` in the tab-separated layout of TargetTree.write_table. Rows are
+    encoded a tree at a time and written once buffer_size bytes are waiting.
+    With tree_column every row starts with the index of its tree.
+    """
+    COLUMNS = ['type', 'target_id', 'annotation_id', 'reason']
+
+    def __init__(self, out, tree_column=False, header=True, buffer_size=1 << 20):
+        self._out = out
+        self.tree_column = tree_column
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+        if header:
+            self.write_chunk(self.header())
+
+    def header(self):
+        return '\t'.join((['tree'] if self.tree_column else []) + self.COLUMNS) + '\n'
+
+    @staticmethod
+    def encode(rows, tree_index=None):
+        # the rows as a chunk for write_chunk (also used by worker processes)
+        prefix = '' if tree_index is None else '{}\t'.format(tree_index)
+        reasons = _REASON_TEXT
+        return ''.join([prefix + kind + '\t' + target_id + '\t' + annotation_id + '\t' + reasons[reason] + '\n' \
+                for kind, target_id, annotation_id, reason in rows])
+
+    def write_rows(self, rows, tree_index=None):
+        self.write_chunk(self.encode(rows, tree_index))
+
+    def write_chunk(self, chunk):
+        self._buffer.append(chunk)
+        self._buffered += len(chunk)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._out.write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def close(self):
+        self.flush()
+        self._out.close()
+
+class ColumnarTableWriter(TableWriter):
+    """
+    A TableWriter of binary column files, for analytics. After the magic
+    and whether there is a tree column, every chunk is a block of rows: its
+    size in bytes and number of rows, then the columns - the tree (int32,
+    if any), the type and reason codes (uint8, see KINDS and Reason) and
+    the target and annotation ids (int32 offsets, n + 1, and utf-8 bytes).
+    Blocks do not refer to each other, so workers can encode them.
+    """
+    MAGIC = 'PLCTAB01'
+    KINDS = ['node', 'edge', 'NA']
+    _HEADER = struct.Struct('<8sB')
+    _BLOCK = struct.Struct('<II')
+
+    def header(self):
+        return self._HEADER.pack(self.MAGIC, self.tree_column)
+
+    @staticmethod
+    def encode(rows, tree_index=None):
+        rows = list(rows)
+        kind_codes = dict((k, i) for i, k in enumerate(ColumnarTableWriter.KINDS))
+        columns = []
+        if tree_index is not None:
+            columns.append(array('i', [tree_index]) * len(rows))
+        columns.append(array('B', [kind_codes[r[0]] for r in rows]))
+        columns.append(array('B', [r[3] for r in rows]))
+        for j in [1, 2]:
+            values = [r[j] for r in rows]
+            offsets = array('i', [0])
+            total = 0
+            for v in values:
+                total += len(v)
+                offsets.append(total)
+            columns.extend([offsets, ''.join(values)])
+        if sys.byteorder == 'big':
+            for c in columns:
+                if type(c) is array:
+                    c.byteswap()
+        body = ''.join([c if type(c) is str else c.tostring() for c in columns])
+        return ColumnarTableWriter._BLOCK.pack(len(body), len(rows)) + body
+
+    @staticmethod
+    def iter_columns(inp, tree_column):
+        # the columns of each block of a column file, read from after the header
+        block = ColumnarTableWriter._BLOCK
+        while True:
+            head = inp.read(block.size)
+            if not head:
+                return
+            size, n = block.unpack(head)
+            data = inp.read(size)
+            p = 0
+            columns = {}
+            if tree_column:
+                columns['tree'] = _read_array('i', data, p, n)
+                p += 4 * n
+            for name in ['type', 'reason']:
+                columns[name] = _read_array('B', data, p, n)
+                p += n
+            for name in ['target_id', 'annotation_id']:
+                offsets = _read_array('i', data, p, n + 1)
+                p += 4 * (n + 1)
+                columns[name] = [data[p + offsets[j]:p + offsets[j + 1]] for j in xrange(n)]
+                p += offsets[-1]
+            yield n, columns
+
+def _read_array(typecode, data, p, n):
+    a = array(typecode)
+    a.fromstring(data[p:p + a.itemsize * n])
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+TABLE_FORMATS = {'tsv': TableWriter, 'columns': ColumnarTableWriter}
+
+def open_table_writer(filepath, table_format='tsv', tree_column=False, compress=None):
+    """
+    A TableWriter (by default) or ColumnarTableWriter of a new table at
+    `filepath`, gzipped if `compress` is True or, by default, if the name
+    ends in ".gz".
+    """
+    if compress is None:
+        compress = filepath.endswith('.gz')
+    out = gzip.GzipFile(filepath, 'wb') if compress else open(filepath, 'wb')
+    return TABLE_FORMATS[table_format](out, tree_column=tree_column)
+
+def _open_table(filepath):
+    with open(filepath, 'rb') as inp:
+        gzipped = inp.read(2) == '\x1f\x8b'
+    return gzip.GzipFile(filepath, 'rb') if gzipped else open(filepath, 'rb')
+
+def read_table(filepath):
+    """
+    The rows of a table written by TargetTree.write_table or a table writer
+    of any format, gzipped or not, as tuples of their tab-separated fields
+    (without the header).
+    """
+    with _open_table(filepath) as inp:
+        magic = inp.read(len(ColumnarTableWriter.MAGIC))
+        if magic != ColumnarTableWriter.MAGIC:
+            line = magic + inp.readline()
+            if line and not (line.startswith('type\t') or line.startswith('tree\ttype\t')):
+                yield tuple(line.rstrip('\r\n').split('\t'))
+            for line in inp:
+                yield tuple(line.rstrip('\r\n').split('\t'))
+            return
+        tree_column = bool(ord(inp.read(1)))
+        kinds = ColumnarTableWriter.KINDS
+        for n, c in ColumnarTableWriter.iter_columns(inp, tree_column):
+            rows = zip([kinds[k] for k in c['type']], c['target_id'], c['annotation_id'], \
+                    [_REASON_TEXT[r] for r in c['reason']])
+            if tree_column:
+                rows = [(str(t),) + r for t, r in zip(c['tree'], rows)]
+            for r in rows:
+                yield r
+
+def read_table_columns(filepath):
+    """
+    The columns of a column file (see ColumnarTableWriter), gzipped or not,
+    by name: arrays of the tree indexes and of the type and reason codes,
+    and lists of the target and annotation ids.
+    """
+    with _open_table(filepath) as inp:
+        magic, tree_column = ColumnarTableWriter._HEADER.unpack(inp.read(ColumnarTableWriter._HEADER.size))
+        if magic != ColumnarTableWriter.MAGIC:
+            raise ValueError('"{}" is not a column file'.format(filepath))
+        columns = {'type': array('B'), 'reason': array('B'), 'target_id': [], 'annotation_id': []}
+        if tree_column:
+            columns['tree'] = array('i')
+        for n, block in ColumnarTableWriter.iter_columns(inp, tree_column):
+            for name, values in block.iteritems():
+                columns[name].extend(values)
+    return columns
+
+# state of a worker process of annotate_trees_in_parallel,
+# TargetTree.add_phyloreferenced_annotations_in_shards or validate_annotations
+_TREE_WORKER = {}
+
+def _worker_name_converter(name_converter):
+    if name_converter is not None:
+        # the SQLite connection of the parent process can not be shared;
+        # expansions that were not prefetched are fetched from taxomachine
+        name_converter._expansion_cache = None
+    return name_converter
+
+def _init_tree_worker(annotations, use_taxonomy, name_converter, stream_parse=False, table_writer=TableWriter):
+    _TREE_WORKER['table_writer'] = table_writer
+    _TREE_WORKER['annotations'] = annotations
+    _TREE_WORKER['use_taxonomy'] = use_taxonomy
+    _TREE_WORKER['name_converter'] = _worker_name_converter(name_converter)
+    _TREE_WORKER['stream_parse'] = stream_parse
+
+def _annotate_tree_statement(job):
+    tree_index, newick = job
+    annotations = _TREE_WORKER['annotations']
+    tree = make_target_tree(newick, use_taxonomy=_TREE_WORKER['use_taxonomy'], \
+            name_converter=_TREE_WORKER['name_converter'], stream_parse=_TREE_WORKER['stream_parse'])
+    tree.add_phyloreferenced_annotations(annotations)
+    out_tree = StringIO()
+    tree.write_labeled_tree(out_tree)
+    rows = _TREE_WORKER['table_writer'].encode(tree.iter_table_rows(), tree_index)
+
+    # do not keep every tree alive through the annotations
+    for a in annotations:
+        del a.applied_to[:]
+    return out_tree.getvalue(), rows
+
+def _pack_outcome(annotation, r):
+    # a MappingOutcome as plain data: the target by its preorder number and
+    # the checks by their position in the lists of the annotation target
+    target = -1
+    on_edge = False
+    if r.attached_to is not None:
+        on_edge = hasattr(r.attached_to, 'head_node')
+        target = getattr(r.attached_to, 'head_node', r.attached_to).preorder_index
+    errors = [j for j, c in enumerate(annotation.target.error_checks) if c in r.failed_error_checks]
+    warnings = [j for j, c in enumerate(annotation.target.warning_checks) if c in r.failed_warning_checks]
+    return (r.reason_code, target, on_edge, r.missing_inc, r.missing_exc, errors, warnings)
+
+def _init_shard_worker(index_filepath, annotations, use_taxonomy, name_converter):
+    tree = IndexedTargetTree(TreeIndex.load(index_filepath), use_taxonomy=use_taxonomy, \
+            name_converter=_worker_name_converter(name_converter), attach=False)
+    _TREE_WORKER['tree'] = tree
+    _TREE_WORKER['annotations'] = annotations
+
+def _map_annotation_shard(shard):
+    start, stop = shard
+    annotations = _TREE_WORKER['annotations'][start:stop]
+    outcomes = _TREE_WORKER['tree'].add_phyloreferenced_annotations(annotations)
+    return start, [_pack_outcome(a, r) for a, r in zip(annotations, outcomes)]
+
+def annotate_trees_in_parallel(tree_filename, annotations, out_tree_file_path, out_table_file_path,
+        use_taxonomy=True, name_converter=None, workers=2, stream_parse=False, table_format='tsv'):
+    """
+    Maps the annotations onto every tree of a newick file using a pool of
+    `workers` processes, each of which parses and annotates whole trees
+    (one target tree per tree, see make_target_tree). The labeled trees are written to
+    out_tree_file_path in input order, and all placements to a single table
+    (see open_table_writer) whose first column is the index of the tree in
+    the file; the workers encode the rows.
+    Returns the number of trees annotated.
+    """
+    import multiprocessing
+    pool = multiprocessing.Pool(workers, _init_tree_worker, (annotations, use_taxonomy, name_converter, \
+            stream_parse, TABLE_FORMATS[table_format]))
+    num_trees = 0
+    try:
+        with open(tree_filename) as inp, open(out_tree_file_path, 'w') as out_tree_file:
+            table = open_table_writer(out_table_file_path, table_format, tree_column=True)
+            try:
+                jobs = enumerate(iter_newick_statements(inp))
+                for labeled_tree, rows in pool.imap(_annotate_tree_statement, jobs):
+                    out_tree_file.write(labeled_tree)
+                    table.write_chunk(rows)
+                    num_trees += 1
+            finally:
+                table.close()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return num_trees
+
+def resolutions_path(table_filepath):
+    # the file written next to a table by main(write_resolutions=True)
+    return table_filepath + '.resolved'
+
+def main(tree_filename, annotations_filename, out_tree_file_path, out_table_file_path, use_taxonomy=True,
+        taxonomy_index=None, expansion_cache=None, prefetch_workers=8, workers=1, shard_annotations=False,
+        tree_index_dir=None, stream_parse=False, previous_tree_filename=None, previous_table_filename=None,
+        induced_subtree=False, annotation_batch_size=10000, placement_cache=None, table_format='tsv',
+        write_resolutions=False, lazy_annotations=False):
     
-    # get the trees
+    # get the trees (when annotating trees in parallel the workers parse them,
+    # with a tree_index_dir only trees without a saved index are parsed, with
+    # stream_parse or induced_subtree they are parsed one at a time by
+    # TreeIndex.from_newick)
     if not os.path.exists(tree_filename):
         raise ValueError('tree file "{}" does not exist'.format(tree_filename))
-    tree_list = dendropy.TreeList.get_from_path(tree_filename,'newick',
-            suppress_internal_node_taxa=False)
-    if len(tree_list) < 1:
-        sys.stderr.write('No trees in input list.')
-        return False
+    if placement_cache is not None and (workers > 1 or shard_annotations or previous_tree_filename is not None or \
+            induced_subtree):
+        raise ValueError('the placement cache is only used when the trees are mapped one at a time in this ' \
+                'process, not with workers, shard_annotations, a previous tree or induced_subtree')
+    tree_list = None
+    if induced_subtree:
+        if previous_tree_filename is not None:
+            raise ValueError('remapping from a previous tree needs the whole tree')
+        if workers > 1:
+            raise ValueError('the induced subtree is mapped in this process, not with workers')
+        stream_parse = True
+    if (tree_index_dir is not None or stream_parse) and (workers <= 1 or shard_annotations):
+        with open(tree_filename) as inp:
+            tree_list = list(iter_newick_statements(inp))
+        if len(tree_list) < 1:
+            sys.stderr.write('No trees in input list.')
+            return False
+    elif workers <= 1 or shard_annotations:
+        tree_list = dendropy.TreeList.get_from_path(tree_filename,'newick',
+                suppress_internal_node_taxa=False)
+        if len(tree_list) < 1:
+            sys.stderr.write('No trees in input list.')
+            return False
+    if previous_tree_filename is not None and (tree_list is None or len(tree_list) != 1):
+        raise ValueError('remapping from a previous tree needs a single input tree')
+    if previous_tree_filename is not None and not os.path.exists(resolutions_path(previous_table_filename)):
+        raise ValueError('"{}" does not exist; map the previous tree with --write-resolutions'.format( \
+                resolutions_path(previous_table_filename)))
+    if write_resolutions and (tree_list is None or len(tree_list) != 1):
+        raise ValueError('writing resolutions needs a single input tree, mapped in this process')
 
-    # get the annotations
-    a_f = codecs.open(annotations_filename, 'rU', encoding='utf-8')
-    annot_list = json.load(a_f)
-    if not isinstance(annot_list, list):
-        annot_list = [annot_list]
-    annotations = []
-    for a in annot_list:
-        annotations.append(Annotation.from_data(a))
-
-    # annotate the trees
-    for tree_index, t in enumerate(tree_list):
-        tree = TargetTree(t, use_taxonomy=use_taxonomy)
-        for a in annotations:
-#            debug(a.summary)
-            tree.add_phyloreferenced_annotation(a)
+    # get the annotations (when the trees are mapped one at a time in this
+    # process they are instead read in batches of annotation_batch_size for
+    # every tree, see iter_annotation_batches); mapping only uses the
+    # targets, so with lazy_annotations the rest of every annotation is
+    # only validated when it is used (see Annotation.from_data)
+    annotations = None
+    if tree_list is None or previous_tree_filename is not None or induced_subtree or \
+            (shard_annotations and workers > 1):
+        annotations = [a for batch in iter_annotation_batches(annotations_filename, lazy=lazy_annotations) \
+                for a in batch]
+
+    # one converter for all trees, so expansions are shared between them
+    name_converter = None
+    if use_taxonomy:
+        name_converter = OTTNameConverter(taxonomy_index=taxonomy_index, expansion_cache=expansion_cache)
+        if prefetch_workers > 0 and annotations is not None:
+            name_converter.prefetch(collect_specifiers(annotations), max_workers=prefetch_workers)
+
+    # the previous version of the tree, whose placements are carried forward
+    previous = None
+    if previous_tree_filename is not None:
+        with open(previous_tree_filename) as inp:
+            previous_list = list(iter_newick_statements(inp))
+        if len(previous_list) != 1:
+            raise ValueError('previous tree file "{}" must hold a single tree'.format(previous_tree_filename))
+        if tree_index_dir is not None:
+            previous = load_target_tree(previous_list[0], tree_index_dir, use_taxonomy=use_taxonomy, \
+                    name_converter=name_converter, stream_parse=stream_parse)
+        else:
+            previous = make_target_tree(previous_list[0], use_taxonomy=use_taxonomy, \
+                    name_converter=name_converter, stream_parse=stream_parse)
+
+    if tree_list is None:
+        if annotate_trees_in_parallel(tree_filename, annotations, out_tree_file_path, out_table_file_path,
+                use_taxonomy=use_taxonomy, name_converter=name_converter, workers=workers, \
+                stream_parse=stream_parse, table_format=table_format) < 1:
+            sys.stderr.write('No trees in input list.')
+            return False
+        return True
+
+    # annotate the trees (with several trees all of them are written, and the
+    # table gets a leading tree index column as when annotating in parallel)
+    tree_column = len(tree_list) > 1
+    out_tree_file = open(out_tree_file_path, 'w')
+    table = open_table_writer(out_table_file_path, table_format, tree_column=tree_column)
+    try:
+        for tree_index, t in enumerate(tree_list):
+            if tree_index_dir is not None:
+                tree = load_target_tree(t, tree_index_dir, use_taxonomy=use_taxonomy, name_converter=name_converter, \
+                        stream_parse=stream_parse)
+            elif stream_parse:
+                tree = make_target_tree(t, use_taxonomy=use_taxonomy, name_converter=name_converter, stream_parse=True)
+            else:
+                tree = TargetTree(t, use_taxonomy=use_taxonomy, split_encoding=SplitEncoding.HASH, \
+                        name_converter=name_converter)
+            whole_tree = tree
+            if induced_subtree:
+                tree = tree.induced_tree(annotations)
+            if previous is not None:
+                with open(resolutions_path(previous_table_filename)) as inp:
+                    tree.remap_from_previous(annotations, previous, read_table(previous_table_filename), inp, \
+                            table_name='"{}"'.format(previous_table_filename))
+                debug('carried {c} of {n} placements forward from the previous tree'.format( \
+                        c=tree.number_annotations_carried_forward, n=len(annotations)))
+            elif shard_annotations and workers > 1:
+                tree.add_phyloreferenced_annotations_in_shards(annotations, workers=workers)
+            elif annotations is not None:
+                tree.add_phyloreferenced_annotations(annotations)
+            else:
+                tree_key = tree.index.content_hash() if placement_cache is not None else None
+                for batch in iter_annotation_batches(annotations_filename, annotation_batch_size, \
+                        lazy=lazy_annotations):
+                    if placement_cache is not None:
+                        tree.add_phyloreferenced_annotations_cached(batch, placement_cache, tree_key, \
+                                prefetch_workers=prefetch_workers)
+                        continue
+                    if name_converter is not None and prefetch_workers > 0:
+                        name_converter.prefetch(collect_specifiers(batch), max_workers=prefetch_workers)
+                    tree.add_phyloreferenced_annotations(batch)
+                if placement_cache is not None:
+                    debug('placement cache: {c} of {n} placements reused'.format(c=tree.number_annotations_from_cache, \
+                            n=tree.number_annotations_tried))
 
-        # report tree and annotations
-        with open(out_tree_file_path,"w") as out_tree_file: 
+            # report tree and annotations
             tree.write_labeled_tree(out_tree_file)
-        with open(out_table_file_path,"w") as out_table_file:
-            tree.write_table(out_table_file)
+            table.write_rows(tree.iter_table_rows(), tree_index if tree_column else None)
+            if write_resolutions:
+                with open(resolutions_path(out_table_file_path), 'w') as out:
+                    tree.write_resolutions(out)
+            whole_tree.close()
+    finally:
+        table.close()
+        out_tree_file.close()
+        if previous is not None:
+            previous.close()
 
 class Tests(unittest.TestCase):
 
@@ -1007,7 +4280,705 @@ class Tests(unittest.TestCase):
         out = tuple(out)
         self.failUnless(out == (("target_id","annotation_id"),("770319","3"),("770319","4"), \
                 ("770319","5"),("770319","6"),("NA","1"),("NA","2")))
-    
+
+    @staticmethod
+    def random_newick(ntax):
+        # join random pairs of subtrees until only the root is left
+        subtrees = ['t' + str(i) for i in range(ntax)]
+        while len(subtrees) > 1:
+            for i in [-1, -2]:
+                j = random.randrange(len(subtrees))
+                subtrees[i], subtrees[j] = subtrees[j], subtrees[i]
+            b = subtrees.pop()
+            a = subtrees.pop()
+            subtrees.append('(' + a + ',' + b + ')')
+        return '[&R] ' + subtrees[0] + ';'
+
+    def test_indexed_mrca(self):
+        t = dendropy.Tree.get_from_string(Tests.random_newick(300), 'newick')
+        tree = TargetTree(t, use_taxonomy=False)
+        taxa = list(t.taxon_namespace)
+        for i in range(300):
+            q = random.sample(taxa, random.randrange(1, 10))
+            self.failUnless(tree.get_mrca(q) is t.mrca(taxa=q))
+
+        # internal node taxa are their own mrca with any of their descendants
+        t = dendropy.Tree.get_from_string('[&R] ((a,b)x,(c,(d,e)));', 'newick',
+                suppress_internal_node_taxa=False)
+        tree = TargetTree(t, use_taxonomy=False)
+        x = t.find_node_with_taxon_label('x')
+        for labels in [['x'], ['x', 'a'], ['a', 'b'], ['b', 'x', 'a']]:
+            self.failUnless(tree.get_mrca([t.taxon_namespace.get_taxon(l) for l in labels]) is x)
+        self.failUnless(tree.get_mrca([t.taxon_namespace.get_taxon(l) for l in ['x', 'e']]) is t.seed_node)
+
+    def test_batch_lca(self):
+        t = dendropy.Tree.get_from_string(Tests.random_newick(200), 'newick')
+        index = TargetTree(t, use_taxonomy=False).index
+        n = len(index)
+        pairs = [(random.randrange(n), random.randrange(n)) for i in range(2000)]
+        self.failUnless(list(index.batch_lca(pairs)) == [index.lca(a, b) for a, b in pairs])
+
+    @staticmethod
+    def random_annotations(labels, num_annotations):
+        annotations = []
+        for i in range(num_annotations):
+            a = Annotation(i)
+            a.target = ReferenceTarget.from_data({
+                "type": random.choice(["node", "branch"]),
+                "included_ids": random.sample(labels, random.randrange(1, 6)) + ['missing'],
+                "excluded_ids": random.sample(labels, random.randrange(0, 3)),
+                "error_checks": [["TARGET_EXCLUDES"] + random.sample(labels, 1)] * random.randrange(2),
+                "warning_checks": [["REQUIRE_MONOPHYLETIC"] + random.sample(labels, 2)] * random.randrange(2),
+            })
+            annotations.append(a)
+        return annotations
+
+    @staticmethod
+    def outcome_results(tree, outcomes):
+        # what the tests compare of mapping outcomes: the reason, the target
+        # (by its id in the output, and whether it is an edge), the failed
+        # checks and the specifiers that were not in the tree
+        return [(r.reason_code, r.attached_to and tree.get_node_out_id(getattr(r.attached_to, 'head_node', r.attached_to)), \
+                isinstance(r.attached_to, (dendropy.Edge, IndexedEdge)), [c.explain() for c in r.failed_error_checks], \
+                [c.explain() for c in r.failed_warning_checks], r.missing_inc, r.missing_exc) for r in outcomes]
+
+    def test_bulk_annotation_matches_single(self):
+        newick = Tests.random_newick(100)
+        labels = ['t' + str(i) for i in range(100)]
+        annotations = Tests.random_annotations(labels, 300)
+        results = []
+        for bulk in [False, True]:
+            t = dendropy.Tree.get_from_string(newick, 'newick')
+            tree = TargetTree(t, use_taxonomy=False)
+            if bulk:
+                outcomes = tree.add_phyloreferenced_annotations(annotations)
+            else:
+                outcomes = [tree.add_phyloreferenced_annotation(a) for a in annotations]
+            results.append(Tests.outcome_results(tree, outcomes))
+        self.failUnless(results[0] == results[1])
+
+    def test_duplicate_targets(self):
+        newick = Tests.random_newick(100)
+        labels = ['t' + str(i) for i in range(100)]
+        annotations = Tests.random_annotations(labels, 100)
+        for a in annotations[::2]:
+            a.target.add_error_condition(MonophylyCondition(*random.sample(labels, 2)))
+        for i in range(200):
+            # an equal (but not the same) target
+            a = Annotation(100 + i)
+            a.target = ReferenceTarget.from_data(random.choice(annotations[:100]).target.to_json())
+            annotations.append(a)
+        random.shuffle(annotations)
+        results = []
+        for bulk in [False, True]:
+            tree = TargetTree(dendropy.Tree.get_from_string(newick, 'newick'), use_taxonomy=False, \
+                    split_encoding=SplitEncoding.INTERVAL)
+            found = []
+            find_target = tree.find_target
+            tree.find_target = lambda a, mrca=None: found.append(a) or find_target(a, mrca)
+            if bulk:
+                outcomes = tree.add_phyloreferenced_annotations(annotations)
+                self.failUnless(len(found) == len(set(a.target.key() for a in annotations)) <= 100)
+            else:
+                outcomes = [tree.add_phyloreferenced_annotation(a) for a in annotations]
+            for a, r in zip(annotations, outcomes):
+                for c in r.failed_error_checks + r.failed_warning_checks:
+                    self.failUnless(any(c is x for x in a.target.error_checks + a.target.warning_checks))
+            results.append(Tests.outcome_results(tree, outcomes))
+            self.failUnless(tree.number_annotations_tried == len(annotations))
+        self.failUnless(results[0] == results[1])
+
+    def test_check_engine_matches_single(self):
+        labels = ['t' + str(i) for i in range(100)]
+        annotations = Tests.random_annotations(labels, 300)
+        for a in annotations[::3]:
+            # monophyletic pairs of tips, and a whole tree
+            a.target.add_error_condition(MonophylyCondition(*random.sample(labels, 2)))
+            a.target.add_warning_condition(MonophylyCondition(*labels))
+        for rooting in ['[&R] ', '[&U] ']:
+            newick = rooting + Tests.random_newick(100)[5:]
+            results = []
+            for bulk in [False, True]:
+                t = dendropy.Tree.get_from_string(newick, 'newick')
+                tree = TargetTree(t, use_taxonomy=False, split_encoding=SplitEncoding.INTERVAL)
+                if bulk:
+                    outcomes = tree.add_phyloreferenced_annotations(annotations)
+                else:
+                    outcomes = [tree.add_phyloreferenced_annotation(a) for a in annotations]
+                results.append(Tests.outcome_results(tree, outcomes))
+            self.failUnless(results[0] == results[1])
+
+    def test_incremental_annotation(self):
+        newick = Tests.random_newick(100)
+        labels = ['t' + str(i) for i in range(100)]
+        annotations = Tests.random_annotations(labels, 200)
+        edited = Tests.random_annotations(labels, 20)
+        def table(tree):
+            out = StringIO()
+            tree.write_table(out)
+            return out.getvalue()
+        for stream_parse in [False, True]:
+            tree = make_target_tree(newick, use_taxonomy=False, stream_parse=stream_parse)
+            tree.add_phyloreferenced_annotations(annotations)
+            for a in annotations[::2]:
+                self.failUnless(tree.remove_annotation(a.id) is not None)
+            self.failUnless(tree.remove_annotation('no such id') is None)
+            for a, b in zip(annotations[1::10], edited):
+                b.id = a.id
+                tree.update_annotation(b)
+            kept = dict((b.id, b) for b in edited)
+            expected_annotations = [a for a in annotations[1::2] if a.id not in kept] + edited
+            expected = make_target_tree(newick, use_taxonomy=False, stream_parse=stream_parse)
+            expected.add_phyloreferenced_annotations(expected_annotations)
+            self.failUnless(tree.number_annotations_tried == len(expected_annotations))
+            self.failUnless(tree.number_annotations_added == expected.number_annotations_added)
+            self.failUnless(sorted(table(tree).splitlines()) == sorted(table(expected).splitlines()))
+            self.failUnless(all(len(a.applied_to) == 0 for a in annotations[::2]))
+
+            # annotations that share an id are all placed, until one of
+            # them is updated
+            tree = make_target_tree(newick, use_taxonomy=False, stream_parse=stream_parse)
+            copies = [Annotation.from_data(annotations[1].to_json()) for i in range(6)]
+            tree.add_phyloreferenced_annotations(copies[:3])
+            for a in copies[3:]:
+                tree.add_phyloreferenced_annotation(a)
+            self.failUnless(tree.number_annotations_tried == 6)
+            self.failUnless(len(table(tree).splitlines()) == 7)
+            tree.update_annotation(copies[0])
+            self.failUnless(tree.number_annotations_tried == 1)
+            self.failUnless(len(table(tree).splitlines()) == 2)
+            self.failUnless(all(len(a.applied_to) == 0 for a in copies[1:]))
+
+    def test_remap_from_previous(self):
+        labels = ['t' + str(i) for i in range(100)]
+        old_newick = Tests.random_newick(100)
+        # a new taxon above t3, one in the polytomy of t50 and t7 replaced by another
+        new_newick = re.sub(r'\bt3\b', '(t3,n1)', old_newick)
+        new_newick = re.sub(r'\bt50\b', 't50,n2', new_newick)
+        new_newick = re.sub(r'\bt7\b', 'n3', new_newick)
+        # and two tips swapped, which changes every clade between them
+        swapped = re.sub(r'\bt(10|20)\b', lambda m: 't20' if m.group(1) == '10' else 't10', new_newick)
+        annotations = Tests.random_annotations(labels + ['n1'], 300)
+        for a in annotations[::5]:
+            a.target.add_warning_condition(MonophylyCondition(*random.sample(labels, 2)))
+        for a in annotations[1::5]:
+            a.target.add_warning_condition(TargetExcludesCondition(*random.sample(labels, 2)))
+            a.target.add_warning_condition(MonophylyCondition(*random.sample(labels, 3)))
+        unrooted = ('[&U] ' + old_newick[5:], '[&U] ' + new_newick[5:])
+        for old, new, stream_parse in [(old_newick, new_newick, False), (old_newick, new_newick, True), \
+                (old_newick, swapped, True), unrooted + (True, )]:
+            previous = make_target_tree(old, use_taxonomy=False, stream_parse=stream_parse)
+            previous.add_phyloreferenced_annotations(annotations)
+            table = StringIO()
+            previous.write_table(table)
+            resolutions = StringIO()
+            previous.write_resolutions(resolutions)
+            for a in annotations:
+                del a.applied_to[:]
+
+            expected = make_target_tree(new, use_taxonomy=False, stream_parse=stream_parse)
+            expected_outcomes = expected.add_phyloreferenced_annotations(annotations)
+            tree = make_target_tree(new, use_taxonomy=False, stream_parse=stream_parse)
+            outcomes = tree.remap_from_previous(annotations, previous, StringIO(table.getvalue()), \
+                    StringIO(resolutions.getvalue()))
+            self.failUnless(Tests.outcome_results(tree, outcomes) == Tests.outcome_results(expected, expected_outcomes))
+            self.failUnless(tree.number_annotations_carried_forward < len(annotations))
+            self.failUnless(tree.number_annotations_carried_forward > 0 or new is swapped)
+            self.failUnless(tree.number_annotations_added == expected.number_annotations_added)
+
+        # a table with a tree column is not the table of one tree
+        table = StringIO()
+        previous.write_table(table, tree_index=0)
+        with self.assertRaises(ValueError):
+            tree.remap_from_previous(annotations, previous, StringIO(table.getvalue()), StringIO())
+
+        # nor is a table with a reason that write_table does not write
+        with self.assertRaises(ValueError) as e:
+            tree.remap_from_previous(annotations, previous, ['node\t1\t0\tsuccess\n', 'node\t1\t1\tlost\n'], \
+                    StringIO(), table_name='"old.tsv"')
+        self.failUnless(str(e.exception) == \
+                'row 2 of "old.tsv" (--previous-table), "node\t1\t1\tlost", has the unknown reason "lost"')
+
+        # a clade that gains a taxon in a polytomy keeps its split, but not its monophyly
+        diff = SplitDiff(TreeIndex.from_newick('((a,b),(c,d),e);'), TreeIndex.from_newick('((a,x,b),(c,(d,y)),e);'))
+        self.failUnless(diff.changed_taxa == set(['d', 'x', 'y']))
+        self.failUnless([diff.new_node(i) for i in [1, 4, 6]] == [1, 5, -1])
+
+    def test_induced_tree(self):
+        picked = random.sample(['t' + str(i) for i in range(300)], 20)
+        annotations = Tests.random_annotations(picked, 100)
+        for a in annotations[::4]:
+            a.target.add_warning_condition(MonophylyCondition(*random.sample(picked, 2)))
+            a.target.add_warning_condition(MonophylyCondition(*picked[:random.randrange(3, 20)]))
+        for rooting in ['[&R] ', '[&U] ']:
+            newick = rooting + Tests.random_newick(300)[5:]
+            full = make_target_tree(newick, use_taxonomy=False, stream_parse=True)
+            induced = full.induced_tree(annotations)
+            self.failUnless(len(induced.index) < len(full.index) // 2)
+            expected = full.add_phyloreferenced_annotations(annotations)
+            outcomes = induced.add_phyloreferenced_annotations(annotations)
+            self.failUnless(Tests.outcome_results(induced, outcomes) == Tests.outcome_results(full, expected))
+            out = []
+            for tree in [full, induced]:
+                o = StringIO()
+                tree.write_labeled_tree(o)
+                tree.write_table(o)
+                out.append(o.getvalue())
+            self.failUnless(out[0] == out[1])
+
+        # main does not silently drop the workers asked for
+        with open('tests/tree.tre', 'w') as out:
+            out.write(newick + ';\n')
+        with open('tests/annotations.jsonl', 'w') as out:
+            for a in annotations:
+                out.write(json.dumps(a.to_json()) + '\n')
+        with self.assertRaises(ValueError):
+            main('tests/tree.tre', 'tests/annotations.jsonl', 'tests/out-tree.tre', 'tests/out-table.tsv', \
+                    use_taxonomy=False, induced_subtree=True, workers=2)
+
+    def test_saved_tree_index(self):
+        t = dendropy.Tree.get_from_string(Tests.random_newick(200), 'newick')
+        index = TreeIndex(t)
+        index.save('tests/tree.idx', key='abc')
+        loaded = TreeIndex.load('tests/tree.idx')
+        self.failUnless(loaded.key == 'abc' and loaded.is_rooted == index.is_rooted)
+        for name in ['parent', 'depth', 'end', 'postorder', 'taxa_before', 'taxon_nodes', 'labels']:
+            self.failUnless(list(getattr(loaded, name)) == list(getattr(index, name)))
+        self.failUnless(loaded.label2node == index.label2node)
+        pairs = [(random.randrange(len(index)), random.randrange(len(index))) for i in range(100)]
+        self.failUnless([loaded.lca(a, b) for a, b in pairs] == [index.lca(a, b) for a, b in pairs])
+        self.failUnless(loaded.nodes[5].parent_node.preorder_index == index.parent[5])
+        loaded.close()
+
+    def test_stream_parse(self):
+        newicks = ["[&R] ((a_b:0.5,'c_d':1,(e,f)x_ott5:2.25)g:1e-05,(h,,i),(j,));",
+                "(('it''s',k),l:3)m:0.1;",
+                "[&U] (n,o,p);",
+                "q;",
+                '(' + Tests.random_newick(50)[:-1] + ',t50);']
+        for newick in newicks:
+            t = dendropy.Tree.get_from_string(newick, 'newick', suppress_internal_node_taxa=False)
+            expected = TargetTree(t, use_taxonomy=False)
+            parsed = make_target_tree(newick, use_taxonomy=False, stream_parse=True)
+            for name in ['parent', 'end', 'postorder', 'taxa_before', 'taxon_nodes', 'labels']:
+                self.failUnless(list(getattr(parsed.index, name)) == list(getattr(expected.index, name)))
+            self.failUnless(parsed.index.is_rooted == expected.index.is_rooted)
+            out = []
+            for tree in [expected, parsed]:
+                o = StringIO()
+                tree.write_labeled_tree(o)
+                out.append(o.getvalue())
+            self.failUnless(out[0] == out[1])
+
+        with self.assertRaises(ValueError):
+            TreeIndex.from_newick('((a,b),(a,c));')
+
+        # labels are converted to ott ids while parsing
+        parsed = make_target_tree("((a_ott1,'b ott2'),3);", name_converter=OTTNameConverter(), stream_parse=True)
+        self.failUnless(list(parsed.index.labels) == ['1', '2', '3'])
+
+    def test_persisted_tree_index(self):
+        newick = '[&R] ' + Tests.random_newick(100)[5:]
+        labels = ['t' + str(i) for i in range(100)]
+        annotations = Tests.random_annotations(labels, 200)
+        results = []
+        for expected_type in [TargetTree, IndexedTargetTree]:
+            tree = load_target_tree(newick, 'tests/indexes', use_taxonomy=False)
+            self.failUnless(type(tree) is expected_type)
+            tree.add_phyloreferenced_annotations(annotations)
+            out_tree = StringIO()
+            tree.write_labeled_tree(out_tree)
+            out_table = StringIO()
+            tree.write_table(out_table)
+            results.append((out_tree.getvalue(), out_table.getvalue()))
+            tree.close()
+            self.failUnless(getattr(tree.index, '_map', None) is None)
+        self.failUnless(results[0] == results[1])
+
+        # a truncated index is rebuilt
+        filepath = os.path.join('tests/indexes', tree_index_key(newick, False) + '.idx')
+        with open(filepath, 'r+b') as f:
+            f.truncate(os.path.getsize(filepath) - 1)
+        self.failUnless(type(load_target_tree(newick, 'tests/indexes', use_taxonomy=False)) is TargetTree)
+        self.failUnless(type(load_target_tree(newick, 'tests/indexes', use_taxonomy=False)) is IndexedTargetTree)
+
+    def test_sharded_annotation(self):
+        newick = Tests.random_newick(100)
+        labels = ['t' + str(i) for i in range(100)]
+        annotations = Tests.random_annotations(labels, 300)
+        results = []
+        for sharded in [False, True]:
+            tree = TargetTree(dendropy.Tree.get_from_string(newick, 'newick'), use_taxonomy=False)
+            if sharded:
+                outcomes = tree.add_phyloreferenced_annotations_in_shards(annotations, workers=2)
+            else:
+                outcomes = tree.add_phyloreferenced_annotations(annotations)
+            out = StringIO()
+            tree.write_table(out)
+            results.append((out.getvalue(), Tests.outcome_results(tree, outcomes)))
+        self.failUnless(results[0] == results[1])
+
+    def test_newick_statements(self):
+        text = "[&R] ((a,'b;c'),d)[x;y];\n\n(e,f);\n(g,h)"
+        self.failUnless(list(iter_newick_statements(StringIO(text), chunk_size=3)) == \
+                ["[&R] ((a,'b;c'),d)[x;y];", "(e,f);", "(g,h);"])
+
+    def test_streamed_annotations(self):
+        self.failUnless(list(iter_json_values(StringIO(' [1, {"a": "],["}, [2,3] ,4] '), chunk_size=2)) == \
+                [1, {'a': '],['}, [2, 3], 4])
+        for text in ['[12.5, 3, -0.25e-3,1E+2 ,7]', '12.5\n3e2\n-1.5E-10 4\n', '[[1.5], 2.5e1]']:
+            expected = json.loads(text) if text[0] == '[' else [json.loads(v) for v in text.split()]
+            for chunk_size in range(1, len(text) + 1):
+                self.failUnless(list(iter_json_values(StringIO(text), chunk_size=chunk_size)) == expected)
+        newick = Tests.random_newick(50)
+        labels = ['t' + str(i) for i in range(50)]
+        annotations = Tests.random_annotations(labels, 40)
+        with open('tests/tree.tre', 'w') as out:
+            out.write(newick + '\n')
+        with open('tests/annotations.json', 'w') as out:
+            json.dump([a.to_json() for a in annotations], out, indent=1)
+        with open('tests/annotations.jsonl', 'w') as out:
+            for a in annotations:
+                out.write(json.dumps(a.to_json()) + '\n')
+        with open('tests/annotations.jsonl') as inp:
+            streamed = list(iter_annotations(inp, chunk_size=7))
+        self.failUnless([a.to_json() for a in streamed] == [a.to_json() for a in annotations])
+        tables = []
+        for name, batch_size in [('annotations.json', 10000), ('annotations.jsonl', 10000), ('annotations.jsonl', 3)]:
+            main('tests/tree.tre', 'tests/' + name, 'tests/out-tree.tre', 'tests/out-table.tsv', \
+                    use_taxonomy=False, annotation_batch_size=batch_size)
+            with open('tests/out-table.tsv') as inp:
+                tables.append(inp.read())
+        self.failUnless(len(set(tables)) == 1)
+
+    def test_parallel_tree_annotation(self):
+        labels = ['t' + str(i) for i in range(30)]
+        newicks = [Tests.random_newick(30) for i in range(5)]
+        annotations = Tests.random_annotations(labels, 60)
+        with open('tests/trees.tre', 'w') as out:
+            out.write('\n'.join(newicks) + '\n')
+        n = annotate_trees_in_parallel('tests/trees.tre', annotations, 'tests/out-trees.tre', 'tests/out-table.tsv',
+                use_taxonomy=False, workers=2)
+        self.failUnless(n == len(newicks))
+        expected_trees = StringIO()
+        expected = StringIO()
+        expected.write('tree\ttype\ttarget_id\tannotation_id\treason\n')
+        for i, newick in enumerate(newicks):
+            tree = TargetTree(dendropy.Tree.get_from_string(newick, 'newick'), use_taxonomy=False)
+            tree.add_phyloreferenced_annotations(annotations)
+            tree.write_labeled_tree(expected_trees)
+            tree.write_table(expected, tree_index=i, header=False)
+        with open('tests/out-table.tsv') as inp:
+            self.failUnless(inp.read() == expected.getvalue())
+        with open('tests/out-trees.tre') as inp:
+            self.failUnless(inp.read() == expected_trees.getvalue())
+
+    def test_table_writers(self):
+        labels = ['t' + str(i) for i in range(30)]
+        newicks = [Tests.random_newick(30) for i in range(3)]
+        annotations = Tests.random_annotations(labels, 60)
+        with open('tests/trees.tre', 'w') as out:
+            out.write('\n'.join(newicks) + '\n')
+        with open('tests/annotations.json', 'w') as out:
+            json.dump([a.to_json() for a in annotations], out)
+        annotate_trees_in_parallel('tests/trees.tre', annotations, 'tests/out-trees.tre', 'tests/out-table.tsv',
+                use_taxonomy=False, workers=2)
+        with open('tests/out-table.tsv') as inp:
+            expected = inp.read()
+        rows = [tuple(l.split('\t')) for l in expected.splitlines()[1:]]
+        self.failUnless(list(read_table('tests/out-table.tsv')) == rows)
+
+        # every tree of the file goes to one table, in any format, whether the
+        # trees are mapped here or by workers
+        for name, table_format in [('table.tsv', 'tsv'), ('table.tsv.gz', 'tsv'), ('table.columns', 'columns'), \
+                ('table.columns.gz', 'columns')]:
+            for workers in [1, 2]:
+                main('tests/trees.tre', 'tests/annotations.json', 'tests/seq-trees.tre', 'tests/' + name, \
+                        use_taxonomy=False, workers=workers, table_format=table_format)
+                self.failUnless(list(read_table('tests/' + name)) == rows)
+                if name == 'table.tsv':
+                    with open('tests/' + name) as inp:
+                        self.failUnless(inp.read() == expected)
+            if table_format == 'columns':
+                columns = read_table_columns('tests/' + name)
+                self.failUnless(list(columns['tree']) == [int(r[0]) for r in rows])
+                self.failUnless(columns['annotation_id'] == [r[3] for r in rows])
+                self.failUnless([Reason.to_str(c) for c in columns['reason']] == [r[4] for r in rows])
+
+        # a single tree keeps the layout of write_table, and small buffers
+        # give the same output
+        tree = TargetTree(dendropy.Tree.get_from_string(newicks[0], 'newick'), use_taxonomy=False)
+        tree.add_phyloreferenced_annotations(annotations)
+        expected = StringIO()
+        tree.write_table(expected)
+        out = StringIO()
+        writer = TableWriter(out, buffer_size=10)
+        for row in tree.iter_table_rows():
+            writer.write_rows([row])
+        writer.flush()
+        self.failUnless(out.getvalue() == expected.getvalue())
+        self.failUnless(expected.getvalue().startswith('type\ttarget_id\tannotation_id\treason\n'))
+
+    def test_split_encodings_agree(self):
+        for rooting in ['[&R] ', '[&U] ']:
+            newick = rooting + Tests.random_newick(60)[5:]
+            trees = []
+            for encoding in [SplitEncoding.BITMASK, SplitEncoding.INTERVAL, SplitEncoding.HASH]:
+                t = dendropy.Tree.get_from_string(newick, 'newick')
+                trees.append(TargetTree(t, use_taxonomy=False, split_encoding=encoding))
+            bitmask_tree = trees[0]
+
+            # every clade and every clade complement is a split
+            labels = [x.label for x in bitmask_tree.tree.taxon_namespace]
+            queries = [random.sample(labels, random.randrange(0, 60)) for i in range(200)]
+            for node in bitmask_tree.tree.preorder_node_iter():
+                clade = [x.taxon.label for x in node.leaf_nodes()]
+                queries.append(clade)
+                queries.append([x for x in labels if x not in clade])
+
+            for q in queries:
+                results = []
+                for tree in trees:
+                    taxa = tree.get_taxa_in_tree(q)[0]
+                    taxon_set = tree.get_taxon_set(taxa)
+                    results.append([tree.is_split(taxon_set)] + \
+                            [tree.clade_overlaps(n, taxon_set) for n in tree.tree.preorder_node_iter()])
+                self.failUnless(results[0] == results[1] == results[2])
+
+            # with colliding taxon hashes every candidate node is checked
+            index = trees[1].index
+            index.taxon_hashes = lambda taxa=None: array('L', [random.randrange(2) for l in index.labels])
+            table = SplitTable(index, rooted=index.is_rooted)
+            for q in queries:
+                taxon_set = trees[1].get_taxon_set(trees[1].get_taxa_in_tree(q)[0])
+                self.failUnless(table.is_split(taxon_set) == index.is_split(taxon_set, rooted=index.is_rooted))
+
+    def test_specifier_resolution_cache(self):
+        t = dendropy.Tree.get_from_string('[&R] ((1,2),(3,4));', 'newick')
+        tree = TargetTree(t, use_taxonomy=False)
+        a = Annotation(0)
+        a.target = ReferenceTarget.from_data({
+            "type": "branch",
+            "included_ids": [1, 2],
+            "excluded_ids": [3, 6],
+            "error_checks": [["REQUIRE_MONOPHYLETIC", 1, 2], ["TARGET_EXCLUDES", 3]],
+            "warning_checks": [["TARGET_EXCLUDES", 4]]
+        })
+        r = tree.add_phyloreferenced_annotation(a)
+        self.failUnless(r.reason_code == Reason.SUCCESS)
+        self.failUnless(r.attached_to is t.find_node_with_taxon_label('1').parent_node.edge)
+        self.failUnless(r.missing_exc == ['6'])
+        self.failUnless(tree.number_resolution_misses == 5)
+        self.failUnless(tree.number_resolution_hits == 3)
+        tree.add_phyloreferenced_annotation(a)
+        self.failUnless(tree.number_resolution_misses == 5)
+        self.failUnless(tree.number_resolution_hits == 11)
+
+    _TAXONOMY_TSV = [
+        ['uid', 'parent_uid', 'name', 'rank', 'sourceinfo', 'uniqname', 'flags'],
+        ['1', '', 'life', 'no rank', '', '', ''],
+        ['2', '1', 'A', 'genus', '', '', ''],
+        ['3', '2', 'A a', 'species', '', '', ''],
+        ['4', '2', 'A b', 'species', '', '', ''],
+        ['5', '1', 'B', 'genus', '', '', ''],
+        ['6', '5', 'B c', 'species', '', '', ''],
+        ['7', '5', 'B d', 'species', '', '', ''],
+        ['8', '7', 'B d e', 'subspecies', '', '', ''],
+    ]
+
+    def write_taxonomy(self):
+        tax = 'tests/taxonomy.tsv'
+        with open(tax, 'w') as out:
+            for row in self._TAXONOMY_TSV:
+                out.write('\t|\t'.join(row) + '\t|\t\n')
+        with open('tests/version.txt', 'w') as out:
+            out.write('ott-test\n')
+        return tax
+
+    def test_local_taxonomy_index(self):
+        taxonomy = OTTTaxonomyIndex.build(self.write_taxonomy(), 'tests/ott.idx')
+        self.failUnless(taxonomy.version == 'ott-test')
+        self.failUnless(len(taxonomy) == 8)
+        self.failUnless(sorted(taxonomy.descendants(5)) == [5, 6, 7, 8])
+        self.failUnless(sorted(taxonomy.descendants('2')) == [2, 3, 4])
+        self.failUnless(list(taxonomy.descendants(8)) == [8])
+        self.failUnless(taxonomy.descendants(9) is None)
+        p = taxonomy.position(8)
+        self.failUnless(taxonomy.ids[taxonomy.parent[p]] == 7)
+        self.failUnless(OTTNameConverter(taxonomy_index=taxonomy).get_taxonomy_version() == 'ott-test')
+        os.remove('tests/version.txt')
+        unversioned = OTTTaxonomyIndex.build('tests/taxonomy.tsv', 'tests/ott-unversioned.idx')
+        with self.assertRaises(RuntimeError):
+            OTTNameConverter(taxonomy_index=unversioned).get_taxonomy_version()
+        unversioned.close()
+        self.failUnless(OTTTaxonomyIndex.build('tests/taxonomy.tsv', 'tests/ott-unversioned.idx', 'v2').version == 'v2')
+
+        # expansion and mapping without taxomachine
+        converter = OTTNameConverter(taxonomy_index=OTTTaxonomyIndex('tests/ott.idx'))
+        self.failUnless(sorted(converter.expand_clade_using_ott(1)) == [str(i) for i in range(1, 9)])
+        self.failUnless(list(converter.expand_clade_using_ott(9)) == ['9'])
+        t = dendropy.Tree.get_from_string('[&R] ((3,4),(6,8));', 'newick')
+        tree = TargetTree(t, name_converter=converter)
+        a = Annotation(0)
+        a.target = ReferenceTarget.from_data({"type": "node", "included_ids": [5]})
+        r = tree.add_phyloreferenced_annotation(a)
+        self.failUnless(r.attached_to is t.find_node_with_taxon_label('6').parent_node)
+
+    def test_compact_clades_in_tree(self):
+        t = dendropy.Tree.get_from_string('[&R] ((3,4),(6,(8,9)));', 'newick')
+        tree = TargetTree(t, name_converter=OTTNameConverter(taxomachine=Tests.StubTaxomachine([])))
+        for ids, expected in [([5, 6, 7, 8], ['6', '8']), (range(1, 1000), ['3', '4', '6', '8', '9']), \
+                ([9], ['9']), ([10, 11], []), ([], [])]:
+            clade = IdArrayClade(ids)
+            self.failUnless(sorted(x.label for x in clade.taxa_in_tree(tree)) == expected)
+            self.failUnless(list(clade) == [str(i) for i in sorted(ids)])
+
+        taxonomy = OTTTaxonomyIndex.build(self.write_taxonomy(), 'tests/ott.idx')
+        for ott_id, expected in [(1, ['3', '4', '6', '8']), (5, ['6', '8']), (7, ['8']), (4, ['4'])]:
+            first, last = taxonomy.descendant_range(ott_id)
+            clade = TaxonomyRangeClade(taxonomy, first, last)
+            self.failUnless(sorted(x.label for x in clade.taxa_in_tree(tree)) == expected)
+            self.failUnless(str(ott_id) in clade)
+
+    def test_persistent_expansion_cache(self):
+        cache = ExpansionCache('tests/expansions.db', 'v1', max_entries=2)
+        self.failUnless(cache.get(1) is None)
+        cache.put(1, ['1', '2', '3'])
+        cache.put('4', ['4'])
+        self.failUnless(list(cache.get('1')) == ['1', '2', '3'])
+        cache.put(5, ['5', '6'])
+        # 4 was the least recently used
+        self.failUnless(cache.get(4) is None)
+        self.failUnless(list(cache.get(5)) == ['5', '6'])
+        self.failUnless((cache.hits, cache.misses) == (2, 2))
+        cache.close()
+
+        # entries survive the process and are keyed by taxonomy version
+        cache = ExpansionCache('tests/expansions.db', 'v2')
+        self.failUnless(cache.get(1) is None)
+        cache.warm([1, 7], lambda i: [str(i), '8'])
+        self.failUnless(list(cache.get(7)) == ['7', '8'])
+        cache.close()
+        cache = ExpansionCache('tests/expansions.db', 'v1')
+        converter = OTTNameConverter(expansion_cache=cache)
+        self.failUnless(list(converter.expand_clade_using_ott('1')) == ['1', '2', '3'])
+        self.failUnless(cache.hit_rate == 1.0)
+        cache.close()
+
+    def test_placement_cache(self):
+        newick = Tests.random_newick(60)
+        labels = ['t' + str(i) for i in range(60)]
+        annotations = Tests.random_annotations(labels, 80)
+        for i in range(20):
+            # same target, other id and body
+            a = Annotation(100 + i)
+            a.target = annotations[i].target
+            a.body = {'copy of': i}
+            annotations.append(a)
+        def run(tree, cache=None):
+            if cache is None:
+                outcomes = tree.add_phyloreferenced_annotations(annotations)
+            else:
+                outcomes = tree.add_phyloreferenced_annotations_cached(annotations, cache)
+            out = StringIO()
+            tree.write_table(out)
+            return out.getvalue(), Tests.outcome_results(tree, outcomes)
+        # (unnamed nodes are numbered differently by the two kinds of tree)
+        expected = run(TargetTree(dendropy.Tree.get_from_string(newick, 'newick'), use_taxonomy=False))
+        expected_indexed = run(make_target_tree(newick, use_taxonomy=False, stream_parse=True))
+        indexed = make_target_tree(newick, use_taxonomy=False, stream_parse=True)
+        self.failUnless(indexed.index.content_hash() == \
+                TargetTree(dendropy.Tree.get_from_string(newick, 'newick'), use_taxonomy=False).index.content_hash())
+        self.failUnless(indexed.index.content_hash() != \
+                make_target_tree(Tests.random_newick(60), use_taxonomy=False, stream_parse=True).index.content_hash())
+        cache = PlacementCache('tests/placements.db', 'v1')
+        self.failUnless(run(indexed, cache) == expected_indexed)
+        self.failUnless(cache.hits == 0 and cache.misses == 80)
+        target = annotations[0].target
+        self.failUnless(PlacementCache.target_key(target, True) != PlacementCache.target_key(target, False))
+
+        # the cache is not silently left unused by the other ways of mapping
+        with open('tests/tree.tre', 'w') as out:
+            out.write(newick + ';\n')
+        with open('tests/annotations.jsonl', 'w') as out:
+            for a in annotations:
+                out.write(json.dumps(a.to_json()) + '\n')
+        for options in [{'workers': 2}, {'shard_annotations': True}, {'induced_subtree': True}, \
+                {'previous_tree_filename': 'tests/tree.tre', 'previous_table_filename': 'tests/out-table.tsv'}]:
+            with self.assertRaises(ValueError):
+                main('tests/tree.tre', 'tests/annotations.jsonl', 'tests/out-tree.tre', 'tests/out-table.tsv', \
+                        use_taxonomy=False, placement_cache=cache, **options)
+        cache.close()
+        for v, hits in [('v1', 80), ('v2', 0)]:
+            cache = PlacementCache('tests/placements.db', v)
+            tree = TargetTree(dendropy.Tree.get_from_string(newick, 'newick'), use_taxonomy=False)
+            self.failUnless(run(tree, cache) == expected)
+            self.failUnless(cache.hits == hits and tree.number_annotations_from_cache == (100 if hits else 0))
+            cache.close()
+
+    class StubTaxomachine(object):
+        # answers subtree calls from the test taxonomy, slowly, keeping the
+        # largest number of calls in flight at once
+        def __init__(self, rows):
+            self.calls = []
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self._lock = threading.Lock()
+            self._children = {}
+            self._names = {}
+            for row in rows[1:]:
+                self._children.setdefault(row[1], []).append(row[0])
+                self._names[row[0]] = row[2].replace(' ', '_') + '_ott' + row[0]
+        def _newick(self, ott_id):
+            c = self._children.get(ott_id)
+            if not c:
+                return self._names[ott_id]
+            return '(' + ','.join(self._newick(i) for i in c) + ')' + self._names[ott_id]
+        def subtree(self, ott_id):
+            with self._lock:
+                self.calls.append(ott_id)
+                self.in_flight += 1
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            time.sleep(0.1)
+            with self._lock:
+                self.in_flight -= 1
+            return {'subtree': self._newick(str(ott_id)) + ';'}
+        def info(self):
+            raise IOError('taxomachine is down')
+
+    def test_prefetch_expansions(self):
+        stub = Tests.StubTaxomachine(self._TAXONOMY_TSV)
+        converter = OTTNameConverter(taxomachine=stub)
+        annotations = []
+        for i in range(20):
+            a = Annotation(i)
+            a.target = ReferenceTarget.from_data({
+                "type": "branch",
+                "included_ids": [2, 3],
+                "excluded_ids": [6],
+                "error_checks": [["TARGET_EXCLUDES", 8]],
+                "warning_checks": [["REQUIRE_MONOPHYLETIC", 5]]
+            })
+            annotations.append(a)
+        ids = collect_specifiers(annotations)
+        self.failUnless(ids == set(['2', '3', '5', '6', '8']))
+        self.failUnless(converter.prefetch(ids, max_workers=3) == 5)
+        self.failUnless(1 < stub.max_in_flight <= 3)
+        self.failUnless(sorted(stub.calls) == sorted(ids))
+
+        # mapping is served from the prefetched expansions
+        t = dendropy.Tree.get_from_string('[&R] ((3,4),(6,8));', 'newick')
+        tree = TargetTree(t, name_converter=converter)
+        for a in annotations:
+            r = tree.add_phyloreferenced_annotation(a)
+            self.failUnless(r.attached_to is t.find_node_with_taxon_label('3').parent_node.edge)
+        self.failUnless(len(stub.calls) == 5)
+        self.failUnless(converter.prefetch(ids) == 0)
+
+        # without a version the caches can not be keyed
+        with self.assertRaises(RuntimeError):
+            converter.get_taxonomy_version()
+
     def test_roundtrip_100_ascii_annotations_n_times(self):
         for i in range(100):
             self.roundtrip_random_annotation_n_times(random.randrange(1,10), False)
@@ -1036,6 +5007,67 @@ class Tests(unittest.TestCase):
             # ensure that the result is identical
             self.failUnless(identical)
     
+    def test_lazy_annotation_matches_eager(self):
+        for use_utf8 in [False, True]:
+            for i in range(10):
+                r = RandomAnnotation(id=i, use_utf8=use_utf8)
+                data = json.loads(r.summary)
+                lazy = Annotation.from_data(data, lazy=True)
+                self.failUnless(lazy.target.to_json() == r.target.to_json())
+                self.failUnless(lazy.to_json() == Annotation.from_data(data).to_json())
+                y = data
+                for j in range(4):
+                    y = json.loads(Annotation.from_data(y, lazy=j % 2 == 1).summary)
+                self.failUnless(Tests.compare_json(data, y))
+
+    def test_lazy_annotation(self):
+        r = RandomAnnotation(id=0)
+        data = json.loads(r.summary)
+        data['oa:annotatedAt'] = 'not a time'
+        lazy = Annotation.from_data(data, lazy=True)
+        for i in range(2):
+            with self.assertRaises(ValueError):
+                lazy.annotated_at
+        self.failUnless(Tests.compare_json(lazy.body, data['oa:hasBody']))
+        lazy.annotated_at = datetime.now().isoformat()
+        self.failUnless(lazy.to_json()['oa:annotatedBy'] == r.annotated_by.to_json())
+
+        # main validates every annotation unless it is asked to read them lazily
+        data['oa:annotatedBy'] = {'nameless': 1}
+        with open('tests/tree.tre', 'w') as out:
+            out.write('((a,b),c);\n')
+        with open('tests/annotations.jsonl', 'w') as out:
+            out.write(json.dumps(data) + '\n')
+        for options in [{}, {'stream_parse': True, 'annotation_batch_size': 1}]:
+            with self.assertRaises(ValueError):
+                main('tests/tree.tre', 'tests/annotations.jsonl', 'tests/out-tree.tre', 'tests/out-table.tsv', \
+                        use_taxonomy=False, **options)
+            main('tests/tree.tre', 'tests/annotations.jsonl', 'tests/out-tree.tre', 'tests/out-table.tsv', \
+                    use_taxonomy=False, lazy_annotations=True, **options)
+
+    def test_shared_entity(self):
+        data = json.loads(RandomAnnotation(id=0).summary)
+        data['oa:annotatedBy']['invocation'] = {'args': ['a']}
+        a, b = Annotation.from_data(data), Annotation.from_data(data)
+        self.failUnless(a.annotated_by is b.annotated_by)
+        with self.assertRaises(ValueError):
+            a.annotated_by.name = 'other'
+        a.annotated_by.invocation['args'].append('b')
+        a.annotated_by.to_json()['invocation']['args'].append('b')
+        e = a.annotated_by.copy()
+        e.name = 'other'
+        e.invocation['args'].append('b')
+        a.annotated_by = e
+        self.failUnless(b.annotated_by.name == data['oa:annotatedBy']['name'])
+        self.failUnless(b.annotated_by.invocation == {'args': ['a']})
+        self.failUnless(a.annotated_by.invocation == {'args': ['a', 'b']})
+
+        # the tables of shared values are bounded
+        for i in range(_MAX_INTERNED + 10):
+            _intern(str(i))
+        self.failUnless(len(_INTERNED) <= _MAX_INTERNED)
+        self.failUnless(_intern('x' + str(i)) == 'x' + str(i))
+
     @staticmethod
     def compare_json(x,y):
         try:
@@ -1223,6 +5255,89 @@ class Tests(unittest.TestCase):
         # bad json structure
         pass
 
+    def test_annotation_corpus(self):
+        newick = Tests.random_newick(50)
+        labels = ['t' + str(i) for i in range(50)]
+        annotations = Tests.random_annotations(labels, 40)
+        for i, a in enumerate(annotations):
+            if i % 3 == 0:
+                a.id = 'a{}'.format(i)
+            a.target.include_specifiers([i * 1000, str(i)])
+            a.body = {'value': i, u'n\xe4me': [u'\u2603']}
+        annotations.append(RandomAnnotation(id=u'\xe9t\xe9', use_utf8=True))
+        corpus = AnnotationCorpus.build(annotations, 'tests/annotations.corpus')
+        self.failUnless(AnnotationCorpus.is_corpus('tests/annotations.corpus'))
+        self.failUnless(len(corpus) == len(annotations))
+        self.failUnless([a.to_json() for a in corpus] == [a.to_json() for a in annotations])
+        for a in random.sample(annotations, 10):
+            self.failUnless(corpus.get(a.id).to_json() == a.to_json())
+        self.failUnless(corpus.get('a1') is None and corpus.get(1).id == 1 and corpus.get('a0').id == 'a0')
+        self.failUnless(corpus[-1].to_json() == annotations[-1].to_json())
+        out = StringIO()
+        corpus.write_json(out)
+        corpus.close()
+        self.failUnless([a.to_json() for a in iter_annotations(StringIO(out.getvalue()))] == \
+                [a.to_json() for a in annotations])
+        with open('tests/tree.tre', 'w') as out:
+            out.write(newick + '\n')
+        with open('tests/annotations.jsonl', 'w') as out:
+            for a in annotations[:-1]:
+                out.write(json.dumps(a.to_json()) + '\n')
+        AnnotationCorpus.build(annotations[:-1], 'tests/annotations.corpus').close()
+        tables = []
+        for name in ['annotations.jsonl', 'annotations.corpus']:
+            main('tests/tree.tre', 'tests/' + name, 'tests/out-tree.tre', 'tests/out-table.tsv', \
+                    use_taxonomy=False, annotation_batch_size=7)
+            with open('tests/out-table.tsv') as inp:
+                tables.append(inp.read())
+        self.failUnless(tables[0] == tables[1])
+
+        # sections past the int32 offsets are refused while building
+        wide = Annotation(0)
+        wide.target.include_specifiers(range(1000))
+        long_bodies = [Annotation(i) for i in range(10)]
+        for a in long_bodies:
+            a.body = {'text': 'x' * 200}
+        for size, batch, section in [(20, annotations, 'strings'), (1000, [wide], 'record values'), \
+                (1000, long_bodies, 'bodies')]:
+            AnnotationCorpus.MAX_SECTION_SIZE = size
+            try:
+                with self.assertRaises(ValueError) as e:
+                    AnnotationCorpus.build(batch, 'tests/annotations.corpus')
+                self.failUnless(section in str(e.exception))
+            finally:
+                AnnotationCorpus.MAX_SECTION_SIZE = (1 << 31) - 1
+
+    def test_annotation_validator(self):
+        validator = AnnotationValidator('../schemas')
+        self.failUnless(len(validator.schemas) == 3)
+        documents = [json.loads(RandomAnnotation(id=i).summary) for i in range(20)]
+        for d in documents:
+            self.failUnless(validator.errors(d) == [])
+        bad = dict(documents[0])
+        del bad['_id']
+        bad['oa:annotatedAt'] = 'not a time'
+        bad['oa:hasTarget'] = {'type': 'tree', 'included_ids': [1, 2], 'error_checks': [['NOPE', 1]]}
+        bad['oa:hasBody'] = {'type': 'taxonomy label', 'name': 3}
+        self.failUnless(sorted(validator.errors(bad)) == sorted([
+                "/: missing the required property '_id'",
+                '/oa:annotatedAt: is not a valid date-time',
+                '/oa:hasTarget/type: is not a valid target-type',
+                '/oa:hasTarget/error_checks/0: is not a valid reference-condition',
+                '/oa:hasBody/name: must be of type string',
+                "/oa:hasBody: missing the required property 'source'"]))
+        documents[3]['oa:hasBody'] = {'type': 'divergence time estimate', 'citation': 'x', 'mean age': 'old'}
+        documents[7]['oa:hasTarget']['included_ids'] = 'a'
+        documents[9] = []
+        with open('tests/annotations.jsonl', 'w') as out:
+            for d in documents:
+                out.write(json.dumps(d) + '\n')
+        for workers in [1, 2]:
+            report = validate_annotations('tests/annotations.jsonl', '../schemas', workers=workers, chunk_size=4)
+            self.failUnless(report == [(3, 3, ['/oa:hasBody/mean age: must be of type integer']), \
+                    (7, 7, ['/oa:hasTarget/included_ids: must be of type array']), \
+                    (9, None, ['/: must be of type object'])])
+
     def NEED_inconsisent_target_from_data(self):
         # this is for an inconsistent target
         # - overlap between included/excluded ids
@@ -1324,17 +5439,138 @@ if __name__ == '__main__':
     parser.add_argument('--tree-file',
                         help='filepath to newick file with labels as ott IDs or using the name_ott#### convention')
     parser.add_argument('--out-table',
-                        required=True,
-                        help='file to output with the annotation placements')
+                        help='file to output with the annotation placements (gzipped if the name ends in .gz)')
+    parser.add_argument('--table-format',
+                        choices=sorted(TABLE_FORMATS),
+                        default='tsv',
+                        help='format of the --out-table: tab-separated text, or a binary column file for analytics')
     parser.add_argument('--out-tree',
-                        required=True,
                         help='file to output with a tree with IDs to be used with the out-table')
-    parser.add_argument('json', help='filepath to JSON file with annotations')
+    parser.add_argument('--ott-index',
+                        help='filepath to a local OTT taxonomy index used to expand ott IDs instead of calling taxomachine')
+    parser.add_argument('--ott-taxonomy',
+                        help='filepath to the taxonomy.tsv of an OTT release, used to build the --ott-index file if it does not exist')
+    parser.add_argument('--expansion-cache',
+                        help='filepath to a persistent (SQLite) cache of the clade expansions fetched from taxomachine')
+    parser.add_argument('--expansion-cache-size',
+                        type=int,
+                        default=100000,
+                        help='maximum number of expansions kept in the --expansion-cache (least recently used are evicted)')
+    parser.add_argument('--warm-expansion-cache',
+                        help='filepath to a list of ott IDs (one per line) to fetch into the --expansion-cache before mapping')
+    parser.add_argument('--taxonomy-version',
+                        help='OTT version used to key the --expansion-cache and --placement-cache (default: asked from taxomachine, or read from the --ott-index, which must then have one); also the version of an --ott-index built from --ott-taxonomy')
+    parser.add_argument('--placement-cache',
+                        help='filepath to a persistent (SQLite) cache of placements keyed by tree, taxonomy version and target; only targets not in it are mapped (not with --workers, --shard-annotations, --previous-tree or --induced-subtree)')
+    parser.add_argument('--prefetch-workers',
+                        type=int,
+                        default=8,
+                        help='number of concurrent taxomachine requests used to expand all ott IDs before mapping (0 to expand them lazily)')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=1,
+                        help='number of processes used to annotate the trees of a multi-tree file (writes all trees and one table with a leading tree index column)')
+    parser.add_argument('--shard-annotations',
+                        action='store_true',
+                        default=False,
+                        help='with --workers, split the annotation list of each tree between the workers (for a single large tree) instead of giving each worker whole trees')
+    parser.add_argument('--tree-index-dir',
+                        help='directory of saved tree indexes (keyed by a hash of the newick); trees with a saved index are memory-mapped instead of parsed')
+    parser.add_argument('--stream-parse',
+                        action='store_true',
+                        default=False,
+                        help='read trees straight into the compact tree index instead of building dendropy trees (much faster and smaller for large trees)')
+    parser.add_argument('--induced-subtree',
+                        action='store_true',
+                        default=False,
+                        help='map the annotations onto the subtree induced by the taxa they refer to (implies --stream-parse, not with --workers; for small annotation sets on large trees)')
+    parser.add_argument('--previous-tree',
+                        help='filepath to the previous version of the (single) input tree; with --previous-table, placements in unchanged clades are carried forward instead of remapped')
+    parser.add_argument('--previous-table',
+                        help='filepath to the --out-table written for the --previous-tree (with --write-resolutions)')
+    parser.add_argument('--write-resolutions',
+                        action='store_true',
+                        default=False,
+                        help='also write the taxa every specifier resolved to (as hashes) next to the --out-table, so that the next version of the tree can be mapped with --previous-tree')
+    parser.add_argument('--annotation-batch-size',
+                        type=int,
+                        default=10000,
+                        help='number of annotations read and mapped at a time when the trees are mapped in a single process')
+    parser.add_argument('--lazy-annotations',
+                        action='store_true',
+                        default=False,
+                        help='only parse the targets of the annotations when mapping; timestamps, annotators and bodies are not validated')
+    parser.add_argument('--validate',
+                        action='store_true',
+                        default=False,
+                        help='check all annotations against the --schema-dir schemas first, report every problem and stop if any are found (uses --workers processes)')
+    parser.add_argument('--schema-dir',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'schemas'),
+                        help='directory of the annotation schemas used by --validate')
+    parser.add_argument('--write-corpus',
+                        help='write the annotations to this binary annotation corpus file (which can be given in place of the JSON) and exit')
+    parser.add_argument('--write-json',
+                        help='write the annotations of a binary annotation corpus to this JSON-lines file and exit')
+    parser.add_argument('json', help='filepath to the annotations, as a JSON array or JSON-lines (one annotation per line), or a binary annotation corpus (see --write-corpus)')
     args = parser.parse_args()
     annotations_file = args.json
     o_tree = args.out_tree
     o_table = args.out_table
 
+    taxonomy_index = None
+    if args.ott_index is not None:
+        if not os.path.exists(args.ott_index):
+            if args.ott_taxonomy is None:
+                sys.exit('OTT index "{}" does not exist; use --ott-taxonomy to build it\n'.format(args.ott_index))
+            sys.stderr.write('Building OTT index "{}" from "{}"\n'.format(args.ott_index, args.ott_taxonomy))
+            taxonomy_index = OTTTaxonomyIndex.build(args.ott_taxonomy, args.ott_index, args.taxonomy_version)
+        else:
+            taxonomy_index = OTTTaxonomyIndex(args.ott_index)
+
+    version = args.taxonomy_version
+    if version is None and (args.expansion_cache is not None or args.placement_cache is not None):
+        try:
+            version = OTTNameConverter(taxonomy_index=taxonomy_index).get_taxonomy_version()
+        except RuntimeError as x:
+            sys.exit('{}; use --taxonomy-version to key the caches\n'.format(x))
+    expansion_cache = None
+    if args.expansion_cache is not None:
+        expansion_cache = ExpansionCache(args.expansion_cache, version, args.expansion_cache_size)
+        if args.warm_expansion_cache is not None:
+            with open(args.warm_expansion_cache) as inp:
+                ids = [line.strip() for line in inp if line.strip()]
+            expansion_cache.warm(ids, OTTNameConverter().expand_clade_using_taxomachine)
+
+    if args.validate:
+        report = validate_annotations(annotations_file, args.schema_dir, workers=args.workers)
+        for n, annotation_id, errors in report:
+            for e in errors:
+                sys.stderr.write('annotation {n} ({i}): {e}\n'.format(n=n, i=annotation_id, e=e))
+        if report:
+            sys.exit('{} invalid annotations\n'.format(len(report)))
+
+    if args.write_corpus is not None:
+        annotations = (a for batch in iter_annotation_batches(annotations_file) for a in batch)
+        AnnotationCorpus.build(annotations, args.write_corpus).close()
+        sys.exit(0)
+    if args.write_json is not None:
+        if not AnnotationCorpus.is_corpus(annotations_file):
+            sys.exit('"{}" is not an annotation corpus\n'.format(annotations_file))
+        corpus = AnnotationCorpus(annotations_file)
+        with open(args.write_json, 'w') as out:
+            corpus.write_json(out)
+        corpus.close()
+        sys.exit(0)
+    if o_tree is None or o_table is None:
+        sys.exit('--out-tree and --out-table are required\n')
+
+    if (args.previous_tree is None) != (args.previous_table is None):
+        sys.exit('--previous-tree and --previous-table must be used together\n')
+
+    placement_cache = None
+    if args.placement_cache is not None:
+        placement_cache = PlacementCache(args.placement_cache, version)
+
     if args.tree_file is not None:
         tree_file = args.tree_file
     else:
@@ -1356,4 +5592,17 @@ if __name__ == '__main__':
         _o.close()
         tree_file = tmpf
     
-    main(tree_file, annotations_file, o_tree, o_table)
+    main(tree_file, annotations_file, o_tree, o_table, taxonomy_index=taxonomy_index,
+            expansion_cache=expansion_cache, prefetch_workers=args.prefetch_workers, workers=args.workers,
+            shard_annotations=args.shard_annotations, tree_index_dir=args.tree_index_dir,
+            stream_parse=args.stream_parse, previous_tree_filename=args.previous_tree,
+            previous_table_filename=args.previous_table, induced_subtree=args.induced_subtree, \
+            write_resolutions=args.write_resolutions, lazy_annotations=args.lazy_annotations,
+            annotation_batch_size=args.annotation_batch_size, placement_cache=placement_cache, \
+            table_format=args.table_format)
+    if placement_cache is not None:
+        placement_cache.close()
+    if expansion_cache is not None:
+        debug('expansion cache: {h} hits, {m} misses ({r:.1%} hit rate)'.format(h=expansion_cache.hits, \
+                m=expansion_cache.misses, r=expansion_cache.hit_rate))
+        expansion_cache.close()
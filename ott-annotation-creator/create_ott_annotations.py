@@ -4,8 +4,9 @@ from datetime import *
 
 def encode_ott_json(uid,name,rank):
     x = {"@context": {"name": "http://schema.org/name","prov": "http://www.w3.org/ns/prov#","oa": "http://www.w3.org/ns/oa#"},"@type": "oa:Annotation","oa:annotatedBy": {"@type": "prov:Entity","name": "blackrim"}}
+    x["_id"] = uid
     x["oa:annotatedAt"] = str(datetime.now())
-    x["oa:hasTarget"] = { "@type":"node" ,"included_ids":[uid], "error_checks":[], "warning_checks":[]}
+    x["oa:hasTarget"] = { "type":"node" ,"included_ids":[uid], "error_checks":[], "warning_checks":[]}
     x["oa:hasBody"] = {"@type" : "taxonomy label", "@id" : "IRI","name":name,"rank":"","source":"ott","unique id":uid}
     return x
 